@@ -0,0 +1,134 @@
+import gzip
+import hashlib
+import os
+from typing import Dict, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:  # brotli variants are skipped; gzip is always available
+    brotli = None  # type: ignore[assignment]
+
+
+# Directory with the Web App's CSS / JS / data files, served under /assets/
+STATIC_DIR = os.environ.get("STATIC_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"))
+# Versioned URLs change whenever the content does, so clients may keep them forever
+ASSET_MAX_AGE = int(os.environ.get("ASSET_MAX_AGE", str(365 * 24 * 3600)))
+
+_CONTENT_TYPES = {
+    ".css": "text/css; charset=utf-8",
+    ".js": "text/javascript; charset=utf-8",
+    ".json": "application/json",
+}
+
+
+class StaticAsset:
+    """
+    One file from STATIC_DIR, read and compressed once per process. Served as
+    "<stem>.<content hash><ext>", e.g. /assets/trial.3f2a9c81d0e4.css.
+    """
+
+    __slots__ = ("name", "content_type", "digest", "url", "bodies")
+
+    def __init__(self, name: str, data: bytes) -> None:
+        stem, ext = os.path.splitext(name)
+        self.name = name
+        self.content_type = _CONTENT_TYPES.get(ext, "application/octet-stream")
+        self.digest = hashlib.sha256(data).hexdigest()[:12]
+        self.url = f"/assets/{stem}.{self.digest}{ext}"
+        # Content-Encoding -> body; a variant is only kept if it is smaller
+        self.bodies: Dict[str, bytes] = {"identity": data}
+        compressed = {"gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            compressed["br"] = brotli.compress(data, quality=11)
+        for encoding, body in compressed.items():
+            if len(body) < len(data):
+                self.bodies[encoding] = body
+
+    def etag(self, encoding: str) -> str:
+        return f'"{self.digest}"' if encoding == "identity" else f'"{self.digest}-{encoding}"'
+
+
+def _load_assets(directory: str) -> Dict[str, StaticAsset]:
+    assets: Dict[str, StaticAsset] = {}
+    if not os.path.isdir(directory):
+        return assets
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                assets[name] = StaticAsset(name, f.read())
+    return assets
+
+
+_assets = _load_assets(STATIC_DIR)
+# "<stem>.<digest><ext>" -> asset, for the current content of every file
+_by_versioned_name = {asset.url.rsplit("/", 1)[1]: asset for asset in _assets.values()}
+
+
+def asset_url(name: str) -> str:
+    """Content-hashed URL of static/<name> (raises KeyError for unknown files)."""
+    return _assets[name].url
+
+
+def _accepted_encodings(accept_encoding: str) -> Dict[str, float]:
+    accepted: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = q
+    return accepted
+
+
+def _choose_encoding(asset: StaticAsset, accept_encoding: str) -> str:
+    accepted = _accepted_encodings(accept_encoding)
+    for encoding in ("br", "gzip"):
+        if encoding in asset.bodies and accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return "identity"
+
+
+def _matches(if_none_match: str, etag: str) -> bool:
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    # Weak comparison, as RFC 9110 requires for If-None-Match
+    return "*" in tags or any(tag[2:] == etag if tag.startswith("W/") else tag == etag for tag in tags)
+
+
+def asset_response(
+    versioned_name: str, if_none_match: Optional[str], accept_encoding: Optional[str]
+) -> Tuple[bytes, int, Dict[str, str]]:
+    """
+    (body, status, headers) for GET /assets/<versioned_name>. Framework
+    agnostic, so any app can serve the same precompressed bytes.
+
+    Current URLs are cacheable forever (immutable). A name whose hash is
+    stale - e.g. a page from the previous deploy - still gets the current
+    content, but with no-cache so it isn't pinned under the old URL.
+    """
+    asset = _by_versioned_name.get(versioned_name)
+    immutable = asset is not None
+    if asset is None:
+        stem, _, rest = versioned_name.partition(".")
+        _, _, ext = rest.partition(".")
+        asset = _assets.get(f"{stem}.{ext}")
+        if asset is None:
+            return b"Not found", 404, {"Content-Type": "text/plain; charset=utf-8"}
+
+    encoding = _choose_encoding(asset, accept_encoding or "")
+    headers = {
+        "ETag": asset.etag(encoding),
+        "Cache-Control": f"public, max-age={ASSET_MAX_AGE}, immutable" if immutable else "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+    if if_none_match and _matches(if_none_match, headers["ETag"]):
+        return b"", 304, headers
+    headers["Content-Type"] = asset.content_type
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return asset.bodies[encoding], 200, headers
@@ -0,0 +1,252 @@
+"""
+asyncio version of the verification routes of web_app.py, on aiohttp.
+
+One process keeps hundreds of /trial requests in flight: IP2Location calls
+are non-blocking (IP2LocationClient.lookup_async), and storage / feed writes
+run on a small thread pool where concurrent writes share one group commit.
+Pages, verdicts and storage are the same code as the Flask app, so both
+modes behave identically; the bot / debug endpoints (/api/get-verifications,
+/api/events*, /api/storage-stats, /debug-ip) stay on the Flask app.
+
+    python async_app.py
+    gunicorn async_app:app --worker-class aiohttp.GunicornWebWorker -b 0.0.0.0:8080
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Optional
+
+from aiohttp import web
+
+import web_app
+from assets import asset_response
+from events import publish
+from ip_cache import MISS, AsyncSingleFlight, TTLCache
+from logs import request_id_from, request_id_var
+from metrics import HTTP_LATENCY, HTTP_REQUESTS, IP_CACHE_REQUESTS, render_metrics
+from storage import get_pending_verification, has_passed_step1, set_pending_verification
+from tracing import finish_trace, span, start_trace
+from web_app import (
+    IPVerdict,
+    _already_passed_page,
+    _check_step1_headers,
+    _form_page,
+    _ip_block_page,
+    _missing_fields_page,
+    _missing_tg_id_page,
+    _profile_response,
+    _save_failed_page,
+    _step1_info,
+    _step1_passed_page,
+    _submitted_tg_id,
+    client_ip_from,
+)
+
+log = logging.getLogger(__name__)
+
+# Threads for blocking storage / change-feed calls. Writes that arrive together
+# are committed together, so this bounds concurrency of fsyncs, not requests.
+ASYNC_STORAGE_THREADS = int(os.environ.get("ASYNC_STORAGE_THREADS", "32"))
+
+_storage_pool = ThreadPoolExecutor(max_workers=ASYNC_STORAGE_THREADS, thread_name_prefix="async-storage")
+# Concurrent lookups of the same IP await one upstream request
+_ip_flight = AsyncSingleFlight()
+# Same compact, key-sorted JSON as Flask's jsonify()
+_dumps = functools.partial(json.dumps, sort_keys=True, separators=(",", ":"))
+
+
+async def _offload(fn: Callable[..., Any], *args: Any) -> Any:
+    # run_in_executor() doesn't carry context variables over; copy them so the
+    # request ID reaches log records written on the pool thread
+    call = functools.partial(contextvars.copy_context().run, fn, *args)
+    return await asyncio.get_running_loop().run_in_executor(_storage_pool, call)
+
+
+async def _cache_call(fn: Callable[..., Any], *args: Any) -> Any:
+    # The in-process cache is a dict lookup; SQLite-backed caches may block
+    if isinstance(web_app._ip_cache, TTLCache):
+        return fn(*args)
+    return await _offload(fn, *args)
+
+
+async def _fetch_and_cache(ip: str) -> Optional[dict]:
+    data = await web_app._ip_client.lookup_async(ip)
+    await _cache_call(web_app._ip_cache.set, ip, data)
+    return data
+
+
+async def _lookup_ip_data(ip: str) -> Optional[dict]:
+    """web_app._lookup_ip_data() without blocking the event loop."""
+    data, ask_api = web_app._local_lookup(ip)
+    if not ask_api:
+        return data
+    data = await _cache_call(web_app._ip_cache.get, ip)
+    IP_CACHE_REQUESTS.labels("miss" if data is MISS else "hit").inc()
+    if data is MISS:
+        with span("ip.api_lookup"):
+            data = await _ip_flight.do(ip, lambda: _fetch_and_cache(ip))
+    return data
+
+
+async def get_ip_verdict(ip: str) -> IPVerdict:
+    with span("trial.ip_verdict") as current:
+        verdict = IPVerdict(ip, await _lookup_ip_data(ip))
+        if current is not None:
+            current.set_attribute("is_vpn", verdict.is_vpn)
+            current.set_attribute("blocked_country", verdict.is_blocked_country)
+    return verdict
+
+
+def _html(page: str) -> web.Response:
+    return web.Response(text=page, content_type="text/html")
+
+
+def _json(payload: Any, status: int = 200) -> web.Response:
+    return web.json_response(payload, status=status, dumps=_dumps)
+
+
+@web.middleware
+async def _record_request(request: web.Request, handler: Callable[[web.Request], Awaitable[web.StreamResponse]]) -> web.StreamResponse:
+    started = time.perf_counter()
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else "unmatched"
+    request_id = request_id_from(request.headers.get("X-Request-ID"))
+    # Each request runs in its own task, so this stays with it across awaits
+    request_id_var.set(request_id)
+    trace = start_trace(
+        f"{request.method} {route}", request.headers.get("traceparent"),
+        **{"http.method": request.method, "http.route": route, "request_id": request_id},
+    )
+    status = 500
+    error = None
+    try:
+        response = await handler(request)
+        status = response.status
+        response.headers["X-Request-ID"] = request_id
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        e.headers["X-Request-ID"] = request_id
+        raise
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        finish_trace(trace, error=error, **{"http.status_code": status})
+        duration = time.perf_counter() - started
+        HTTP_REQUESTS.labels(route, request.method, str(status)).inc()
+        HTTP_LATENCY.labels(route, request.method).observe(duration)
+        log.info(
+            "request",
+            extra={"route": route, "method": request.method, "status": status, "duration_ms": round(duration * 1000, 2)},
+        )
+
+
+async def metrics(request: web.Request) -> web.Response:
+    body, content_type = render_metrics()
+    return web.Response(body=body, headers={"Content-Type": content_type})
+
+
+async def admin_profile(request: web.Request) -> web.Response:
+    """web_app.admin_profile(); the event loop keeps serving while it samples."""
+    body, status, headers = await _offload(_profile_response, request.headers, request.query.get("seconds"))
+    return web.Response(text=body, status=status, headers=headers)
+
+
+async def index(request: web.Request) -> web.Response:
+    text, status = web_app.index()
+    return web.Response(text=text, status=status, content_type="text/html")
+
+
+async def static_asset(request: web.Request) -> web.Response:
+    body, status, headers = asset_response(
+        request.match_info["name"], request.headers.get("If-None-Match"), request.headers.get("Accept-Encoding")
+    )
+    return web.Response(body=body, status=status, headers=headers)
+
+
+async def check_step1(request: web.Request) -> web.Response:
+    tg_id_param = request.query.get("tg_id")
+    if not tg_id_param or not tg_id_param.isdigit():
+        return _json({"already_passed": False})
+    passed = await _offload(has_passed_step1, int(tg_id_param))
+    headers = _check_step1_headers(passed)
+    if request.headers.get("If-None-Match") == headers["ETag"]:
+        return web.Response(status=304, headers=headers)
+    response = _json({"already_passed": passed})
+    response.headers.update(headers)
+    return response
+
+
+async def api_get_verification(request: web.Request) -> web.Response:
+    tg_id_param = request.query.get("tg_id")
+    if not tg_id_param or not tg_id_param.isdigit():
+        return _json({"error": "Invalid or missing tg_id"}, status=400)
+    data = await _offload(get_pending_verification, int(tg_id_param))
+    if data:
+        return _json({"success": True, "data": data})
+    return _json({"success": False, "data": None})
+
+
+async def trial(request: web.Request) -> web.Response:
+    """Same steps as web_app.trial()."""
+    with span("trial.client_ip"):
+        ip = client_ip_from(request.headers, request.remote)
+
+    if request.method == "GET":
+        tg_id_param = request.query.get("tg_id")
+        if tg_id_param and tg_id_param.isdigit() and await _offload(has_passed_step1, int(tg_id_param)):
+            return _html(_already_passed_page())
+        blocked_page = _ip_block_page(await get_ip_verdict(ip))
+        if blocked_page is not None:
+            return _html(blocked_page)
+        return _html(_form_page())
+
+    form = await request.post()
+    tg_id = _submitted_tg_id(form, request.query, request.headers)
+    if tg_id is None:
+        return _html(_missing_tg_id_page())
+
+    blocked_page = _ip_block_page(await get_ip_verdict(ip))
+    if blocked_page is not None:
+        return _html(blocked_page)
+
+    info = _step1_info(form, ip)
+    if info is None:
+        return _html(_missing_fields_page())
+
+    if not await _offload(set_pending_verification, tg_id, info):
+        return _html(_save_failed_page())
+    log.info("Step 1 passed", extra={"tg_id": tg_id})
+    await _offload(publish, "step1_passed", tg_id)
+    return _html(_step1_passed_page())
+
+
+async def _close_clients(app: web.Application) -> None:
+    await web_app._ip_client.close_async()
+
+
+def create_app() -> web.Application:
+    app = web.Application(middlewares=[_record_request])
+    app.router.add_get("/metrics", metrics)
+    app.router.add_get("/admin/profile", admin_profile)
+    app.router.add_get("/", index)
+    app.router.add_get("/assets/{name:.+}", static_asset)
+    app.router.add_get("/check-step1", check_step1)
+    app.router.add_get("/api/get-verification", api_get_verification)
+    app.router.add_get("/trial", trial)
+    app.router.add_post("/trial", trial)
+    app.on_cleanup.append(_close_clients)
+    return app
+
+
+app = create_app()
+
+
+if __name__ == "__main__":
+    web.run_app(app, host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
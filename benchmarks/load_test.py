@@ -0,0 +1,298 @@
+"""
+End-to-end load test: web_app under gunicorn against a local IP2Location mock.
+
+    python benchmarks/load_test.py [--rps 100] [--duration 30] [--workers 2]
+        [--threads 8] [--mix trial=0.4,check=0.4,poll=0.2]
+        [--mock-latency-ms 50] [--mock-error-rate 0] [--output run.json]
+        [--compare baseline.json]
+
+Starts benchmarks/mock_ip2location.py in-process and gunicorn in a
+subprocess (STORAGE_DIR in a temporary directory, so nothing in the checkout
+is touched), then offers a fixed arrival rate of:
+
+  trial  GET /trial then, unless the IP was rejected, POST /trial with a
+         fresh tg_id - the Telegram Web App flow
+  check  GET /check-step1 for a known or unknown tg_id
+  poll   GET /api/get-verification, as the bot does for submitted tg_ids
+
+Arrivals are open-loop: latency is measured from when a request was due, not
+when a free client thread sent it, so an overloaded server shows up as
+latency instead of silently lowering the offered load. Writes one JSON
+report (throughput and p50/p95/p99 per endpoint) to stdout or --output;
+--compare prints the change against an earlier report to stderr.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import IO, Any, Dict, List, Optional
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_ip2location import MockIP2Location, parse_distribution  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COUNTRIES = ["Germany", "United States", "Brazil", "Albania", "Japan"]
+
+
+class Recorder:
+    """Latency samples (seconds) and failures, per endpoint."""
+
+    def __init__(self) -> None:
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.statuses: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, latency: float, status: Optional[int]) -> None:
+        with self._lock:
+            self.samples.setdefault(name, []).append(latency)
+            statuses = self.statuses.setdefault(name, {})
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if status is None or status >= 500:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return 0.0
+    index = max(int(round(q / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def summarize(samples: List[float], errors: int, statuses: Dict[str, int], elapsed: float) -> Dict[str, Any]:
+    values = sorted(samples)
+    return {
+        "count": len(values),
+        "errors": errors,
+        "statuses": statuses,
+        "throughput_rps": round(len(values) / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        "p50_ms": round(percentile(values, 50) * 1000, 3),
+        "p95_ms": round(percentile(values, 95) * 1000, 3),
+        "p99_ms": round(percentile(values, 99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3) if values else 0.0,
+    }
+
+
+class LoadGenerator:
+    def __init__(self, base_url: str, recorder: Recorder, ips: int, seed: int) -> None:
+        self.base_url = base_url
+        self.recorder = recorder
+        self.ips = ips
+        self._local = threading.local()
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._next_tg_id = 7_000_000_000
+        # tg_ids that completed step 1, for check / poll traffic
+        self.passed: List[int] = []
+        self._passed_lock = threading.Lock()
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _draw(self) -> float:
+        with self._random_lock:
+            return self._random.random()
+
+    def _request(self, name: str, method: str, path: str, due: float, **kwargs: Any) -> Optional[requests.Response]:
+        try:
+            response = self._session().request(method, self.base_url + path, timeout=30, **kwargs)
+        except requests.RequestException:
+            self.recorder.record(name, time.perf_counter() - due, None)
+            return None
+        self.recorder.record(name, time.perf_counter() - due, response.status_code)
+        return response
+
+    def _known_or_unknown_tg_id(self) -> int:
+        with self._passed_lock:
+            if self.passed and self._draw() < 0.8:
+                return self.passed[int(self._draw() * len(self.passed))]
+        return 9_000_000_000 + int(self._draw() * 1_000_000)
+
+    def trial(self, due: float) -> None:
+        n = int(self._draw() * self.ips)
+        ip = f"10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}"
+        headers = {"X-Forwarded-For": ip}
+        page = self._request("GET /trial", "GET", "/trial", due, headers=headers)
+        if page is None or page.status_code != 200 or 'id="trial-form"' not in page.text:
+            self.recorder.record("trial_flow", time.perf_counter() - due, page.status_code if page is not None else None)
+            return
+        with self._passed_lock:
+            tg_id = self._next_tg_id
+            self._next_tg_id += 1
+        form = {"tg_id": str(tg_id), "name": f"Load {tg_id}", "country": COUNTRIES[tg_id % len(COUNTRIES)]}
+        submitted = self._request("POST /trial", "POST", "/trial", time.perf_counter(), headers=headers, data=form)
+        self.recorder.record("trial_flow", time.perf_counter() - due, submitted.status_code if submitted is not None else None)
+        if submitted is not None and submitted.status_code == 200:
+            with self._passed_lock:
+                self.passed.append(tg_id)
+
+    def check(self, due: float) -> None:
+        self._request("GET /check-step1", "GET", f"/check-step1?tg_id={self._known_or_unknown_tg_id()}", due)
+
+    def poll(self, due: float) -> None:
+        self._request("GET /api/get-verification", "GET", f"/api/get-verification?tg_id={self._known_or_unknown_tg_id()}", due)
+
+
+def start_gunicorn(args: argparse.Namespace, mock_url: str, storage_dir: str, log_file: IO[bytes]) -> subprocess.Popen:
+    env = dict(os.environ)
+    # Multiprocess metrics need gunicorn.conf.py's directory setup; not measured here
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    env.update(
+        IP2LOCATION_API_URL=mock_url,
+        IP2LOCATION_API_KEY="load-test",
+        STORAGE_DIR=storage_dir,
+        BLOCKED_COUNTRY_CODE=args.blocked_country,
+        LOG_LEVEL=os.environ.get("LOG_LEVEL", "WARNING"),
+    )
+    command = [
+        sys.executable, "-m", "gunicorn", args.app,
+        "-b", f"127.0.0.1:{args.port}", "-w", str(args.workers), "--threads", str(args.threads),
+    ]
+    if args.app.startswith("async_app"):
+        command += ["--worker-class", "aiohttp.GunicornWebWorker"]
+    # Run from the checkout so gunicorn.conf.py is picked up like in production
+    return subprocess.Popen(command, cwd=ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+
+
+def wait_until_ready(base_url: str, server: subprocess.Popen, log_path: str, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            with open(log_path, encoding="utf-8", errors="replace") as f:
+                raise SystemExit(f"gunicorn exited:\n{f.read()}")
+        try:
+            if requests.get(base_url + "/", timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise SystemExit("gunicorn did not become ready in time")
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    mix = [(name.lower(), bound) for name, bound in parse_distribution(args.mix)]
+    unknown = {name for name, _ in mix} - {"trial", "check", "poll"}
+    if unknown:
+        raise SystemExit(f"Unknown scenarios in --mix: {', '.join(sorted(unknown))}")
+    mock = MockIP2Location(
+        ("127.0.0.1", args.mock_port), args.mock_latency_ms, args.mock_jitter_ms, args.mock_error_rate,
+        args.mock_proxy_rate, args.mock_countries, args.seed,
+    ).start()
+    storage_dir = tempfile.mkdtemp(prefix="load-test-")
+    base_url = f"http://127.0.0.1:{args.port}"
+    log_path = os.path.join(storage_dir, "gunicorn.log")
+    log_file = open(log_path, "wb")
+    server = start_gunicorn(args, mock.url, storage_dir, log_file)
+    try:
+        wait_until_ready(base_url, server, log_path)
+        recorder = Recorder()
+        generator = LoadGenerator(base_url, recorder, args.ips, args.seed)
+        scenarios = {"trial": generator.trial, "check": generator.check, "poll": generator.poll}
+        choose = random.Random(args.seed)
+        started = time.perf_counter()
+        arrivals = int(args.rps * args.duration)
+        with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="load") as pool:
+            for i in range(arrivals):
+                due = started + i / args.rps
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                draw = choose.random()
+                name = next((name for name, bound in mix if draw < bound), mix[-1][0])
+                pool.submit(scenarios[name], due)
+        elapsed = time.perf_counter() - started
+    finally:
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        mock.shutdown()
+        log_file.close()
+        shutil.rmtree(storage_dir, ignore_errors=True)
+
+    endpoints = {
+        name: summarize(samples, recorder.errors.get(name, 0), recorder.statuses[name], elapsed)
+        for name, samples in sorted(recorder.samples.items())
+    }
+    requests_sent = sum(summary["count"] for name, summary in endpoints.items() if name != "trial_flow")
+    return {
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "config": vars(args),
+        "elapsed_s": round(elapsed, 3),
+        "offered_rps": args.rps,
+        "requests": requests_sent,
+        "throughput_rps": round(requests_sent / elapsed, 2),
+        "errors": sum(summary["errors"] for name, summary in endpoints.items() if name != "trial_flow"),
+        "endpoints": endpoints,
+        "mock_ip2location": dict(mock.counts),
+    }
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any]) -> str:
+    lines = [f"{'endpoint':<28} {'metric':<15} {'baseline':>10} {'current':>10} {'change':>8}"]
+    for name, current in report["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(name)
+        if previous is None:
+            continue
+        for metric in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms"):
+            before, after = previous.get(metric, 0), current[metric]
+            change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+            lines.append(f"{name:<28} {metric:<15} {before:>10} {after:>10} {change:>8}")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--app", default="web_app:app", help="WSGI/ASGI target, e.g. async_app:app")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--rps", type=float, default=100, help="offered arrivals per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load")
+    parser.add_argument("--concurrency", type=int, default=64, help="client threads")
+    parser.add_argument("--mix", default="trial=0.4,check=0.4,poll=0.2", help="scenario=weight,...")
+    parser.add_argument("--ips", type=int, default=5000, help="distinct client IPs (fewer = more IP cache hits)")
+    parser.add_argument("--blocked-country", default="PK")
+    parser.add_argument("--mock-port", type=int, default=18777)
+    parser.add_argument("--mock-latency-ms", type=float, default=50)
+    parser.add_argument("--mock-jitter-ms", type=float, default=20)
+    parser.add_argument("--mock-error-rate", type=float, default=0)
+    parser.add_argument("--mock-proxy-rate", type=float, default=0.05)
+    parser.add_argument("--mock-countries", default="US=0.7,GB=0.1,PK=0.1,IN=0.1")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="earlier JSON report to compare against")
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print(compare(report, json.load(f)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
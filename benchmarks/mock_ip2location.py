@@ -0,0 +1,137 @@
+"""
+Local stand-in for the IP2Location.io API, for load tests.
+
+    python benchmarks/mock_ip2location.py [--port 18777] [--latency-ms 50]
+        [--jitter-ms 20] [--error-rate 0.01] [--proxy-rate 0.05]
+        [--countries US=0.7,GB=0.1,PK=0.1,IN=0.1]
+
+Point the app at it with IP2LOCATION_API_URL=http://127.0.0.1:18777/. Every
+answer is derived from the IP (and --seed), so repeated lookups of one IP
+agree the way the real API does, while latency and errors are drawn per
+request. benchmarks/load_test.py starts one in-process.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+
+def parse_distribution(spec: str) -> List[Tuple[str, float]]:
+    """Parse "US=0.7,PK=0.3" into cumulative bounds: [("US", 0.7), ("PK", 1.0)]."""
+    weights = []
+    for item in spec.split(","):
+        code, _, weight = item.partition("=")
+        if code.strip():
+            weights.append((code.strip().upper(), float(weight or "1")))
+    total = sum(weight for _, weight in weights)
+    if not weights or total <= 0:
+        raise ValueError(f"Invalid country distribution: {spec!r}")
+    cumulative, running = [], 0.0
+    for code, weight in weights:
+        running += weight / total
+        cumulative.append((code, running))
+    return cumulative
+
+
+class MockIP2Location(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 512
+
+    def __init__(
+        self,
+        address: Tuple[str, int],
+        latency_ms: float = 50,
+        jitter_ms: float = 0,
+        error_rate: float = 0,
+        proxy_rate: float = 0.05,
+        countries: str = "US=0.7,GB=0.1,PK=0.1,IN=0.1",
+        seed: int = 0,
+    ) -> None:
+        super().__init__(address, _Handler)
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.proxy_rate = proxy_rate
+        self.countries = parse_distribution(countries)
+        self.seed = seed
+        self.counts: Dict[str, int] = {"ok": 0, "error": 0}
+        self._counts_lock = threading.Lock()
+
+    def answer(self, ip: str) -> Dict[str, object]:
+        digest = hashlib.sha256(f"{self.seed}:{ip}".encode()).digest()
+        country_draw = int.from_bytes(digest[:4], "big") / 2**32
+        proxy_draw = int.from_bytes(digest[4:8], "big") / 2**32
+        country = next((code for code, bound in self.countries if country_draw < bound), self.countries[-1][0])
+        return {"ip": ip, "country_code": country, "is_proxy": proxy_draw < self.proxy_rate}
+
+    def count(self, outcome: str) -> None:
+        with self._counts_lock:
+            self.counts[outcome] += 1
+
+    def start(self) -> "MockIP2Location":
+        threading.Thread(target=self.serve_forever, name="mock-ip2location", daemon=True).start()
+        return self
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: MockIP2Location
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+
+    def do_GET(self) -> None:
+        server = self.server
+        time.sleep(max(server.latency + random.uniform(-server.jitter, server.jitter), 0))
+        if random.random() < server.error_rate:
+            server.count("error")
+            self._send(500, {"error": {"error_code": 10000, "error_message": "Mock failure"}})
+            return
+        ip = (parse_qs(urlparse(self.path).query).get("ip") or [""])[0]
+        server.count("ok")
+        self._send(200, server.answer(ip))
+
+    def _send(self, status: int, payload: Dict[str, object]) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 18777)))
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=0, help="latency varies uniformly by +/- this much")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of requests answered with HTTP 500")
+    parser.add_argument("--proxy-rate", type=float, default=0.05, help="share of IPs reported as proxies")
+    parser.add_argument("--countries", default="US=0.7,GB=0.1,PK=0.1,IN=0.1", help="country_code=weight,...")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = MockIP2Location(
+        (args.host, args.port), args.latency_ms, args.jitter_ms, args.error_rate, args.proxy_rate, args.countries, args.seed
+    )
+    print(f"Mock IP2Location listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
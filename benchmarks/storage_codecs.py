@@ -0,0 +1,120 @@
+"""
+Size / speed of the pending verification file formats in storage.py.
+
+    python benchmarks/storage_codecs.py [--records 100000] [--json]
+
+Compares the original format (dict of dicts, json indent=2) with every
+STORAGE_CODEC available in this environment, including the cost of turning
+the decoded document back into PendingRecord objects, and the in-memory size
+of a parsed file as plain dicts vs. PendingRecord slots.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+
+
+def make_records(count: int) -> Dict[str, Dict[str, Any]]:
+    return {
+        str(5_000_000_000 + i): {
+            "name": f"User {i}",
+            "country": "Germany",
+            "email": f"user{i}@example.com" if i % 3 else "",
+            "ip": f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}",
+            "marketing_opt_in": i % 2 == 0,
+            "step1_ok": True,
+            "status": "step1_passed",
+            "created_at": "2026-10-18T12:00:00.000000+00:00",
+        }
+        for i in range(count)
+    }
+
+
+def best_of(fn: Callable[[], Any], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def traced_size(build: Callable[[], Any]) -> int:
+    tracemalloc.start()
+    obj = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del obj
+    return size
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    plain = make_records(args.records)
+    records = {key: storage.PendingRecord.from_dict(info) for key, info in plain.items()}
+    results: List[Dict[str, Any]] = []
+
+    baseline = json.dumps(plain, indent=2, ensure_ascii=False).encode("utf-8")
+    results.append(
+        {
+            "format": "original (json indent=2, stdlib)",
+            "bytes": len(baseline),
+            "encode_s": best_of(lambda: json.dumps(plain, indent=2, ensure_ascii=False).encode("utf-8"), args.repeat),
+            "decode_s": best_of(lambda: json.loads(baseline.decode("utf-8")), args.repeat),
+        }
+    )
+
+    codecs = ["json", "json-compact"] + (["msgpack"] if storage.msgpack is not None else [])
+    for codec in codecs:
+        payload = storage._encode(storage._records_to_document(records, codec), codec)
+        # What the file cache holds after reading a file in this codec
+        cached = storage._document_to_records(storage._decode(payload))
+        label = codec + (" (orjson)" if codec == "json-compact" and storage.orjson is not None else "")
+        results.append(
+            {
+                "format": f"STORAGE_CODEC={label}",
+                "bytes": len(payload),
+                "encode_s": best_of(
+                    lambda: storage._encode(storage._records_to_document(cached, codec), codec), args.repeat
+                ),
+                "decode_s": best_of(lambda: storage._document_to_records(storage._decode(payload)), args.repeat),
+            }
+        )
+
+    memory = {
+        "dicts": traced_size(lambda: make_records(args.records)),
+        "pending_records": traced_size(
+            lambda: {k: storage.PendingRecord.from_dict(v) for k, v in make_records(args.records).items()}
+        ),
+    }
+
+    if args.json:
+        print(json.dumps({"records": args.records, "formats": results, "memory_bytes": memory}, indent=2))
+        return
+
+    base = results[0]
+    print(f"{args.records} records (best of {args.repeat})")
+    print(f"{'format':44} {'size':>12} {'encode':>10} {'decode':>10}")
+    for row in results:
+        print(
+            f"{row['format']:44} {row['bytes'] / 1e6:>9.2f} MB {row['encode_s'] * 1000:>8.0f}ms {row['decode_s'] * 1000:>8.0f}ms"
+            f"   ({row['bytes'] / base['bytes']:.0%} size, {base['encode_s'] / row['encode_s']:.1f}x enc,"
+            f" {base['decode_s'] / row['decode_s']:.1f}x dec)"
+        )
+    print(f"in memory: dicts {memory['dicts'] / 1e6:.1f} MB, PendingRecord {memory['pending_records'] / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
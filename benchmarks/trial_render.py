@@ -0,0 +1,73 @@
+"""
+Per-request render cost of the /trial page.
+
+    python benchmarks/trial_render.py [--iterations 2000] [--json]
+
+Compares the original render_template_string(TRIAL_PAGE, ...) call, which
+compiles the template source on every request, with rendering the template
+compiled once, and with web_app._render(), which only escapes the message
+into the pre-rendered page. All three produce identical HTML.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Any, Callable, Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import render_template_string  # noqa: E402
+
+import web_app  # noqa: E402
+
+MESSAGE = "Please fill in your details to start your free trial <for real> & more."
+
+
+def per_call(fn: Callable[[], Any], iterations: int, repeat: int = 5) -> float:
+    """Best average seconds per call over `repeat` runs of `iterations` calls."""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        best = min(best, (time.perf_counter() - started) / iterations)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    template = web_app.app.jinja_env.from_string(web_app.TRIAL_PAGE)
+    variants: Dict[str, Callable[[], str]] = {
+        "render_template_string": lambda: render_template_string(
+            web_app.TRIAL_PAGE, message=MESSAGE, show_form=True, already_passed=False, asset_url=web_app.asset_url
+        ),
+        "compiled_once": lambda: template.render(message=MESSAGE, show_form=True, already_passed=False, asset_url=web_app.asset_url),
+        "pre_rendered": lambda: web_app._render(MESSAGE, show_form=True),
+    }
+
+    results = []
+    with web_app.app.test_request_context("/trial"):
+        expected = variants["render_template_string"]()
+        for name, fn in variants.items():
+            if fn() != expected:
+                raise SystemExit(f"{name} renders different HTML")
+            iterations = args.iterations if name != "render_template_string" else max(args.iterations // 10, 1)
+            results.append({"variant": name, "us_per_render": per_call(fn, iterations) * 1e6, "bytes": len(expected)})
+
+    baseline = results[0]["us_per_render"]
+    for result in results:
+        result["speedup"] = baseline / result["us_per_render"]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        print(f"{result['variant']:<24} {result['us_per_render']:>10.1f} us/render  {result['speedup']:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+
+from storage import BASE_DIR, STORAGE_DURABILITY, file_lock
+from tracing import traced
+
+try:
+    import fcntl
+except ImportError:  # Windows: every process runs its own webhook dispatcher
+    fcntl = None  # type: ignore[assignment]
+
+log = logging.getLogger(__name__)
+
+
+# Append-only change feed of step-1 completions, followed by the bot through
+# /api/events (long-poll), /api/events/stream (SSE) or BOT_WEBHOOK_URL. Stored
+# as segments "<EVENTS_DIR>/events-<first byte offset>.jsonl"; a cursor is a
+# byte offset into the whole feed, so it stays valid across segment rotation.
+EVENTS_DIR = os.environ.get("EVENTS_DIR", os.path.join(BASE_DIR, "events"))
+# Start a new segment once the current one reaches this size
+EVENTS_SEGMENT_BYTES = int(os.environ.get("EVENTS_SEGMENT_BYTES", str(8 * 1024 * 1024)))
+# Older segments beyond this count are deleted; readers behind them get reset=True
+EVENTS_KEEP_SEGMENTS = max(1, int(os.environ.get("EVENTS_KEEP_SEGMENTS", "4")))
+# Waiting readers are woken at once by writes in their own process; writes by
+# other worker processes are noticed within this many seconds
+EVENTS_POLL_INTERVAL = float(os.environ.get("EVENTS_POLL_INTERVAL", "0.1"))
+
+# Optional push delivery: batches of events are POSTed as
+# {"events": [...], "cursor": N} to this URL, retried with exponential backoff
+# until the bot answers 2xx (at-least-once; the bot should ignore duplicates).
+# One worker per host delivers; its position survives restarts.
+BOT_WEBHOOK_URL = os.environ.get("BOT_WEBHOOK_URL", "")
+# Sent as the X-Webhook-Secret header so the bot can reject forged calls
+BOT_WEBHOOK_SECRET = os.environ.get("BOT_WEBHOOK_SECRET", "")
+BOT_WEBHOOK_BATCH_SIZE = int(os.environ.get("BOT_WEBHOOK_BATCH_SIZE", "100"))
+# How long to wait for more events to fill a batch once the first one arrived
+BOT_WEBHOOK_BATCH_WAIT_MS = float(os.environ.get("BOT_WEBHOOK_BATCH_WAIT_MS", "20"))
+BOT_WEBHOOK_TIMEOUT = float(os.environ.get("BOT_WEBHOOK_TIMEOUT", "5"))
+BOT_WEBHOOK_MAX_BACKOFF = float(os.environ.get("BOT_WEBHOOK_MAX_BACKOFF", "60"))
+
+_SEGMENT_PREFIX = "events-"
+_SEGMENT_SUFFIX = ".jsonl"
+# Serialises appends from the threads of this process (other processes are
+# excluded by file_lock); _new_event wakes readers waiting in this process.
+_write_lock = threading.Lock()
+_new_event = threading.Condition()
+_dispatcher_thread: Optional[threading.Thread] = None
+_dispatcher_stats: Dict[str, Any] = {"leader": False, "delivered": 0, "batches": 0, "failures": 0, "cursor": None}
+
+
+def _segments() -> List[Tuple[int, str]]:
+    """(first offset, path) of every segment, oldest first."""
+    try:
+        names = os.listdir(EVENTS_DIR)
+    except FileNotFoundError:
+        return []
+    segments = []
+    for name in names:
+        base = name[len(_SEGMENT_PREFIX):-len(_SEGMENT_SUFFIX)]
+        if name.startswith(_SEGMENT_PREFIX) and name.endswith(_SEGMENT_SUFFIX) and base.isdigit():
+            segments.append((int(base), os.path.join(EVENTS_DIR, name)))
+    segments.sort()
+    return segments
+
+
+def _segment_path(base: int) -> str:
+    return os.path.join(EVENTS_DIR, f"{_SEGMENT_PREFIX}{base:020d}{_SEGMENT_SUFFIX}")
+
+
+def _size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+@traced("events.publish")
+def publish(event_type: str, tg_id: int) -> Optional[int]:
+    """
+    Append an event to the feed and wake waiting readers. Events carry only
+    the type and tg_id; the bot fetches the record itself through the
+    authenticated /api/get-verifications, so the feed holds no personal data.
+    Returns the cursor just past the event, or None if it couldn't be written
+    (the caller's request should not fail because of the feed; the bot can
+    still resync through /api/get-verifications).
+    """
+    event = {
+        "type": event_type,
+        "tg_id": tg_id,
+        "at": datetime.now(timezone.utc).isoformat(),
+    }
+    line = (json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+    try:
+        os.makedirs(EVENTS_DIR, exist_ok=True)
+        with _write_lock, file_lock(os.path.join(EVENTS_DIR, "events")):
+            segments = _segments()
+            base, path = segments[-1] if segments else (0, _segment_path(0))
+            size = _size(path)
+            if size >= EVENTS_SEGMENT_BYTES:
+                base, path = base + size, _segment_path(base + size)
+                for _, old_path in segments[: max(len(segments) + 1 - EVENTS_KEEP_SEGMENTS, 0)]:
+                    os.remove(old_path)
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+                if STORAGE_DURABILITY == "fsync":
+                    os.fsync(fd)
+                cursor = base + os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+    except Exception:
+        log.exception("Failed to publish event", extra={"event_type": event_type, "tg_id": tg_id})
+        return None
+    with _new_event:
+        _new_event.notify_all()
+    return cursor
+
+
+def read_events(cursor: Optional[int], limit: int = 100) -> Tuple[List[Dict[str, Any]], int, bool]:
+    """
+    Read up to `limit` events after `cursor` without waiting.
+    Returns (events, next_cursor, reset). Each event carries its own "cursor"
+    (the position just past it). A cursor of None means "from now on" and
+    returns no events. reset is True when the cursor pointed at data that has
+    been deleted (or a different feed); reading then restarts at the oldest
+    event still kept.
+    """
+    segments = _segments()
+    if not segments:
+        return [], 0 if cursor is None else cursor, False
+    end = segments[-1][0] + _size(segments[-1][1])
+    if cursor is None:
+        return [], end, False
+    reset = False
+    if cursor < segments[0][0] or cursor > end:
+        cursor, reset = segments[0][0], True
+
+    events: List[Dict[str, Any]] = []
+    for i, (base, path) in enumerate(segments):
+        next_base = segments[i + 1][0] if i + 1 < len(segments) else None
+        if next_base is not None and cursor >= next_base:
+            continue
+        if cursor < base:
+            cursor, reset = base, True  # the data before this segment is gone
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            # Deleted by a rotation since we listed it: skip the lost events
+            if next_base is None:
+                break
+            cursor, reset = max(cursor, next_base), True
+            continue
+        with f:
+            f.seek(cursor - base)
+            while len(events) < limit:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    break  # end of segment, or a write still in progress
+                cursor += len(line)
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                event["cursor"] = cursor
+                events.append(event)
+        if len(events) >= limit or next_base is None:
+            break
+        cursor = next_base
+    return events, cursor, reset
+
+
+def wait_for_events(
+    cursor: Optional[int], timeout: float, limit: int = 100
+) -> Tuple[List[Dict[str, Any]], int, bool]:
+    """Like read_events(), but waits up to `timeout` seconds for the first event."""
+    if cursor is None:
+        cursor = read_events(None)[1]
+    deadline = time.monotonic() + timeout
+    while True:
+        events, next_cursor, reset = read_events(cursor, limit)
+        remaining = deadline - time.monotonic()
+        if events or reset or remaining <= 0:
+            return events, next_cursor, reset
+        with _new_event:
+            _new_event.wait(min(EVENTS_POLL_INTERVAL, remaining))
+
+
+def _try_lock(path: str) -> Optional[int]:
+    """Non-blocking exclusive flock on `path`; returns the fd holding it, or None."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    if fcntl is None:
+        return fd
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _load_webhook_cursor(path: str) -> Optional[int]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return int(json.load(f)["cursor"])
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _save_webhook_cursor(path: str, cursor: int) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"cursor": cursor}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _deliver(session: requests.Session, events: List[Dict[str, Any]], cursor: int) -> None:
+    """POST one batch, retrying with exponential backoff until the bot accepts it."""
+    headers = {"X-Webhook-Secret": BOT_WEBHOOK_SECRET} if BOT_WEBHOOK_SECRET else {}
+    attempt = 0
+    while True:
+        try:
+            resp = session.post(
+                BOT_WEBHOOK_URL,
+                json={"events": events, "cursor": cursor},
+                headers=headers,
+                timeout=BOT_WEBHOOK_TIMEOUT,
+            )
+            if resp.ok:
+                return
+            error = f"HTTP {resp.status_code}"
+        except requests.RequestException as e:
+            error = str(e)
+        attempt += 1
+        _dispatcher_stats["failures"] += 1
+        delay = min(BOT_WEBHOOK_MAX_BACKOFF, 0.5 * 2 ** min(attempt, 16)) * random.uniform(0.5, 1)
+        log.warning("Bot webhook delivery failed", extra={"error": error, "attempt": attempt, "retry_in": round(delay, 1)})
+        time.sleep(delay)
+
+
+def _dispatch_loop() -> None:
+    os.makedirs(EVENTS_DIR, exist_ok=True)
+    lock_fd = None
+    while lock_fd is None:
+        # Only one worker per host delivers; the others stand by in case it dies
+        lock_fd = _try_lock(os.path.join(EVENTS_DIR, "webhook.lock"))
+        if lock_fd is None:
+            time.sleep(5)
+    _dispatcher_stats["leader"] = True
+    cursor_path = os.path.join(EVENTS_DIR, "webhook.cursor")
+    cursor = _load_webhook_cursor(cursor_path)
+    if cursor is None:
+        # First start: only push what happens from now on
+        cursor = read_events(None)[1]
+        _save_webhook_cursor(cursor_path, cursor)
+    _dispatcher_stats["cursor"] = cursor
+    session = requests.Session()
+    while True:
+        try:
+            events, next_cursor, reset = wait_for_events(cursor, timeout=30, limit=BOT_WEBHOOK_BATCH_SIZE)
+            if reset:
+                log.warning("Bot webhook fell behind the retained events", extra={"skipped_to": next_cursor})
+            if events and len(events) < BOT_WEBHOOK_BATCH_SIZE and BOT_WEBHOOK_BATCH_WAIT_MS > 0:
+                # Give a burst a moment to fill the batch before sending
+                time.sleep(BOT_WEBHOOK_BATCH_WAIT_MS / 1000)
+                more, next_cursor, _ = read_events(next_cursor, BOT_WEBHOOK_BATCH_SIZE - len(events))
+                events += more
+            if events:
+                _deliver(session, events, next_cursor)
+                _dispatcher_stats["delivered"] += len(events)
+                _dispatcher_stats["batches"] += 1
+            if next_cursor != cursor:
+                cursor = next_cursor
+                _save_webhook_cursor(cursor_path, cursor)
+                _dispatcher_stats["cursor"] = cursor
+        except Exception:
+            log.exception("Bot webhook dispatcher error")
+            time.sleep(1)
+
+
+def start_webhook_dispatcher() -> bool:
+    """
+    Start the webhook delivery thread in this process (once). Does nothing
+    unless BOT_WEBHOOK_URL is set. Returns whether the thread is running.
+    """
+    global _dispatcher_thread
+    if not BOT_WEBHOOK_URL:
+        return False
+    if _dispatcher_thread is None or not _dispatcher_thread.is_alive():
+        _dispatcher_thread = threading.Thread(target=_dispatch_loop, name="bot-webhook", daemon=True)
+        _dispatcher_thread.start()
+    return True
+
+
+def feed_stats() -> Dict[str, Any]:
+    segments = _segments()
+    return {
+        "segments": len(segments),
+        "oldest_cursor": segments[0][0] if segments else 0,
+        "cursor": segments[-1][0] + _size(segments[-1][1]) if segments else 0,
+        "webhook": dict(_dispatcher_stats) if BOT_WEBHOOK_URL else None,
+    }
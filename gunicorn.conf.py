@@ -0,0 +1,28 @@
+# Loaded automatically by gunicorn from the working directory; the bind address,
+# worker class and thread count are still given on the command line.
+import os
+import shutil
+
+
+def on_starting(server):
+    # Start every deploy with empty multiprocess metrics (see metrics.py)
+    directory = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+
+def post_worker_init(worker):
+    # `pkill -USR2 -P <master pid>` profiles every worker (see profiler.py)
+    from profiler import install_signal_handler
+
+    install_signal_handler()
+
+
+def child_exit(server, worker):
+    # A dead worker's counters and histograms stay in the totals; only its
+    # live gauges are dropped
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,352 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple, Union
+
+
+# How long a successful IP2Location answer is reused (seconds)
+IP_CACHE_TTL = float(os.environ.get("IP_CACHE_TTL", "3600"))
+# Failed lookups (errors, timeouts) are cached briefly so an API outage
+# doesn't make every request wait for the full timeout again
+IP_CACHE_NEGATIVE_TTL = float(os.environ.get("IP_CACHE_NEGATIVE_TTL", "30"))
+IP_CACHE_MAX_ENTRIES = int(os.environ.get("IP_CACHE_MAX_ENTRIES", "10000"))
+# "memory" (per process) or "sqlite" (shared by every worker on the host)
+IP_CACHE_BACKEND = os.environ.get("IP_CACHE_BACKEND", "memory").lower()
+# Put this on a persistent volume to keep warm verdicts across deploys
+IP_CACHE_PATH = os.environ.get(
+    "IP_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "ip_cache.sqlite3"),
+)
+IP_CACHE_SHARED_MAX_ENTRIES = int(os.environ.get("IP_CACHE_SHARED_MAX_ENTRIES", "200000"))
+
+# Returned by get() when the key is absent or expired. A cached failed
+# lookup is stored as None, so None can't be used to signal a miss.
+MISS = object()
+
+
+class TTLCache:
+    """
+    Thread-safe in-process cache with per-entry expiry and LRU eviction.
+    Values of None are treated as negative results and use `negative_ttl`.
+    """
+
+    def __init__(self, ttl: float, negative_ttl: float, max_entries: int) -> None:
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISS
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return MISS
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """Store `value` for `ttl` seconds (default: the cache's TTL for this kind of value)."""
+        if ttl is None:
+            ttl = self.negative_ttl if value is None else self.ttl
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "backend": "memory",
+                "size": len(self._data),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class SQLiteTTLCache:
+    """
+    Host-wide cache shared by all gunicorn workers through an SQLite database
+    in WAL mode. Entries expire by wall-clock time, so they survive restarts.
+    The size limit is enforced every `prune_every` writes by dropping expired
+    rows first and then the entries closest to expiry.
+    Any SQLite error is treated as a miss - the cache must never break /trial.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float,
+        negative_ttl: float,
+        max_entries: int,
+        prune_every: int = 500,
+    ) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.prune_every = prune_every
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ip_cache ("
+                " key TEXT PRIMARY KEY,"
+                " expires_at REAL NOT NULL,"
+                " value TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ip_cache_expires ON ip_cache (expires_at)")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: Hashable) -> Any:
+        return self.get_entry(key)[0]
+
+    def get_entry(self, key: Hashable) -> Tuple[Any, float]:
+        """(value, seconds until it expires), or (MISS, 0)."""
+        now = time.time()
+        try:
+            row = self._conn().execute(
+                "SELECT value, expires_at FROM ip_cache WHERE key = ? AND expires_at > ?",
+                (str(key), now),
+            ).fetchone()
+        except sqlite3.Error:
+            with self._lock:
+                self.errors += 1
+                self.misses += 1
+            return MISS, 0
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return MISS, 0
+            self.hits += 1
+        return json.loads(row[0]), row[1] - now
+
+    def set(self, key: Hashable, value: Any) -> None:
+        ttl = self.negative_ttl if value is None else self.ttl
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        try:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO ip_cache (key, expires_at, value) VALUES (?, ?, ?)",
+                (str(key), time.time() + ttl, json.dumps(value)),
+            )
+        except sqlite3.Error:
+            with self._lock:
+                self.errors += 1
+            return
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % self.prune_every == 0
+        if prune:
+            self.prune()
+
+    def prune(self) -> None:
+        try:
+            conn = self._conn()
+            removed = conn.execute("DELETE FROM ip_cache WHERE expires_at <= ?", (time.time(),)).rowcount
+            (size,) = conn.execute("SELECT COUNT(*) FROM ip_cache").fetchone()
+            if size > self.max_entries:
+                removed += conn.execute(
+                    "DELETE FROM ip_cache WHERE key IN ("
+                    " SELECT key FROM ip_cache ORDER BY expires_at LIMIT ?)",
+                    (size - self.max_entries,),
+                ).rowcount
+        except sqlite3.Error:
+            with self._lock:
+                self.errors += 1
+            return
+        with self._lock:
+            self.evictions += removed
+
+    def clear(self) -> None:
+        try:
+            self._conn().execute("DELETE FROM ip_cache")
+        except sqlite3.Error:
+            with self._lock:
+                self.errors += 1
+
+    def stats(self) -> Dict[str, Any]:
+        try:
+            (size,) = self._conn().execute("SELECT COUNT(*) FROM ip_cache").fetchone()
+        except sqlite3.Error:
+            size = None
+        with self._lock:
+            return {
+                "backend": "sqlite",
+                "path": self.path,
+                "size": size,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "errors": self.errors,
+            }
+
+
+class TieredCache:
+    """
+    A small per-process cache in front of a shared one: hits in `local` cost a
+    dict lookup, misses fall through to `shared` and are copied back locally
+    until the shared entry's own expiry, so no copy outlives it.
+    """
+
+    def __init__(self, local: TTLCache, shared: SQLiteTTLCache) -> None:
+        self.local = local
+        self.shared = shared
+
+    def get(self, key: Hashable) -> Any:
+        value = self.local.get(key)
+        if value is MISS:
+            value, remaining = self.shared.get_entry(key)
+            if value is not MISS:
+                self.local.set(key, value, ttl=remaining)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self.local.set(key, value)
+        self.shared.set(key, value)
+
+    def clear(self) -> None:
+        self.local.clear()
+        self.shared.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "tiered", "local": self.local.stats(), "shared": self.shared.stats()}
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into one: the first caller runs
+    `fn`, everyone who arrives while it is in flight waits and gets the same
+    result (or exception). Works across threads of one process, i.e. under
+    gthread / gevent workers; separate sync workers share results through the
+    cache instead.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._calls)}
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines on one event loop: concurrent `do()` calls for
+    the same key await the first caller's task instead of starting their own.
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[Hashable, "asyncio.Future[Any]"] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        if call is not None:
+            self.coalesced += 1
+            # shield: a cancelled waiter must not cancel the shared call
+            return await asyncio.shield(call)
+        call = self._calls[key] = asyncio.ensure_future(fn())
+        self.calls += 1
+        try:
+            return await asyncio.shield(call)
+        finally:
+            if call.done():
+                del self._calls[key]
+            else:
+                # The leader was cancelled; let the call finish for the waiters
+                call.add_done_callback(lambda _: self._calls.pop(key, None))
+
+    def stats(self) -> Dict[str, Any]:
+        return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._calls)}
+
+
+def make_ip_cache() -> Union[TTLCache, TieredCache]:
+    """Build the IP lookup cache from the IP_CACHE_* environment variables."""
+    local = TTLCache(IP_CACHE_TTL, IP_CACHE_NEGATIVE_TTL, IP_CACHE_MAX_ENTRIES)
+    if IP_CACHE_BACKEND == "sqlite":
+        shared = SQLiteTTLCache(IP_CACHE_PATH, IP_CACHE_TTL, IP_CACHE_NEGATIVE_TTL, IP_CACHE_SHARED_MAX_ENTRIES)
+        return TieredCache(local, shared)
+    return local
@@ -0,0 +1,389 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import IP_LOOKUP_LATENCY
+
+log = logging.getLogger(__name__)
+
+
+IP2LOCATION_API_URL = os.environ.get("IP2LOCATION_API_URL", "https://api.ip2location.io/")
+# Keep-alive connections per worker process
+IP2LOCATION_POOL_SIZE = int(os.environ.get("IP2LOCATION_POOL_SIZE", "10"))
+# Connection limit of the asyncio client (async_app.py), which keeps far more
+# lookups in flight per process than a thread pool does
+IP2LOCATION_ASYNC_POOL_SIZE = int(os.environ.get("IP2LOCATION_ASYNC_POOL_SIZE", "200"))
+IP2LOCATION_CONNECT_TIMEOUT = float(os.environ.get("IP2LOCATION_CONNECT_TIMEOUT", "1"))
+IP2LOCATION_READ_TIMEOUT = float(os.environ.get("IP2LOCATION_READ_TIMEOUT", "2"))
+# HTTP/2 needs the optional `httpx[http2]` package; falls back to requests otherwise
+IP2LOCATION_HTTP2 = os.environ.get("IP2LOCATION_HTTP2", "0") == "1"
+# Adaptive read timeout: p99 of recent successful calls x factor, clamped to
+# [IP2LOCATION_MIN_READ_TIMEOUT, IP2LOCATION_READ_TIMEOUT]
+IP2LOCATION_MIN_READ_TIMEOUT = float(os.environ.get("IP2LOCATION_MIN_READ_TIMEOUT", "0.3"))
+IP2LOCATION_TIMEOUT_FACTOR = float(os.environ.get("IP2LOCATION_TIMEOUT_FACTOR", "2"))
+
+# Circuit breaker: trips when, over the last IP_BREAKER_WINDOW calls (at least
+# IP_BREAKER_MIN_CALLS), the failure rate or the share of calls slower than
+# IP_BREAKER_SLOW_CALL_SECONDS reaches its threshold. While open, lookups fail
+# open immediately; after IP_BREAKER_OPEN_SECONDS one probe call is let through.
+IP_BREAKER_WINDOW = int(os.environ.get("IP_BREAKER_WINDOW", "50"))
+IP_BREAKER_MIN_CALLS = int(os.environ.get("IP_BREAKER_MIN_CALLS", "10"))
+IP_BREAKER_FAILURE_RATE = float(os.environ.get("IP_BREAKER_FAILURE_RATE", "0.5"))
+IP_BREAKER_SLOW_CALL_SECONDS = float(os.environ.get("IP_BREAKER_SLOW_CALL_SECONDS", "1.5"))
+IP_BREAKER_SLOW_CALL_RATE = float(os.environ.get("IP_BREAKER_SLOW_CALL_RATE", "0.8"))
+IP_BREAKER_OPEN_SECONDS = float(os.environ.get("IP_BREAKER_OPEN_SECONDS", "30"))
+
+
+class CircuitBreaker:
+    """
+    Closed -> open -> half-open breaker over a sliding window of recent calls.
+    Thread-safe; one instance per worker process.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        window: int = IP_BREAKER_WINDOW,
+        min_calls: int = IP_BREAKER_MIN_CALLS,
+        failure_rate: float = IP_BREAKER_FAILURE_RATE,
+        slow_call_seconds: float = IP_BREAKER_SLOW_CALL_SECONDS,
+        slow_call_rate: float = IP_BREAKER_SLOW_CALL_RATE,
+        open_seconds: float = IP_BREAKER_OPEN_SECONDS,
+        on_trip: Optional[Callable[[], None]] = None,
+    ) -> None:
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.on_trip = on_trip
+        self._calls: Deque[Tuple[bool, float]] = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.opens = 0
+        self.short_circuits = 0
+
+    def allow(self) -> bool:
+        """Whether a call may go upstream now. Every allowed call must be followed by record()."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.short_circuits += 1
+            return False
+
+    def record(self, ok: bool, latency: float) -> None:
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probe_in_flight = False
+                if ok and latency < self.slow_call_seconds:
+                    self.state = self.CLOSED
+                    self._calls.clear()
+                else:
+                    self._trip()
+                return
+            if self.state == self.OPEN:
+                return  # a call that started before the breaker tripped
+            self._calls.append((ok, latency))
+            total = len(self._calls)
+            if total < self.min_calls:
+                return
+            failures = sum(1 for call_ok, _ in self._calls if not call_ok)
+            slow = sum(1 for _, call_latency in self._calls if call_latency >= self.slow_call_seconds)
+            if failures / total >= self.failure_rate or slow / total >= self.slow_call_rate:
+                self._trip()
+
+    def _trip(self) -> None:
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._calls.clear()
+        self.opens += 1
+        if self.on_trip is not None:
+            self.on_trip()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"state": self.state, "opens": self.opens, "short_circuits": self.short_circuits}
+
+
+class AdaptiveTimeout:
+    """Read timeout derived from the latency percentile of recent successful calls."""
+
+    def __init__(
+        self,
+        minimum: float = IP2LOCATION_MIN_READ_TIMEOUT,
+        maximum: float = IP2LOCATION_READ_TIMEOUT,
+        factor: float = IP2LOCATION_TIMEOUT_FACTOR,
+        percentile: float = 0.99,
+        samples: int = 200,
+        min_samples: int = 20,
+    ) -> None:
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._latencies: Deque[float] = deque(maxlen=samples)
+        self._lock = threading.Lock()
+
+    def observe(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+
+    def reset(self) -> None:
+        """Forget old latencies, e.g. once upstream behaviour has clearly changed."""
+        with self._lock:
+            self._latencies.clear()
+
+    def current(self) -> float:
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return self.maximum
+            ordered: List[float] = sorted(self._latencies)
+        p = ordered[min(int(len(ordered) * self.percentile), len(ordered) - 1)]
+        return min(max(p * self.factor, self.minimum), self.maximum)
+
+
+class IP2LocationClient:
+    """
+    HTTP client for IP2Location.io that keeps a persistent connection pool per
+    worker process, so repeated lookups reuse the TCP + TLS connection instead
+    of handshaking on every call.
+    """
+
+    def __init__(
+        self,
+        api_key: str = "",
+        base_url: str = IP2LOCATION_API_URL,
+        pool_size: int = IP2LOCATION_POOL_SIZE,
+        connect_timeout: float = IP2LOCATION_CONNECT_TIMEOUT,
+        read_timeout: float = IP2LOCATION_READ_TIMEOUT,
+        http2: bool = IP2LOCATION_HTTP2,
+    ) -> None:
+        self.api_key = api_key
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.http2 = http2
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._session: Any = None
+        # (aiohttp.ClientSession, event loop) used by lookup_async()
+        self._async_session: Tuple[Any, Any] = (None, None)
+        self.timeout = AdaptiveTimeout(maximum=read_timeout)
+        # Latencies from before an outage say nothing about the upstream that
+        # comes back; start over at the maximum timeout
+        self.breaker = CircuitBreaker(on_trip=self.timeout.reset)
+        self.requests = 0
+        self.errors = 0
+        self.outcomes: Dict[str, int] = {"ok": 0, "error": 0, "timeout": 0, "short_circuit": 0}
+
+    def _get_session(self) -> Any:
+        # Sessions (and their sockets) must not be shared across fork(), so
+        # build one lazily in each gunicorn worker.
+        pid = os.getpid()
+        if self._session is not None and self._pid == pid:
+            return self._session
+        with self._lock:
+            if self._session is None or self._pid != pid:
+                self._session = self._build_session()
+                self._pid = pid
+            return self._session
+
+    def _build_session(self) -> Any:
+        if self.http2:
+            try:
+                import httpx
+
+                return httpx.Client(
+                    http2=True,
+                    limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+                    timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                )
+            except ImportError:
+                log.warning("IP2LOCATION_HTTP2=1 but httpx[http2] is not installed; using HTTP/1.1")
+                self.http2 = False
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def _params(self, ip: str) -> Dict[str, str]:
+        params = {"ip": ip, "format": "json"}
+        # If you configured a key, send it; otherwise keyless (limited) mode.
+        if self.api_key:
+            params["key"] = self.api_key
+        return params
+
+    def _start(self) -> Optional[float]:
+        """
+        Admit a call through the breaker and return its read timeout; None
+        means fail open right away.
+        """
+        if not self.breaker.allow():
+            # Upstream is known to be failing; fail open right away instead of
+            # tying up the worker until the timeout.
+            self._count("short_circuit")
+            IP_LOOKUP_LATENCY.labels("short_circuit").observe(0.0)
+            return None
+        with self._lock:
+            self.requests += 1
+        if self.breaker.state == CircuitBreaker.HALF_OPEN:
+            # A probe must be able to succeed against a slower upstream
+            return self.timeout.maximum
+        return self.timeout.current()
+
+    def _finish(self, data: Any, healthy: bool, outcome: str, started: float, read_timeout: float) -> Optional[dict]:
+        # If API returned an error object, treat as no data
+        if isinstance(data, dict) and "error" in data:
+            data = None
+        latency = time.monotonic() - started
+        self.breaker.record(healthy, latency)
+        if data is not None:
+            outcome = "ok"
+            self.timeout.observe(latency)
+        elif outcome == "timeout":
+            # The call took at least this long; without it the timeout could
+            # never grow past a latency shift it is cutting off
+            self.timeout.observe(read_timeout)
+        self._count(outcome)
+        IP_LOOKUP_LATENCY.labels(outcome).observe(latency)
+        return data
+
+    def lookup(self, ip: str) -> Optional[dict]:
+        """
+        Fetch geolocation and proxy info for `ip`.
+        Returns None on any failure (non-2xx, API error object, timeout, ...).
+        """
+        read_timeout = self._start()
+        if read_timeout is None:
+            return None
+        params = self._params(ip)
+        started = time.monotonic()
+        data = None
+        healthy = False
+        outcome = "error"
+        try:
+            session = self._get_session()
+            if self.http2:
+                import httpx
+
+                resp = session.get(self.base_url, params=params, timeout=httpx.Timeout(read_timeout, connect=self.connect_timeout))
+                ok = resp.is_success
+            else:
+                resp = session.get(self.base_url, params=params, timeout=(self.connect_timeout, read_timeout))
+                ok = resp.ok
+            # 4xx other than rate limiting means our request was bad, not that
+            # the provider is unhealthy
+            healthy = resp.status_code < 500 and resp.status_code != 429
+            if ok:
+                data = resp.json()
+        except Exception as e:
+            if self._is_timeout(e):
+                outcome = "timeout"
+        return self._finish(data, healthy, outcome, started, read_timeout)
+
+    def _is_timeout(self, error: Exception) -> bool:
+        if isinstance(error, requests.Timeout):
+            return True
+        if self.http2:
+            import httpx
+
+            return isinstance(error, httpx.TimeoutException)
+        return False
+
+    async def lookup_async(self, ip: str) -> Optional[dict]:
+        """
+        lookup() for asyncio code (async_app.py), over an aiohttp connection
+        pool owned by the running event loop. Shares the breaker, adaptive
+        timeout and counters with the blocking client.
+        """
+        read_timeout = self._start()
+        if read_timeout is None:
+            return None
+        import aiohttp
+
+        started = time.monotonic()
+        data = None
+        healthy = False
+        outcome = "error"
+        try:
+            session = self._get_async_session()
+            timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=read_timeout)
+            async with session.get(self.base_url, params=self._params(ip), timeout=timeout) as resp:
+                healthy = resp.status < 500 and resp.status != 429
+                if resp.ok:
+                    data = await resp.json(content_type=None)
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+        except Exception:
+            pass
+        return self._finish(data, healthy, outcome, started, read_timeout)
+
+    def _get_async_session(self) -> Any:
+        # aiohttp sessions are bound to the loop they were created on
+        loop = asyncio.get_running_loop()
+        session, session_loop = self._async_session
+        if session is None or session.closed or session_loop is not loop:
+            import aiohttp
+
+            connector = aiohttp.TCPConnector(limit=IP2LOCATION_ASYNC_POOL_SIZE, ttl_dns_cache=300)
+            session = aiohttp.ClientSession(connector=connector)
+            self._async_session = (session, loop)
+        return session
+
+    async def close_async(self) -> None:
+        """Close the aiohttp pool of the running loop (call on app shutdown)."""
+        session, session_loop = self._async_session
+        if session is not None and session_loop is asyncio.get_running_loop():
+            self._async_session = (None, None)
+            await session.close()
+
+    def _count(self, outcome: str) -> None:
+        with self._lock:
+            self.outcomes[outcome] += 1
+            if outcome in ("error", "timeout"):
+                self.errors += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Request / connection reuse counters for this worker process."""
+        stats: Dict[str, Any] = {
+            "transport": "httpx-h2" if self.http2 else "requests",
+            "pool_size": self.pool_size,
+            "requests": self.requests,
+            "errors": self.errors,
+            "outcomes": dict(self.outcomes),
+            "read_timeout": round(self.timeout.current(), 3),
+            "breaker": self.breaker.stats(),
+        }
+        session = self._session
+        if session is not None and not self.http2 and self._pid == os.getpid():
+            pools = session.get_adapter(self.base_url).poolmanager.pools
+            opened = served = 0
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    opened += pool.num_connections
+                    served += pool.num_requests
+            # urllib3 counts every new socket it opens; the rest were reused
+            stats["connections_opened"] = opened
+            stats["connections_reused"] = max(served - opened, 0)
+        return stats
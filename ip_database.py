@@ -0,0 +1,318 @@
+import csv
+import ipaddress
+import logging
+import os
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from itertools import chain
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+log = logging.getLogger(__name__)
+
+
+# Comma-separated list of local range databases. Supported formats:
+#   * IP2Location CSV exports (DB1 country, PX proxy; IPv4 or IPv6 editions)
+#   * MaxMind-style .mmdb files (needs the optional `maxminddb` package)
+IP_DATABASE_PATH = os.environ.get("IP_DATABASE_PATH", "")
+# How often (seconds) to stat the files and reload them if they were replaced
+IP_DATABASE_CHECK_INTERVAL = float(os.environ.get("IP_DATABASE_CHECK_INTERVAL", "60"))
+
+_IPV4_MAX = 0xFFFFFFFF
+_IPV4_MAPPED_BASE = 0xFFFF00000000
+
+# proxy_type values used by the IP2Location PX databases ("-" = not a proxy)
+_PROXY_TYPES = {"VPN", "TOR", "PUB", "WEB", "RES", "DCH", "CPN", "EPN", "SES", "-"}
+
+
+class RangeTable:
+    """
+    Sorted, non-overlapping [start, end] ranges for one address family, searched
+    with bisect. IPv4 bounds live in compact unsigned arrays; IPv6 bounds don't
+    fit a machine word and are kept as int lists. Each range points at a row in
+    `records`, which holds each distinct attribute tuple only once.
+    """
+
+    def __init__(self, kind: str, ipv6: bool) -> None:
+        self.kind = kind  # "country" or "proxy"
+        self.ipv6 = ipv6
+        self.starts: Sequence[int] = [] if ipv6 else array("I")
+        self.ends: Sequence[int] = [] if ipv6 else array("I")
+        self.record_ids = array("I")
+        self.records: List[Tuple[str, ...]] = []
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def find(self, number: int) -> Optional[Tuple[str, ...]]:
+        i = bisect_right(self.starts, number) - 1
+        if i < 0 or number > self.ends[i]:
+            return None
+        return self.records[self.record_ids[i]]
+
+
+def _detect_kind(path: str, header: Optional[List[str]], first_rows: List[List[str]]) -> str:
+    """
+    "proxy" or "country" for a whole file, decided once: from a header row if
+    the file has one, else the file name (IP2PROXY-...-PX2.CSV vs
+    IP2LOCATION-...-DB1.CSV), else the first row whose third column is a
+    proxy type or a two-letter country code ("-" fits both, so it decides
+    nothing). Files that can't be told apart are read as country tables.
+    """
+    if header is not None:
+        return "proxy" if any("proxy" in column.lower() for column in header) else "country"
+    name = os.path.basename(path).upper()
+    if "PROXY" in name or re.search(r"(^|[^A-Z])PX\d+", name):
+        return "proxy"
+    if re.search(r"(^|[^A-Z])DB\d+", name):
+        return "country"
+    for row in first_rows:
+        value = row[2].upper()
+        if len(row) >= 5 and value in _PROXY_TYPES and value != "-":
+            return "proxy"
+        if len(value) == 2:
+            return "country"
+    return "country"
+
+
+def _load_csv(path: str) -> RangeTable:
+    """
+    Parse an IP2Location DB/PX CSV export into a RangeTable. The format (and
+    column count) is fixed per file by its first data row; rows that don't
+    match it are skipped and counted, never reinterpreted.
+    """
+    rows: List[Tuple[int, int, Tuple[str, ...]]] = []
+    skipped = 0
+    ipv6 = False
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+        header: Optional[List[str]] = None
+        head: List[List[str]] = []
+        for row in reader:
+            if row and row[0].isdigit():
+                head.append(row)
+                if len(head) == 100:
+                    break
+            elif row and header is None and not head:
+                header = row
+        if not head:
+            return RangeTable("country", False)
+        kind = _detect_kind(path, header, head)
+        columns = len(head[0])
+        if columns < 4:
+            raise ValueError(f"{path}: expected at least 4 columns, got {columns}")
+        # PX1 has no proxy_type column: every listed range is a proxy
+        px1 = kind == "proxy" and columns == 4
+
+        for row in chain(head, reader):
+            if not row:
+                continue
+            if len(row) != columns or not row[0].isdigit() or not row[1].isdigit():
+                skipped += 1
+                continue
+            start, end = int(row[0]), int(row[1])
+            if px1:
+                # PX1: ip_from, ip_to, country_code, country_name
+                attrs: Tuple[str, ...] = (row[2], row[3], "", "")
+            elif kind == "proxy":
+                # PX2+: ip_from, ip_to, proxy_type, country_code, country_name,
+                #       region, city, isp, domain, usage_type, ...
+                proxy_type = row[2].upper()
+                if proxy_type not in _PROXY_TYPES:
+                    skipped += 1
+                    continue
+                attrs = (row[3], row[4], proxy_type, row[9] if columns > 9 else "")
+            else:
+                # DB1+: ip_from, ip_to, country_code, country_name, region, city, ...
+                attrs = (row[2], row[3])
+            ipv6 = ipv6 or end > _IPV4_MAX
+            rows.append((start, end, attrs))
+    if skipped:
+        log.warning("Skipped malformed IP database rows", extra={"path": path, "kind": kind, "skipped": skipped})
+
+    rows.sort(key=lambda r: r[0])
+    table = RangeTable(kind, ipv6)
+    interned: Dict[Tuple[str, ...], int] = {}
+    for start, end, attrs in rows:
+        record_id = interned.get(attrs)
+        if record_id is None:
+            record_id = interned[attrs] = len(table.records)
+            table.records.append(attrs)
+        table.starts.append(start)
+        table.ends.append(end)
+        table.record_ids.append(record_id)
+    return table
+
+
+class _MMDBSource:
+    """Adapter for .mmdb files; the reader is already a memory-mapped search tree."""
+
+    def __init__(self, path: str) -> None:
+        import maxminddb  # optional dependency, only needed for .mmdb files
+
+        self._reader = maxminddb.open_database(path)
+
+    def lookup(self, ip: str) -> Optional[Dict[str, Any]]:
+        found = self._reader.get(ip)
+        if not found:
+            return None
+        country = found.get("country") or found.get("registered_country") or {}
+        traits = found.get("traits") or {}
+        result: Dict[str, Any] = {
+            "country_code": country.get("iso_code", ""),
+            "country_name": (country.get("names") or {}).get("en", ""),
+        }
+        proxy_keys = ("is_anonymous", "is_anonymous_vpn", "is_hosting_provider", "is_public_proxy", "is_tor_exit_node")
+        if any(key in traits for key in proxy_keys) or "is_anonymous" in found:
+            result["is_proxy"] = any(traits.get(key) or found.get(key) for key in proxy_keys)
+        return result
+
+
+class _Snapshot:
+    """One immutable generation of loaded databases; replaced wholesale on reload."""
+
+    def __init__(self, paths: List[str]) -> None:
+        self.signature = _stat_signature(paths)
+        self.v4: List[RangeTable] = []
+        self.v6: List[RangeTable] = []
+        self.mmdb: List[_MMDBSource] = []
+        for path in paths:
+            if path.lower().endswith(".mmdb"):
+                self.mmdb.append(_MMDBSource(path))
+                continue
+            table = _load_csv(path)
+            (self.v6 if table.ipv6 else self.v4).append(table)
+
+    def lookup(self, ip: str) -> Optional[Dict[str, Any]]:
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        number = int(addr)
+        if addr.version == 4:
+            searches = [(t, number) for t in self.v4] + [(t, _IPV4_MAPPED_BASE + number) for t in self.v6]
+        else:
+            mapped = addr.ipv4_mapped
+            searches = [(t, number) for t in self.v6]
+            if mapped is not None:
+                searches += [(t, int(mapped)) for t in self.v4]
+
+        result: Dict[str, Any] = {}
+        has_proxy_table = False
+        for table, key in searches:
+            has_proxy_table = has_proxy_table or table.kind == "proxy"
+            attrs = table.find(key)
+            if attrs is None:
+                continue
+            if table.kind == "proxy":
+                country_code, country_name, proxy_type, usage_type = attrs
+                result["is_proxy"] = proxy_type != "-"
+                if proxy_type:
+                    result["proxy_type"] = proxy_type
+                if usage_type:
+                    result["usage_type"] = usage_type
+            else:
+                country_code, country_name = attrs
+            if country_code and country_code != "-" and not result.get("country_code"):
+                result["country_code"] = country_code
+                result["country_name"] = country_name
+        # PX databases only list proxy ranges, so a miss there means "not a proxy"
+        if has_proxy_table and "is_proxy" not in result:
+            result["is_proxy"] = False
+
+        for source in self.mmdb:
+            try:
+                found = source.lookup(ip)
+            except Exception:
+                # A broken / unreadable .mmdb must not fail the request
+                log.debug("mmdb lookup failed", exc_info=True, extra={"ip": ip})
+                found = None
+            if found:
+                for key, value in found.items():
+                    result.setdefault(key, value)
+
+        if not result.get("country_code") and "is_proxy" not in result:
+            return None
+        result["ip"] = ip
+        result["source"] = "local"
+        return result
+
+
+def _stat_signature(paths: List[str]) -> Tuple[Tuple[int, int, int], ...]:
+    signature = []
+    for path in paths:
+        st = os.stat(path)
+        signature.append((st.st_mtime_ns, st.st_size, st.st_ino))
+    return tuple(signature)
+
+
+class LocalIPDatabase:
+    """
+    Answers country / proxy questions from local range files in microseconds.
+    Files are loaded once; when any of them is replaced on disk (checked at most
+    every `check_interval` seconds) a new snapshot is built in a background
+    thread and swapped in atomically, so lookups never see a half-loaded table.
+    """
+
+    def __init__(self, paths: List[str], check_interval: float = IP_DATABASE_CHECK_INTERVAL) -> None:
+        self.paths = paths
+        self.check_interval = check_interval
+        self._snapshot = _Snapshot(paths)
+        self._next_check = time.monotonic() + check_interval
+        self._reload_lock = threading.Lock()
+        self.loaded_at = time.time()
+        self.reloads = 0
+
+    def lookup(self, ip: str) -> Optional[Dict[str, Any]]:
+        """Return an IP2Location.io-shaped dict, or None if no database covers the IP."""
+        if self.check_interval > 0 and time.monotonic() >= self._next_check:
+            self._maybe_reload()
+        return self._snapshot.lookup(ip)
+
+    def _maybe_reload(self) -> None:
+        if not self._reload_lock.acquire(blocking=False):
+            return  # another thread is already checking / reloading
+        self._next_check = time.monotonic() + self.check_interval
+        try:
+            changed = _stat_signature(self.paths) != self._snapshot.signature
+        except OSError:
+            changed = False  # file is mid-replace; keep serving the old snapshot
+        if not changed:
+            self._reload_lock.release()
+            return
+        threading.Thread(target=self._reload, name="ip-database-reload", daemon=True).start()
+
+    def _reload(self) -> None:
+        try:
+            # The old snapshot isn't closed: lookups that already hold it may
+            # still be reading its mmdb readers. They close when the last
+            # reference goes away.
+            self._snapshot = _Snapshot(self.paths)
+            self.loaded_at = time.time()
+            self.reloads += 1
+        except Exception:
+            log.exception("Failed to reload IP database", extra={"paths": self.paths})
+            return
+        finally:
+            self._reload_lock.release()
+
+    def stats(self) -> Dict[str, Any]:
+        snapshot = self._snapshot
+        return {
+            "paths": self.paths,
+            "ipv4_ranges": sum(len(t) for t in snapshot.v4),
+            "ipv6_ranges": sum(len(t) for t in snapshot.v6),
+            "mmdb_files": len(snapshot.mmdb),
+            "loaded_at": self.loaded_at,
+            "reloads": self.reloads,
+        }
+
+
+def load_local_ip_database() -> Optional[LocalIPDatabase]:
+    """Open the databases listed in IP_DATABASE_PATH, or return None if unset."""
+    paths = [p.strip() for p in IP_DATABASE_PATH.split(",") if p.strip()]
+    if not paths:
+        return None
+    return LocalIPDatabase(paths)
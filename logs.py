@@ -0,0 +1,145 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from itertools import islice
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Iterable, Optional
+
+from metrics import LOG_RECORDS_DROPPED
+
+
+# DEBUG, INFO, WARNING or ERROR
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# "json" (one object per line, for log shipping) or "text" (local development)
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
+# Share of DEBUG / INFO records kept, e.g. 0.1 under heavy load; warnings and
+# errors are always kept
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "1"))
+# Records waiting for the writer thread. When it can't keep up, new records are
+# dropped (and counted) instead of blocking the request that logs them.
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+# Longest key listing included in DEBUG records (see sample_keys)
+LOG_MAX_KEYS = int(os.environ.get("LOG_MAX_KEYS", "20"))
+
+# ID of the request being handled in this thread / task, added to every record
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+# Attributes every LogRecord has; anything else came in through `extra=`
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "request_id"}
+
+_listener: Optional[QueueListener] = None
+# Accepted X-Request-ID values; anything else is replaced with a fresh ID
+_REQUEST_ID_RE = re.compile(r"[A-Za-z0-9._:-]{1,64}")
+
+
+def _extras(record: logging.LogRecord) -> Dict[str, Any]:
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS}
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record: ts, level, logger, msg, request_id, `extra` fields, exc."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            entry["request_id"] = request_id
+        entry.update(_extras(record))
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable single line, with `extra` fields appended as key=value."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = f"{self.formatTime(record)} {record.levelname:<7} {record.name}: {record.getMessage()}"
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            line += f" request_id={request_id}"
+        for key, value in _extras(record).items():
+            line += f" {key}={value}"
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+class _SamplingFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or LOG_SAMPLE_RATE >= 1 or random.random() < LOG_SAMPLE_RATE
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """
+    Hands records to the writer thread. Runs in the logging thread, so it only
+    resolves what may change later (message, traceback, request ID); the JSON
+    encoding and the write happen on the writer thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.request_id = request_id_var.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+def setup_logging() -> None:
+    """
+    Route all logging in this process through a bounded queue to one writer
+    thread that prints to stdout. Safe to call more than once.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JSONFormatter() if LOG_FORMAT == "json" else TextFormatter())
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = _NonBlockingQueueHandler(log_queue)
+    handler.addFilter(_SamplingFilter())
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.handlers[:] = [handler]
+    _listener = QueueListener(log_queue, output)
+    _listener.start()
+    # Flush what is still queued when the process exits
+    atexit.register(_listener.stop)
+
+
+def request_id_from(header: Optional[str]) -> str:
+    """The caller's X-Request-ID if it looks sane, else a new 16-hex-digit ID."""
+    if header and _REQUEST_ID_RE.fullmatch(header):
+        return header
+    return uuid.uuid4().hex[:16]
+
+
+def sample_keys(keys: Iterable[Any], limit: int = LOG_MAX_KEYS) -> list:
+    """
+    At most `limit` keys for a DEBUG record. Call it only under
+    `logger.isEnabledFor(logging.DEBUG)`, so nothing is built otherwise.
+    """
+    return [str(key) for key in islice(keys, limit)]
@@ -0,0 +1,50 @@
+import os
+from typing import Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+
+# With several gunicorn workers, point this at a directory that gunicorn.conf.py
+# empties on start: every worker writes its samples there and /metrics sums
+# them, so a scrape sees the whole instance rather than whichever worker
+# happened to answer. Read by prometheus_client itself at import time.
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR", "")
+if PROMETHEUS_MULTIPROC_DIR:
+    # Outside gunicorn (e.g. `python storage.py migrate`) nothing else creates it
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+# Latencies here range from a cached render (~1us) to an IP2Location timeout (seconds)
+_FAST_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)
+_SLOW_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+HTTP_REQUESTS = Counter(
+    "addremove_http_requests_total", "HTTP requests by route, method and status", ["route", "method", "status"]
+)
+HTTP_LATENCY = Histogram(
+    "addremove_http_request_duration_seconds", "HTTP request latency by route", ["route", "method"],
+    buckets=_SLOW_BUCKETS,
+)
+IP_LOOKUP_LATENCY = Histogram(
+    "addremove_ip_lookup_duration_seconds", "IP2Location.io lookups by outcome (ok, error, timeout, short_circuit)",
+    ["outcome"], buckets=_SLOW_BUCKETS,
+)
+IP_CACHE_REQUESTS = Counter("addremove_ip_cache_requests_total", "IP lookup cache hits and misses", ["result"])
+IP_BLOCKS = Counter("addremove_trial_blocks_total", "/trial requests rejected, by reason (vpn, country)", ["reason"])
+STORAGE_LATENCY = Histogram(
+    "addremove_storage_duration_seconds", "Storage loads and saves (JSON files or SQLite rows)", ["op"], buckets=_SLOW_BUCKETS
+)
+STORAGE_BYTES = Counter("addremove_storage_bytes_total", "Bytes read / written by storage", ["op"])
+RENDER_LATENCY = Histogram("addremove_render_duration_seconds", "/trial page render time", buckets=_FAST_BUCKETS)
+LOG_RECORDS_DROPPED = Counter("addremove_log_records_dropped_total", "Log records dropped because the log queue was full")
+TRACE_SPANS_DROPPED = Counter("addremove_trace_spans_dropped_total", "Spans dropped because the export queue was full")
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    """(body, content type) for a /metrics response."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
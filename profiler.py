@@ -0,0 +1,96 @@
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+log = logging.getLogger(__name__)
+
+
+# Longest profile /admin/profile will take (seconds)
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "60"))
+# Time between stack samples (seconds); 0.005 = 200 samples/s per thread
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", "0.005"))
+# Where profiles triggered by SIGUSR2 are written, and how long they run
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/profiles")
+PROFILE_SIGNAL_SECONDS = float(os.environ.get("PROFILE_SIGNAL_SECONDS", "30"))
+
+# One profile at a time per process: overlapping samplers only skew each other
+_running = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(seconds: float, interval: float = PROFILE_INTERVAL) -> Dict[str, int]:
+    """
+    Sample the stack of every thread in this process for `seconds` and return
+    folded stacks ("thread;outer;...;inner" -> samples), the input format of
+    flamegraph.pl, inferno and speedscope. Pure Python and wall-clock: threads
+    blocked on a lock or on I/O show up where they wait, which is the point.
+    Raises ProfilerBusy if a profile is already running.
+    """
+    if not _running.acquire(blocking=False):
+        raise ProfilerBusy()
+    try:
+        me = threading.get_ident()
+        stacks: Counter = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                labels.append(names.get(ident, f"thread-{ident}"))
+                stacks[";".join(reversed(labels))] += 1
+            time.sleep(interval)
+        return dict(stacks)
+    finally:
+        _running.release()
+
+
+def folded(stacks: Dict[str, int]) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+
+
+def _profile_to_file(seconds: float) -> None:
+    try:
+        stacks = sample_stacks(seconds)
+    except ProfilerBusy:
+        log.warning("Profile already running; ignoring SIGUSR2")
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"profile-{os.getpid()}-{int(time.time())}.folded")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(folded(stacks))
+    log.info("Profile written", extra={"path": path, "samples": sum(stacks.values())})
+
+
+def install_signal_handler(signum: int = getattr(signal, "SIGUSR2", 0)) -> bool:
+    """
+    Profile this process for PROFILE_SIGNAL_SECONDS whenever it receives
+    `signum` (SIGUSR2), writing PROFILE_DIR/profile-<pid>-<time>.folded. With
+    gunicorn, `pkill -USR2 -P <master pid>` profiles every live worker at once.
+    Must be called from the main thread; returns False where unsupported.
+    """
+    if not signum:
+        return False
+
+    def handle(signum: int, frame: Optional[object]) -> None:
+        threading.Thread(target=_profile_to_file, args=(PROFILE_SIGNAL_SECONDS,), name="profiler", daemon=True).start()
+
+    signal.signal(signum, handle)
+    return True
@@ -0,0 +1,243 @@
+// Telegram Web App: Extract user ID from Telegram's API
+// This works when opened via Web App button (web_app parameter)
+// Falls back to query param (?tg_id=...) for testing in regular browser
+function extractTelegramUserId() {
+  var tgIdInput = document.getElementById('tg_id');
+  if (!tgIdInput) return;
+
+  var tgId = null;
+
+  // Try to get from Telegram Web App API first
+  if (window.Telegram && window.Telegram.WebApp) {
+    try {
+      // Wait for initDataUnsafe to be available
+      if (window.Telegram.WebApp.initDataUnsafe) {
+        var user = window.Telegram.WebApp.initDataUnsafe.user;
+        if (user && user.id) {
+          tgId = user.id.toString();
+          tgIdInput.value = tgId;
+          // Also set backup field
+          var backupInput = document.getElementById('tg_id_backup');
+          if (backupInput) {
+            backupInput.value = tgId;
+          }
+          // Expand the Web App to full height for better UX
+          window.Telegram.WebApp.expand();
+
+          // Check if user already passed step1 (after extracting tg_id)
+          checkIfAlreadyPassed(tgId);
+          return;
+        }
+      }
+    } catch (e) {
+      console.log('Telegram Web App API not fully initialized yet');
+    }
+  }
+
+  // Fallback: try to get from URL query parameter (for testing in browser)
+  var urlParams = new URLSearchParams(window.location.search);
+  var tgIdFromUrl = urlParams.get('tg_id');
+  if (tgIdFromUrl) {
+    tgId = tgIdFromUrl;
+    tgIdInput.value = tgId;
+    // Also set backup field
+    var backupInput = document.getElementById('tg_id_backup');
+    if (backupInput) {
+      backupInput.value = tgId;
+    }
+    checkIfAlreadyPassed(tgId);
+  }
+}
+
+// tg_ids already checked on this page; the retry timers and validateForm()
+// call extractTelegramUserId() repeatedly, but one check per tg_id is enough
+// (the browser's HTTP cache answers repeat visits via Cache-Control / ETag)
+var step1Checked = {};
+
+// Check if user already passed step1 and show message/close Web App
+function checkIfAlreadyPassed(tgId) {
+  if (!tgId || step1Checked[tgId]) return;
+  step1Checked[tgId] = true;
+
+  // Check with server if user already passed step1
+  fetch('/check-step1?tg_id=' + tgId)
+    .then(response => response.json())
+    .then(data => {
+      if (data.already_passed) {
+        // Show message and close Web App
+        var card = document.querySelector('.card');
+        if (card) {
+          card.innerHTML = '<h2>Free Trial Verification</h2><p>✅ You have already passed Step 1 verification!<br><br>Please close this window and tap \'Continue verification\' button in Telegram to proceed with Step 2.</p>';
+        }
+
+        // Close Web App after 3 seconds
+        if (window.Telegram && window.Telegram.WebApp) {
+          setTimeout(function() {
+            window.Telegram.WebApp.close();
+          }, 3000);
+        }
+      }
+    })
+    .catch(err => {
+      // Silently fail - don't block user if check fails
+      delete step1Checked[tgId]; // allow a retry
+      console.log('Could not check step1 status:', err);
+    });
+}
+
+// Run when page loads - try multiple times to ensure extraction
+function initTelegramId() {
+  extractTelegramUserId();
+
+  // Keep trying until we get tg_id or timeout
+  var attempts = 0;
+  var maxAttempts = 20; // Try for up to 10 seconds (20 * 500ms)
+  var checkInterval = setInterval(function() {
+    var tgIdInput = document.getElementById('tg_id');
+    if (tgIdInput && tgIdInput.value) {
+      clearInterval(checkInterval);
+      console.log('Telegram ID extracted:', tgIdInput.value);
+    } else {
+      extractTelegramUserId();
+      attempts++;
+      if (attempts >= maxAttempts) {
+        clearInterval(checkInterval);
+        console.log('Could not extract Telegram ID after multiple attempts');
+      }
+    }
+  }, 500);
+}
+
+if (document.readyState === 'loading') {
+  document.addEventListener('DOMContentLoaded', initTelegramId);
+} else {
+  initTelegramId();
+}
+
+// Form validation - ensure tg_id is set before submission
+function validateForm(event) {
+  if (event) {
+    event.preventDefault(); // Prevent immediate submission
+  }
+
+  var tgIdInput = document.getElementById('tg_id');
+  var errorDiv = document.getElementById('error-message');
+  var loadingDiv = document.getElementById('loading-indicator');
+
+  if (!tgIdInput) {
+    if (errorDiv) {
+      errorDiv.textContent = 'Form error. Please refresh the page.';
+      errorDiv.style.display = 'block';
+    }
+    return false;
+  }
+
+  // Show loading indicator
+  if (loadingDiv) {
+    loadingDiv.style.display = 'block';
+  }
+  if (errorDiv) {
+    errorDiv.style.display = 'none';
+  }
+
+  // Always try to extract tg_id one more time before submission
+  extractTelegramUserId();
+
+  // Function to check and submit if ready
+  function checkAndSubmit() {
+    if (!tgIdInput.value) {
+      // Still no tg_id - try one more time
+      extractTelegramUserId();
+
+      if (!tgIdInput.value) {
+        // Failed to get tg_id
+        if (loadingDiv) {
+          loadingDiv.style.display = 'none';
+        }
+        if (errorDiv) {
+          errorDiv.textContent = 'Unable to verify your Telegram account. Please make sure you opened this page from Telegram and try again.';
+          errorDiv.style.display = 'block';
+        }
+        return false;
+      }
+    }
+
+    // Verify tg_id is a valid number
+    if (!/^\d+$/.test(tgIdInput.value)) {
+      if (loadingDiv) {
+        loadingDiv.style.display = 'none';
+      }
+      if (errorDiv) {
+        errorDiv.textContent = 'Invalid Telegram account. Please open this page from Telegram.';
+        errorDiv.style.display = 'block';
+      }
+      return false;
+    }
+
+    // tg_id is valid - submit the form
+    if (loadingDiv) {
+      loadingDiv.style.display = 'none';
+    }
+    document.getElementById('trial-form').submit();
+    return true;
+  }
+
+  // Wait a moment for extraction, then check
+  setTimeout(checkAndSubmit, 300);
+  return false; // Prevent immediate submission
+}
+
+// Also extract tg_id when form is shown (not just on submit)
+// This ensures it's ready before user fills the form
+if (document.readyState === 'loading') {
+  document.addEventListener('DOMContentLoaded', function() {
+    extractTelegramUserId();
+    // Keep trying until we get it
+    var attempts = 0;
+    var checkInterval = setInterval(function() {
+      var tgIdInput = document.getElementById('tg_id');
+      if (tgIdInput && tgIdInput.value) {
+        clearInterval(checkInterval);
+      } else {
+        extractTelegramUserId();
+        attempts++;
+        if (attempts > 10) {
+          clearInterval(checkInterval);
+        }
+      }
+    }, 500);
+  });
+} else {
+  extractTelegramUserId();
+}
+
+// Fill the country <select> from the cached country list (countries.json)
+function loadCountries() {
+  var select = document.getElementById('country');
+  if (!select || !select.dataset.options) return;
+  fetch(select.dataset.options)
+    .then(response => response.json())
+    .then(countries => {
+      var fragment = document.createDocumentFragment();
+      countries.forEach(function(country) {
+        var option = document.createElement('option');
+        option.value = country;
+        option.textContent = country;
+        fragment.appendChild(option);
+      });
+      select.appendChild(fragment);
+    })
+    .catch(err => {
+      console.log('Could not load the country list:', err);
+    });
+}
+
+loadCountries();
+
+// Close Web App if user already passed step1
+if (document.body.dataset.alreadyPassed && window.Telegram && window.Telegram.WebApp) {
+  // Close the Web App after showing message
+  setTimeout(function() {
+    window.Telegram.WebApp.close();
+  }, 3000); // Close after 3 seconds
+}
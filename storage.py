@@ -1,77 +1,1338 @@
+import csv
+import glob
+import hashlib
+import heapq
 import json
+import logging
 import os
+import queue
+import random
+import re
+import sqlite3
 import threading
-from typing import Any, Dict, Optional, List
+import time
+import zlib
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, ContextManager, Dict, IO, Iterator, Optional, List, Tuple, Union
 
+try:
+    import fcntl
+except ImportError:  # Windows: only in-process (thread) locking is available
+    fcntl = None  # type: ignore[assignment]
 
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Optional fast / compact codecs (see STORAGE_CODEC)
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+try:
+    import msgpack
+except ImportError:
+    msgpack = None  # type: ignore[assignment]
+
+from logs import sample_keys, setup_logging
+from metrics import STORAGE_BYTES, STORAGE_LATENCY
+from tracing import span, traced, traced_lock
+
+log = logging.getLogger(__name__)
+
+
+# Directory for the pending verification files, trial log and SQLite database
+# (and, by default, the change feed); the checkout itself unless overridden
+BASE_DIR = os.environ.get("STORAGE_DIR", os.path.dirname(os.path.abspath(__file__)))
 
 PENDING_FILE = os.path.join(BASE_DIR, "pending_verifications.json")
-TRIAL_LOG_FILE = os.path.join(BASE_DIR, "trial_users.json")
+# Append-only JSON Lines log, one record per line. Rotated files get a
+# ".<UTC timestamp>" suffix next to it.
+TRIAL_LOG_FILE = os.path.join(BASE_DIR, "trial_users.jsonl")
+# Pre-JSONL format (one JSON list); converted automatically on first use
+LEGACY_TRIAL_LOG_FILE = os.path.join(BASE_DIR, "trial_users.json")
+# Rotate when the log reaches this size (bytes, 0 = never) ...
+TRIAL_LOG_MAX_BYTES = int(os.environ.get("TRIAL_LOG_MAX_BYTES", str(64 * 1024 * 1024)))
+# ... or when its last write falls in an earlier period of this length (seconds, 0 = never)
+TRIAL_LOG_ROTATE_SECONDS = int(os.environ.get("TRIAL_LOG_ROTATE_SECONDS", "0"))
+# Suffix of a rotated segment (see _maybe_rotate_trial_log); "<log>.lock" and
+# other files next to the log don't match it
+_TRIAL_SEGMENT_SUFFIX = re.compile(r"\.\d{8}T\d{12}$")
+
+# "json" (the files above) or "sqlite" (STORAGE_DB_FILE). Existing JSON data is
+# imported into SQLite automatically the first time the database is opened.
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json").lower()
+STORAGE_DB_FILE = os.environ.get("STORAGE_DB_FILE", os.path.join(BASE_DIR, "storage.sqlite3"))
+# Extra time (ms) a writer waits to gather concurrent writes into one flush.
+# 0 still batches writes that queue up while a flush is in progress.
+STORAGE_COMMIT_WINDOW_MS = float(os.environ.get("STORAGE_COMMIT_WINDOW_MS", "0"))
+# "fsync": a write is acknowledged only after the file and its directory entry
+# are fsynced, so it survives a crash / power loss. "none": skip the fsyncs.
+STORAGE_DURABILITY = os.environ.get("STORAGE_DURABILITY", "fsync").lower()
+# Fraction of flushes re-read in the background and compared with the SHA-256
+# of what was written (0 = never). Off the request path.
+STORAGE_VERIFY_SAMPLE_RATE = float(os.environ.get("STORAGE_VERIFY_SAMPLE_RATE", "0"))
+
+# Encoding of the pending verification files (JSON backend):
+#   "json"         - pretty-printed JSON dicts, the original format (default)
+#   "json-compact" - fixed-schema rows as compact JSON, via orjson if installed
+#   "msgpack"      - fixed-schema rows as MessagePack (needs `msgpack`)
+# Files are auto-detected on read, so switching only affects future writes;
+# `python storage.py convert-codec` rewrites everything at once.
+STORAGE_CODEC = os.environ.get("STORAGE_CODEC", "json").lower()
+if STORAGE_CODEC not in ("json", "json-compact", "msgpack"):
+    raise ValueError(f"Unknown STORAGE_CODEC: {STORAGE_CODEC}")
+if STORAGE_CODEC == "msgpack" and msgpack is None:
+    # Fail at startup rather than on the first write
+    raise RuntimeError("STORAGE_CODEC=msgpack requires the msgpack package")
 
+# Pending verifications expire this many seconds after their `created_at`
+# (0 = keep forever). PENDING_TTL_BY_STATUS overrides it per `status`, e.g.
+# "step1_passed=604800,step2_pending=3600". Expired records are invisible to
+# readers at once and purged by the background compaction task.
+PENDING_TTL_SECONDS = float(os.environ.get("PENDING_TTL_SECONDS", "0"))
+PENDING_TTL_BY_STATUS: Dict[str, float] = {
+    status.strip(): float(ttl)
+    for status, _, ttl in (
+        item.partition("=") for item in os.environ.get("PENDING_TTL_BY_STATUS", "").split(",") if "=" in item
+    )
+}
+# Seconds between compaction runs in each process that started the task
+STORAGE_COMPACT_INTERVAL = float(os.environ.get("STORAGE_COMPACT_INTERVAL", "300"))
+
+# Split pending verifications over N files by a hash of tg_id (JSON backend).
+# Each shard has its own locks and is rewritten on its own. This is the initial
+# layout only: once PENDING_LAYOUT_FILE exists it is the source of truth, and
+# the shard count is changed online with `python storage.py reshard N`.
+STORAGE_SHARDS = max(1, int(os.environ.get("STORAGE_SHARDS", "1")))
+PENDING_LAYOUT_FILE = f"{PENDING_FILE}.layout"
+
+# One lock per JSON file serialises the threads of this process (see
+# _path_lock); other processes are excluded with an flock() on "<file>.lock"
+# (see _file_lock) around every read-modify-write. _lock guards _path_locks.
 _lock = threading.Lock()
+_path_locks: Dict[str, threading.Lock] = {}
+_db_local = threading.local()
+# pid of the process that has run the JSON -> SQLite migration check; the
+# first _db() call of each process does it, later connections skip it
+_db_migration_pid: Optional[int] = None
+_db_migration_lock = threading.Lock()
+# pid of the process that has looked for trial log conversions left behind by
+# a crashed process (see convert_legacy_trial_log)
+_abandoned_checked_pid: Optional[int] = None
+# (layout file signature, shard count) last read from PENDING_LAYOUT_FILE
+_layout_state: Optional[Tuple[Optional[Tuple[int, int, int]], int]] = None
+
+# Parsed JSON files keyed by path, with the (mtime, size, inode) they were read
+# at. Only reparsed when the file changes on disk (e.g. another worker wrote it).
+_file_cache: Dict[str, Tuple[Tuple[int, int, int], Any]] = {}
+# SHA-256 of the last bytes this process wrote to each path, with the file
+# signature right after the write (used by the consistency checker)
+_written_checksums: Dict[str, Tuple[Tuple[int, int, int], str]] = {}
+_verify_queue: "queue.Queue[str]" = queue.Queue(maxsize=64)
+_verify_thread: Optional[threading.Thread] = None
+_verify_stats = {"checked": 0, "skipped": 0, "mismatches": 0}
+_compaction_thread: Optional[threading.Thread] = None
+_compaction_stats: Dict[str, Any] = {"runs": 0, "purged_total": 0, "last_run_at": None, "last_purged": 0}
+
+
+# Files written with a non-default codec start with this line + codec name
+_CODEC_MAGIC = b"#addremove-storage "
+
+
+class StorageReadError(Exception):
+    """A storage file exists but can't be decoded (corrupt, or a codec this host lacks)."""
+
+
+def _encode(data: Any, codec: str) -> bytes:
+    if codec == "json":
+        return json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8")
+    if codec == "json-compact":
+        if orjson is not None:
+            body = orjson.dumps(data)
+        else:
+            body = json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    elif codec == "msgpack":
+        if msgpack is None:
+            raise RuntimeError("STORAGE_CODEC=msgpack requires the msgpack package")
+        body = msgpack.packb(data, use_bin_type=True)
+    else:
+        raise ValueError(f"Unknown storage codec: {codec}")
+    return _CODEC_MAGIC + codec.encode("ascii") + b"\n" + body
+
+
+def _decode(payload: bytes) -> Any:
+    """Decode a file written by _encode(); files without a header are plain JSON."""
+    if not payload.startswith(_CODEC_MAGIC):
+        return json.loads(payload.decode("utf-8"))
+    header, _, body = payload.partition(b"\n")
+    codec = header[len(_CODEC_MAGIC):].decode("ascii")
+    if codec == "json-compact":
+        return orjson.loads(body) if orjson is not None else json.loads(body.decode("utf-8"))
+    if codec == "msgpack":
+        if msgpack is None:
+            raise RuntimeError("reading msgpack storage requires the msgpack package")
+        return msgpack.unpackb(body, raw=False)
+    raise ValueError(f"Unknown storage codec: {codec}")
+
+
+class PendingRecord:
+    """
+    One pending verification with a fixed schema, stored as a single row:
+    [presence bitmask, *FIELDS values, extra dict or None]. Unknown keys go to
+    `extra`, so to_dict() returns exactly what was saved. The compact codecs
+    write the row as is, so decoding a file doesn't rebuild per-record dicts.
+    """
+
+    FIELDS = ("name", "country", "email", "ip", "marketing_opt_in", "step1_ok", "status", "created_at")
+    _INDEX = {field: i for i, field in enumerate(FIELDS)}
+    __slots__ = ("row",)
+
+    def __init__(self, row: List[Any]) -> None:
+        self.row = row
+
+    @classmethod
+    def from_dict(cls, info: Dict[str, Any]) -> "PendingRecord":
+        row: List[Any] = [0] + [None] * len(cls.FIELDS) + [None]
+        mask = 0
+        extra = {}
+        for key, value in info.items():
+            i = cls._INDEX.get(key)
+            if i is None:
+                extra[key] = value
+            else:
+                mask |= 1 << i
+                row[i + 1] = value
+        row[0] = mask
+        row[-1] = extra or None
+        return cls(row)
+
+    @classmethod
+    def from_row(cls, row: List[Any], schema: Tuple[str, ...] = FIELDS) -> "PendingRecord":
+        if schema == cls.FIELDS:
+            return cls(row)
+        # Written with a different field list: go through a dict
+        mask = row[0]
+        info = {field: row[i + 1] for i, field in enumerate(schema) if mask & (1 << i)}
+        info.update(row[-1] or {})
+        return cls.from_dict(info)
+
+    def to_row(self) -> List[Any]:
+        return self.row
+
+    def to_dict(self) -> Dict[str, Any]:
+        row = self.row
+        mask = row[0]
+        info = {field: row[i + 1] for i, field in enumerate(self.FIELDS) if mask & (1 << i)}
+        if row[-1]:
+            info.update(row[-1])
+        return info
+
+    def get(self, key: str, default: Any = None) -> Any:
+        i = self._INDEX.get(key)
+        if i is None:
+            return (self.row[-1] or {}).get(key, default)
+        return self.row[i + 1] if self.row[0] & (1 << i) else default
+
+
+# A pending record in memory: a PendingRecord, or the plain dict decoded from
+# a headerless (STORAGE_CODEC=json) file. Converting those to PendingRecord
+# would make every reparse with the default codec slower than plain JSON.
+_Record = Union[PendingRecord, Dict[str, Any]]
+
+
+def _record_dict(record: _Record) -> Dict[str, Any]:
+    """A copy of `record` as a dict, safe to hand out of the file cache."""
+    return dict(record) if isinstance(record, dict) else record.to_dict()
+
+
+def _new_record(info: Dict[str, Any]) -> _Record:
+    """In-memory form of a record about to be saved with STORAGE_CODEC."""
+    return dict(info) if STORAGE_CODEC == "json" else PendingRecord.from_dict(info)
+
+
+def _records_to_document(data: Dict[str, _Record], codec: str) -> Any:
+    if codec == "json":
+        return {key: record if isinstance(record, dict) else record.to_dict() for key, record in data.items()}
+    return {
+        "schema": list(PendingRecord.FIELDS),
+        "rows": {
+            key: (PendingRecord.from_dict(record) if isinstance(record, dict) else record).to_row()
+            for key, record in data.items()
+        },
+    }
+
+
+def _document_to_records(document: Any) -> Dict[str, _Record]:
+    if not isinstance(document, dict):
+        return {}
+    if "schema" in document and "rows" in document:
+        schema = tuple(document["schema"])
+        if schema == PendingRecord.FIELDS:
+            return {key: PendingRecord(row) for key, row in document["rows"].items()}
+        return {key: PendingRecord.from_row(row, schema) for key, row in document["rows"].items()}
+    # Original format: keep the decoded dicts as they are
+    return {key: info for key, info in document.items() if isinstance(info, dict)}
 
 
 def _load_json(path: str, default: Any) -> Any:
-    if not os.path.exists(path):
-        return default
+    """
+    Decoded contents of `path`, or `default` if it doesn't exist. A file that
+    exists but can't be decoded raises StorageReadError: treating it as empty
+    would let the next write replace it and silently drop every record in it.
+    """
+    started = time.perf_counter()
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        # On any error, fall back to default to avoid crashing the app
+        with open(path, "rb") as f:
+            payload = f.read()
+    except FileNotFoundError:
         return default
+    try:
+        data = _decode(payload)
+    except Exception as e:
+        log.error("Storage file can't be decoded; refusing to use it", extra={"path": path, "error": str(e)})
+        raise StorageReadError(f"Can't decode {path}: {e}") from e
+    _observe_io("load", started, len(payload))
+    return data
 
 
-def _save_json(path: str, data: Any) -> None:
-    tmp_path = f"{path}.tmp"
-    with open(tmp_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+def _save_json(path: str, data: Any, codec: str = "json") -> str:
+    """
+    Atomically replace `path` with `data`. With STORAGE_DURABILITY=fsync the
+    data is on stable storage when this returns. Returns the SHA-256 of the
+    bytes written.
+    """
+    started = time.perf_counter()
+    payload = _encode(data, codec)
+    durable = STORAGE_DURABILITY == "fsync"
+    # Unique temp name per writer, so two processes never share a temp file
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+        if durable:
+            f.flush()
+            os.fsync(f.fileno())
     os.replace(tmp_path, path)
+    if durable:
+        _fsync_dir(os.path.dirname(path) or ".")
+    _observe_io("save", started, len(payload))
+    return hashlib.sha256(payload).hexdigest()
 
 
-def get_pending_verification(tg_id: int) -> Optional[Dict[str, Any]]:
-    with _lock:
-        print(f"🔍 get_pending_verification: Looking for tg_id={tg_id}")
-        print(f"   File path: {PENDING_FILE}")
-        print(f"   File exists: {os.path.exists(PENDING_FILE)}")
-        data = _load_json(PENDING_FILE, {})
-        print(f"   All keys in data: {list(data.keys())}")
-        result = data.get(str(tg_id))
-        if result:
-            print(f"   ✅ Found data for tg_id={tg_id}")
-        else:
-            print(f"   ❌ No data found for tg_id={tg_id}")
-        return result
+def _observe_io(op: str, started: float, size: int) -> None:
+    """Record one storage load / save in the metrics; shared by both backends."""
+    STORAGE_LATENCY.labels(op).observe(time.perf_counter() - started)
+    STORAGE_BYTES.labels(op).inc(size)
+
+
+def _fsync_dir(path: str) -> None:
+    """Persist a rename: fsync the directory entry (not supported on Windows)."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
 
 
-def set_pending_verification(tg_id: int, info: Dict[str, Any]) -> None:
+@contextmanager
+def _file_lock(path: str, shared: bool = False) -> Iterator[None]:
+    """Cross-process lock for `path`, held on a sidecar "<path>.lock" file."""
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        with span("storage.flock_wait", path=path, shared=shared):
+            fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)  # also releases the lock
+
+
+def file_lock(path: str, shared: bool = False) -> ContextManager[None]:
+    """_file_lock() for other modules that keep files next to the storage ones (e.g. events.py)."""
+    return _file_lock(path, shared)
+
+
+def _path_lock(path: str) -> threading.Lock:
+    """The in-process lock for one JSON file."""
     with _lock:
-        data = _load_json(PENDING_FILE, {})
-        data[str(tg_id)] = info
-        _save_json(PENDING_FILE, data)
-        # Debug logging
-        print(f"💾 Saved verification data for tg_id={tg_id} to {PENDING_FILE}")
-        print(f"   File exists after save: {os.path.exists(PENDING_FILE)}")
-        # Verify it was saved
-        verify_data = _load_json(PENDING_FILE, {})
-        if str(tg_id) in verify_data:
-            print(f"   ✅ Verified: Data is in file")
+        lock = _path_locks.get(path)
+        if lock is None:
+            lock = _path_locks[path] = threading.Lock()
+        return lock
+
+
+def _file_signature(path: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def _load_pending_cached(path: str) -> Dict[str, _Record]:
+    """
+    Decoded pending verification file, backed by _file_cache. Every save
+    replaces the file (new inode), so any write - from this process or another
+    one - is detected. The returned dict is shared: callers must hold
+    _path_lock(path) and must not keep references to it outside the lock.
+    """
+    signature = _file_signature(path)
+    if signature is None:
+        _file_cache.pop(path, None)
+        return {}
+    cached = _file_cache.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    data = _document_to_records(_load_json(path, {}))
+    _file_cache[path] = (signature, data)
+    return data
+
+
+def _save_pending_cached(path: str, data: Dict[str, _Record]) -> None:
+    """Save a pending verification file with STORAGE_CODEC and keep _file_cache in sync."""
+    try:
+        checksum = _save_json(path, _records_to_document(data, STORAGE_CODEC), STORAGE_CODEC)
+    except Exception:
+        # `data` may now differ from the file; force a reload next time
+        _file_cache.pop(path, None)
+        raise
+    signature = _file_signature(path)
+    if signature is None:
+        _file_cache.pop(path, None)
+        _written_checksums.pop(path, None)
+        return
+    _file_cache[path] = (signature, data)
+    _written_checksums[path] = (signature, checksum)
+    if STORAGE_VERIFY_SAMPLE_RATE > 0 and random.random() < STORAGE_VERIFY_SAMPLE_RATE:
+        _schedule_verify(path)
+
+
+def _schedule_verify(path: str) -> None:
+    global _verify_thread
+    if _verify_thread is None or not _verify_thread.is_alive():
+        _verify_thread = threading.Thread(target=_verify_worker, name="storage-verify", daemon=True)
+        _verify_thread.start()
+    try:
+        _verify_queue.put_nowait(path)
+    except queue.Full:
+        pass  # sampling: dropping a check is fine
+
+
+def _verify_worker() -> None:
+    while True:
+        verify_written_file(_verify_queue.get())
+
+
+def verify_written_file(path: str) -> Optional[bool]:
+    """
+    Re-read `path` and compare it with the checksum of this process's last
+    write. Returns None if the file has been replaced since (nothing to
+    compare), else whether the contents match. A mismatch drops the cached copy.
+    """
+    expected = _written_checksums.get(path)
+    if expected is None or _file_signature(path) != expected[0]:
+        _verify_stats["skipped"] += 1
+        return None
+    try:
+        with open(path, "rb") as f:
+            actual = hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        actual = ""
+    if _file_signature(path) != expected[0]:
+        _verify_stats["skipped"] += 1
+        return None  # replaced while we were reading
+    _verify_stats["checked"] += 1
+    if actual == expected[1]:
+        return True
+    _verify_stats["mismatches"] += 1
+    log.error("Storage consistency check failed: checksum mismatch", extra={"path": path})
+    with _path_lock(path):
+        _file_cache.pop(path, None)
+    return False
+
+
+class _GroupCommitter:
+    """
+    Group commit for one JSON file. Writers enqueue their change; the first
+    one to find no flush in progress becomes the leader and applies every
+    queued change in one locked read-modify-write + fsync, then resolves all
+    their futures. Writers arriving during a flush are picked up by the next
+    one, so under load N writes cost one file rewrite instead of N.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._queue: List[Tuple[str, str, Any, "Future[bool]"]] = []
+        self._queue_lock = threading.Lock()
+        self._flushing = False
+        self.flushes = 0
+        self.writes = 0
+
+    def submit(self, op: str, key: str, value: Any = None) -> "Future[bool]":
+        future: "Future[bool]" = Future()
+        with self._queue_lock:
+            self._queue.append((op, key, value, future))
+            if self._flushing:
+                return future  # the current leader will flush it
+            self._flushing = True
+        self._lead(future)
+        return future
+
+    def _lead(self, own: Optional["Future[bool]"]) -> None:
+        batch: List[Tuple[str, str, Any, "Future[bool]"]] = []
+        try:
+            while True:
+                if STORAGE_COMMIT_WINDOW_MS > 0:
+                    time.sleep(STORAGE_COMMIT_WINDOW_MS / 1000)
+                with self._queue_lock:
+                    batch, self._queue = self._queue, []
+                self._flush(batch)
+                batch = []
+                with self._queue_lock:
+                    if not self._queue:
+                        self._flushing = False
+                        return
+                    if own is not None and own.done():
+                        # Our write is durable; hand the rest to a helper thread
+                        # instead of making this request wait for other writers.
+                        threading.Thread(target=self._lead, args=(None,), name="storage-commit", daemon=True).start()
+                        return
+        except BaseException as e:
+            # Interrupted (worker timeout, thread start failure...): step down
+            # so the next writer can lead, and fail the writes left behind
+            # rather than have their callers wait forever.
+            with self._queue_lock:
+                stranded, self._queue = self._queue, []
+                self._flushing = False
+            error = e if isinstance(e, Exception) else RuntimeError(f"Group commit interrupted: {e!r}")
+            for *_, future in batch + stranded:
+                if not future.done():
+                    future.set_exception(error)
+            raise
+
+    def _flush(self, batch: List[Tuple[str, str, Any, "Future[bool]"]]) -> None:
+        try:
+            # Shared layout lock: a concurrent reshard() waits for this flush
+            with _file_lock(PENDING_LAYOUT_FILE, shared=True):
+                if self.path not in _shard_paths(_shard_count()):
+                    # Resharded while these writes were queued: re-route them
+                    for op, key, value, future in batch:
+                        _chain(_committer(_shard_path(key)).submit(op, key, value), future)
+                    return
+                self._apply(batch)
+        except Exception as e:
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.flushes += 1
+        self.writes += len(batch)
+        for *_, future in batch:
+            future.set_result(True)
+
+    def _apply(self, batch: List[Tuple[str, str, Any, "Future[bool]"]]) -> None:
+        with traced_lock(_path_lock(self.path), "storage.lock_wait", path=self.path), _file_lock(self.path):
+            data = _load_pending_cached(self.path)
+            for op, key, value, _ in batch:
+                if op == "set":
+                    data[key] = _new_record(value)
+                else:
+                    data.pop(key, None)
+            _save_pending_cached(self.path, data)
+
+
+_committers: Dict[str, _GroupCommitter] = {}
+_committers_lock = threading.Lock()
+
+
+def _committer(path: str) -> _GroupCommitter:
+    with _committers_lock:
+        committer = _committers.get(path)
+        if committer is None:
+            committer = _committers[path] = _GroupCommitter(path)
+        return committer
+
+
+def _completed(result: bool) -> "Future[bool]":
+    future: "Future[bool]" = Future()
+    future.set_result(result)
+    return future
+
+
+def _chain(source: "Future[bool]", target: "Future[bool]") -> None:
+    def copy(done: "Future[bool]") -> None:
+        error = done.exception()
+        if error is not None:
+            target.set_exception(error)
         else:
-            print(f"   ❌ ERROR: Data NOT found in file after save!")
+            target.set_result(done.result())
 
+    source.add_done_callback(copy)
+
+
+def _shard_paths(count: int) -> List[str]:
+    if count == 1:
+        return [PENDING_FILE]
+    root, ext = os.path.splitext(PENDING_FILE)
+    return [f"{root}.shard{i}-of-{count}{ext}" for i in range(count)]
+
+
+def _shard_count() -> int:
+    """Shard count currently in use, from PENDING_LAYOUT_FILE (cached by file signature)."""
+    global _layout_state
+    signature = _file_signature(PENDING_LAYOUT_FILE)
+    state = _layout_state
+    if state is not None and state[0] == signature:
+        return state[1]
+    count = 1 if signature is None else _layout_shard_count()
+    if signature is None and STORAGE_SHARDS != 1:
+        # No layout yet: move the single-file data to the configured shards
+        reshard(STORAGE_SHARDS)
+        return _shard_count()
+    _layout_state = (signature, count)
+    return count
+
+
+def _layout_shard_count() -> int:
+    """Shard count recorded in PENDING_LAYOUT_FILE (1 without one). Unlike _shard_count(), never reshards."""
+    return int(_load_json(PENDING_LAYOUT_FILE, {}).get("shards", 1))
+
+
+def _shard_path(tg_id: Union[int, str]) -> str:
+    paths = _shard_paths(_shard_count())
+    if len(paths) == 1:
+        return paths[0]
+    return paths[zlib.crc32(str(tg_id).encode("ascii")) % len(paths)]
+
+
+def reshard(count: int) -> int:
+    """
+    Move pending verifications to a layout with `count` shards while the app
+    keeps running. New shard files are written first, then the layout file is
+    switched atomically and the old files removed; writers hold the layout
+    lock shared, so none is mid-flush meanwhile, and writes queued for an old
+    shard are re-routed. Returns the number of records moved.
+    """
+    global _layout_state
+    count = max(1, int(count))
+    with _file_lock(PENDING_LAYOUT_FILE):
+        signature = _file_signature(PENDING_LAYOUT_FILE)
+        current = int(_load_json(PENDING_LAYOUT_FILE, {}).get("shards", 1)) if signature else 1
+        if current == count:
+            _layout_state = (signature, count)
+            return 0
+        old_paths = _shard_paths(current)
+        new_paths = _shard_paths(count)
+        buckets: List[Dict[str, Any]] = [{} for _ in new_paths]
+        for path in old_paths:
+            with _path_lock(path):
+                for key, info in _load_pending_cached(path).items():
+                    buckets[zlib.crc32(key.encode("ascii")) % count if count > 1 else 0][key] = info
+        for path, bucket in zip(new_paths, buckets):
+            with _path_lock(path):
+                _save_pending_cached(path, bucket)
+        _save_json(PENDING_LAYOUT_FILE, {"shards": count})
+        _layout_state = (_file_signature(PENDING_LAYOUT_FILE), count)
+        for path in old_paths:
+            if path not in new_paths:
+                with _path_lock(path):
+                    _file_cache.pop(path, None)
+                    for stale in (path, f"{path}.lock"):
+                        try:
+                            os.remove(stale)
+                        except FileNotFoundError:
+                            pass
+    moved = sum(len(bucket) for bucket in buckets)
+    log.info("Resharded pending verifications", extra={"moved": moved, "from_shards": current, "to_shards": count})
+    return moved
+
+
+def convert_codec(codec: str = STORAGE_CODEC) -> int:
+    """
+    Rewrite every pending verification shard with `codec` now, instead of
+    waiting for each one's next write. Returns the number of files rewritten.
+    """
+    global STORAGE_CODEC
+    _encode({}, codec)  # fail early on an unknown / unavailable codec
+    STORAGE_CODEC = codec
+    rewritten = 0
+    _shard_count()
+    with _file_lock(PENDING_LAYOUT_FILE, shared=True):
+        for path in _shard_paths(_shard_count()):
+            if not os.path.exists(path):
+                continue
+            with _path_lock(path), _file_lock(path):
+                _save_pending_cached(path, _load_pending_cached(path))
+            rewritten += 1
+    return rewritten
+
+
+def iter_pending_verifications(include_expired: bool = False) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """
+    Yield (tg_id, record) for every pending verification, shard by shard (or
+    straight from SQLite). Each shard is snapshotted under its lock and the
+    records are copied, so the caller can take its time.
+    """
+    now = time.time()
+    if STORAGE_BACKEND == "sqlite":
+        for tg_id, data in _db().execute("SELECT tg_id, data FROM pending_verifications ORDER BY tg_id"):
+            info = json.loads(data)
+            if include_expired or not _is_expired(info, now):
+                yield tg_id, info
+        return
+    for path in _shard_paths(_shard_count()):
+        with _path_lock(path):
+            items = list(_load_pending_cached(path).items())
+        for key, info in items:
+            if key.isdigit() and (include_expired or not _is_expired(info, now)):
+                yield int(key), _record_dict(info)
+
+
+def _db() -> sqlite3.Connection:
+    """
+    Per-thread (and per-process, after fork) SQLite connection. Statements are
+    parameterised, so sqlite3's statement cache reuses the prepared queries.
+    The first connection of a process also imports any JSON storage once.
+    """
+    global _db_migration_pid
+    conn = getattr(_db_local, "conn", None)
+    if conn is not None and _db_local.pid == os.getpid():
+        return conn
+    conn = _connect()
+    if _db_migration_pid != os.getpid():
+        with _db_migration_lock:
+            if _db_migration_pid != os.getpid():
+                try:
+                    migrate_json_to_sqlite(conn)
+                except Exception:
+                    conn.close()
+                    raise
+                _db_migration_pid = os.getpid()
+    _db_local.conn = conn
+    _db_local.pid = os.getpid()
+    return conn
+
+
+def _connect() -> sqlite3.Connection:
+    """New SQLite connection with the pragmas set and the schema in place."""
+    conn = sqlite3.connect(STORAGE_DB_FILE, timeout=10, isolation_level=None)
+    # Lets compaction hand freed pages back to the OS (only applies to new databases)
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    # FULL fsyncs the WAL on every commit; NORMAL may lose the last commits on power loss
+    conn.execute("PRAGMA synchronous=FULL" if STORAGE_DURABILITY == "fsync" else "PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS pending_verifications ("
+        " tg_id INTEGER PRIMARY KEY,"
+        " status TEXT,"
+        " created_at TEXT,"
+        " data TEXT NOT NULL)"
+    )
+    conn.execute("CREATE TABLE IF NOT EXISTS trial_log (id INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS storage_meta (key TEXT PRIMARY KEY, value TEXT)")
+    return conn
+
+
+def migrate_json_to_sqlite(conn: Optional[sqlite3.Connection] = None) -> bool:
+    """
+    One-shot import of PENDING_FILE and TRIAL_LOG_FILE into the SQLite database.
+    Runs inside one IMMEDIATE transaction and records itself in storage_meta, so
+    concurrent workers can all call it and only the first one does the work.
+    Returns True if this call performed the migration.
+    """
+    # Not _db(): that would run the migration itself before we get to report it
+    conn = conn or _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        done = conn.execute("SELECT 1 FROM storage_meta WHERE key = 'migrated_from_json'").fetchone()
+        if done:
+            conn.execute("ROLLBACK")
+            return False
+        pending: Dict[str, _Record] = {}
+        # Read the files as they are: _shard_count() could reshard them first
+        for path in _shard_paths(_layout_shard_count()):
+            pending.update(_document_to_records(_load_json(path, {})))
+        conn.executemany(
+            "INSERT OR IGNORE INTO pending_verifications (tg_id, status, created_at, data) VALUES (?, ?, ?, ?)",
+            (
+                (int(tg_id), info.get("status"), info.get("created_at"), json.dumps(_record_dict(info), ensure_ascii=False))
+                for tg_id, info in pending.items()
+                if str(tg_id).isdigit()
+            ),
+        )
+        legacy: List[Dict[str, Any]] = _load_json(LEGACY_TRIAL_LOG_FILE, [])
+        records = legacy + list(_iter_trial_log_files())
+        conn.executemany(
+            "INSERT INTO trial_log (data) VALUES (?)",
+            ((json.dumps(record, ensure_ascii=False),) for record in records),
+        )
+        conn.execute("INSERT INTO storage_meta (key, value) VALUES ('migrated_from_json', datetime('now'))")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    if pending or records:
+        log.info(
+            "Migrated JSON storage to SQLite",
+            extra={"pending": len(pending), "trial_log_records": len(records), "db_file": STORAGE_DB_FILE},
+        )
+    return True
+
+
+@traced("storage.get_pending_verification")
+def get_pending_verification(tg_id: int) -> Optional[Dict[str, Any]]:
+    if STORAGE_BACKEND == "sqlite":
+        started = time.perf_counter()
+        row = _db().execute("SELECT data FROM pending_verifications WHERE tg_id = ?", (int(tg_id),)).fetchone()
+        _observe_io("load", started, len(row[0]) if row else 0)
+        result = json.loads(row[0]) if row else None
+        return None if result is None or _is_expired(result) else result
+    path = _shard_path(tg_id)
+    with traced_lock(_path_lock(path), "storage.lock_wait", path=path):
+        data = _load_pending_cached(path)
+        result = data.get(str(tg_id))
+        expired = result is not None and _is_expired(result)
+        if log.isEnabledFor(logging.DEBUG):
+            # Bounded key sample, built only at DEBUG verbosity
+            log.debug(
+                "get_pending_verification",
+                extra={
+                    "tg_id": tg_id,
+                    "path": path,
+                    "found": result is not None,
+                    "expired": expired,
+                    "records": len(data),
+                    "keys_sample": sample_keys(data),
+                },
+            )
+        if result is None or expired:
+            return None
+        # Copy, so callers can't mutate the cached record
+        return _record_dict(result)
+
+
+@traced("storage.has_passed_step1")
+def has_passed_step1(tg_id: int) -> bool:
+    """
+    Whether `tg_id` has a live record with step1_ok - the /check-step1 fast
+    path. On the JSON backend this is a stat() plus a dict lookup in the
+    decoded shard that _file_cache already holds (reparsed only when any
+    process rewrites the file), with no copy of the record.
+    """
+    if STORAGE_BACKEND == "sqlite":
+        started = time.perf_counter()
+        row = _db().execute("SELECT data FROM pending_verifications WHERE tg_id = ?", (int(tg_id),)).fetchone()
+        _observe_io("load", started, len(row[0]) if row else 0)
+        info = json.loads(row[0]) if row else None
+        return bool(info and info.get("step1_ok") and not _is_expired(info))
+    path = _shard_path(tg_id)
+    with traced_lock(_path_lock(path), "storage.lock_wait", path=path):
+        record = _load_pending_cached(path).get(str(tg_id))
+        return bool(record is not None and record.get("step1_ok") and not _is_expired(record))
+
+
+@traced("storage.get_pending_verifications")
+def get_pending_verifications(tg_ids: List[int], status: Optional[str] = None) -> Dict[int, Dict[str, Any]]:
+    """
+    Batch version of get_pending_verification(): one read per shard (or one
+    query per 500 ids on SQLite) instead of one per tg_id. Missing, expired
+    and - if `status` is given - non-matching records are left out.
+    """
+    now = time.time()
+    found: Dict[int, Dict[str, Any]] = {}
+    if STORAGE_BACKEND == "sqlite":
+        ids = sorted({int(tg_id) for tg_id in tg_ids})
+        started, size = time.perf_counter(), 0
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            rows = _db().execute(
+                f"SELECT tg_id, data FROM pending_verifications WHERE tg_id IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for tg_id, data in rows:
+                size += len(data)
+                info = json.loads(data)
+                if not _is_expired(info, now) and (status is None or info.get("status") == status):
+                    found[tg_id] = info
+        _observe_io("load", started, size)
+        return found
+    by_shard: Dict[str, List[int]] = {}
+    for tg_id in tg_ids:
+        by_shard.setdefault(_shard_path(tg_id), []).append(int(tg_id))
+    for path, ids in by_shard.items():
+        with traced_lock(_path_lock(path), "storage.lock_wait", path=path):
+            data = _load_pending_cached(path)
+            for tg_id in ids:
+                record = data.get(str(tg_id))
+                if record is None or _is_expired(record, now):
+                    continue
+                if status is None or record.get("status") == status:
+                    found[tg_id] = _record_dict(record)
+    return found
+
+
+def list_pending_verifications(
+    status: Optional[str] = None, after: int = 0, limit: int = 500
+) -> Tuple[List[Tuple[int, Dict[str, Any]]], Optional[int]]:
+    """
+    One page of live pending verifications ordered by tg_id, for bulk sync.
+    Returns (records, next_cursor); pass next_cursor back as `after` to get
+    the following page; it is None on the last page. Paging is keyed on
+    tg_id rather than an offset, so concurrent writes never shift later pages.
+    """
+    now = time.time()
+    page: List[Tuple[int, Dict[str, Any]]] = []
+    if STORAGE_BACKEND == "sqlite":
+        query = "SELECT tg_id, data FROM pending_verifications WHERE tg_id > ?"
+        params: List[Any] = [after]
+        if status is not None:
+            query += " AND status = ?"
+            params.append(status)
+        query += " ORDER BY tg_id"
+        # Expired rows aren't purged until compaction, so keep reading until
+        # the page is full (plus one row to know whether there is more)
+        started, size, next_cursor = time.perf_counter(), 0, None
+        for tg_id, data in _db().execute(query, params):
+            size += len(data)
+            info = json.loads(data)
+            if _is_expired(info, now):
+                continue
+            if len(page) == limit:
+                next_cursor = page[-1][0]
+                break
+            page.append((tg_id, info))
+        _observe_io("load", started, size)
+        return page, next_cursor
+    candidates: List[Tuple[int, _Record]] = []
+    for path in _shard_paths(_shard_count()):
+        with _path_lock(path):
+            items = list(_load_pending_cached(path).items())
+        for key, record in items:
+            if not key.isdigit() or int(key) <= after or _is_expired(record, now):
+                continue
+            if status is None or record.get("status") == status:
+                candidates.append((int(key), record))
+    selected = heapq.nsmallest(limit + 1, candidates, key=lambda item: item[0])
+    page = [(tg_id, _record_dict(record)) for tg_id, record in selected[:limit]]
+    return page, (page[-1][0] if len(selected) > limit else None)
+
+
+def set_pending_verification_async(tg_id: int, info: Dict[str, Any]) -> "Future[bool]":
+    """
+    Queue a write and return a future that resolves to True once it is on
+    disk (or raises the write error). Concurrent writes share one flush.
+    """
+    if STORAGE_BACKEND == "sqlite":
+        started = time.perf_counter()
+        data = json.dumps(info, ensure_ascii=False)
+        _db().execute(
+            "INSERT OR REPLACE INTO pending_verifications (tg_id, status, created_at, data) VALUES (?, ?, ?, ?)",
+            (int(tg_id), info.get("status"), info.get("created_at"), data),
+        )
+        _observe_io("save", started, len(data))
+        return _completed(True)
+    return _committer(_shard_path(tg_id)).submit("set", str(tg_id), info)
+
+
+def clear_pending_verification_async(tg_id: int) -> "Future[bool]":
+    """Like set_pending_verification_async(), for removing a record."""
+    if STORAGE_BACKEND == "sqlite":
+        started = time.perf_counter()
+        _db().execute("DELETE FROM pending_verifications WHERE tg_id = ?", (int(tg_id),))
+        _observe_io("save", started, 0)
+        return _completed(True)
+    return _committer(_shard_path(tg_id)).submit("clear", str(tg_id))
+
+
+@traced("storage.set_pending_verification")
+def set_pending_verification(tg_id: int, info: Dict[str, Any]) -> bool:
+    """
+    Store `info` for `tg_id`. Returns True once the write is durable (see
+    STORAGE_DURABILITY), False if it failed - no need to read it back.
+    """
+    try:
+        set_pending_verification_async(tg_id, info).result()
+    except Exception:
+        log.exception("Error saving verification data", extra={"tg_id": tg_id})
+        return False
+    log.debug("Saved verification data", extra={"tg_id": tg_id})
+    return True
+
+
+def clear_pending_verification(tg_id: int) -> bool:
+    """Remove the record for `tg_id`. Returns False if the write failed."""
+    try:
+        clear_pending_verification_async(tg_id).result()
+    except Exception:
+        log.exception("Error clearing verification data", extra={"tg_id": tg_id})
+        return False
+    return True
+
+
+def _ttl_for(status: Any) -> float:
+    return PENDING_TTL_BY_STATUS.get(str(status), PENDING_TTL_SECONDS)
+
+
+def _is_expired(info: _Record, now: Optional[float] = None) -> bool:
+    ttl = _ttl_for(info.get("status"))
+    if ttl <= 0:
+        return False
+    created = _parse_time(info.get("created_at"))
+    if created is None:
+        return False  # can't tell its age; keep it
+    return (now if now is not None else time.time()) - created.timestamp() > ttl
+
+
+def _count_pending(records: Iterator[_Record], now: float) -> Dict[str, Any]:
+    counts: Dict[str, Any] = {"live": 0, "expired": 0, "by_status": {}}
+    for info in records:
+        key = "expired" if _is_expired(info, now) else "live"
+        counts[key] += 1
+        per_status = counts["by_status"].setdefault(str(info.get("status")), {"live": 0, "expired": 0})
+        per_status[key] += 1
+    return counts
+
+
+def compact_pending_verifications() -> int:
+    """
+    Purge expired pending verifications and shrink the storage: the JSON file
+    is rewritten once, the SQLite database gets an incremental vacuum and a
+    WAL checkpoint. Returns the number of purged records.
+    """
+    now = time.time()
+    if STORAGE_BACKEND == "sqlite":
+        conn = _db()
+        # Scan and delete in one write transaction, so a record re-submitted
+        # between the two can't be purged on the strength of its old copy
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            expired = [
+                (tg_id,)
+                for tg_id, data in conn.execute("SELECT tg_id, data FROM pending_verifications")
+                if _is_expired(json.loads(data), now)
+            ]
+            conn.executemany("DELETE FROM pending_verifications WHERE tg_id = ?", expired)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if expired:
+            conn.execute("PRAGMA incremental_vacuum")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        purged = len(expired)
+    else:
+        purged = 0
+        _shard_count()  # set up the layout before taking the layout lock
+        with _file_lock(PENDING_LAYOUT_FILE, shared=True):
+            for path in _shard_paths(_shard_count()):
+                with _path_lock(path), _file_lock(path):
+                    data = _load_pending_cached(path)
+                    expired_keys = [key for key, info in data.items() if _is_expired(info, now)]
+                    for key in expired_keys:
+                        del data[key]
+                    if expired_keys:
+                        _save_pending_cached(path, data)
+                purged += len(expired_keys)
+    _compaction_stats["runs"] += 1
+    _compaction_stats["purged_total"] += purged
+    _compaction_stats["last_run_at"] = now
+    _compaction_stats["last_purged"] = purged
+    return purged
 
-def clear_pending_verification(tg_id: int) -> None:
-    with _lock:
-        data = _load_json(PENDING_FILE, {})
-        data.pop(str(tg_id), None)
-        _save_json(PENDING_FILE, data)
+
+def pending_stats() -> Dict[str, Any]:
+    """Live vs. expired record counts (overall and per status) plus compaction counters."""
+    counts = _count_pending((info for _, info in iter_pending_verifications(include_expired=True)), time.time())
+    counts["compaction"] = dict(_compaction_stats)
+    return counts
+
+
+def _compaction_loop(interval: float) -> None:
+    while True:
+        time.sleep(interval)
+        try:
+            purged = compact_pending_verifications()
+            if purged:
+                log.info("Purged expired pending verifications", extra={"purged": purged})
+        except Exception:
+            log.exception("Pending verification compaction failed")
+
+
+def start_background_compaction(interval: float = STORAGE_COMPACT_INTERVAL) -> bool:
+    """
+    Start the compaction task in this process (once). Does nothing when no TTL
+    is configured. Returns whether the task is running.
+    """
+    global _compaction_thread
+    if PENDING_TTL_SECONDS <= 0 and not any(ttl > 0 for ttl in PENDING_TTL_BY_STATUS.values()):
+        return False
+    if _compaction_thread is None or not _compaction_thread.is_alive():
+        _compaction_thread = threading.Thread(
+            target=_compaction_loop, args=(interval,), name="storage-compaction", daemon=True
+        )
+        _compaction_thread.start()
+    return True
 
 
 def append_trial_log(record: Dict[str, Any]) -> None:
-    with _lock:
-        records: List[Dict[str, Any]] = _load_json(TRIAL_LOG_FILE, [])
-        records.append(record)
-        _save_json(TRIAL_LOG_FILE, records)
+    """
+    Append one record to the trial log. On the JSON backend this is a single
+    O_APPEND write + fsync, independent of how large the history is.
+    """
+    if STORAGE_BACKEND == "sqlite":
+        _db().execute("INSERT INTO trial_log (data) VALUES (?)", (json.dumps(record, ensure_ascii=False),))
+        return
+    line = (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+    # The append itself is atomic (O_APPEND); the file lock keeps a rotation
+    # in another worker from racing with it.
+    with _path_lock(TRIAL_LOG_FILE), _file_lock(TRIAL_LOG_FILE):
+        convert_legacy_trial_log()
+        _maybe_rotate_trial_log()
+        fd = os.open(TRIAL_LOG_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _maybe_rotate_trial_log() -> None:
+    try:
+        st = os.stat(TRIAL_LOG_FILE)
+    except FileNotFoundError:
+        return
+    too_big = TRIAL_LOG_MAX_BYTES > 0 and st.st_size >= TRIAL_LOG_MAX_BYTES
+    now = time.time()
+    too_old = TRIAL_LOG_ROTATE_SECONDS > 0 and int(st.st_mtime // TRIAL_LOG_ROTATE_SECONDS) < int(now // TRIAL_LOG_ROTATE_SECONDS)
+    if not (too_big or too_old):
+        return
+    suffix = datetime.fromtimestamp(now, timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    try:
+        os.rename(TRIAL_LOG_FILE, f"{TRIAL_LOG_FILE}.{suffix}")
+    except FileNotFoundError:
+        pass  # another worker rotated it first
+
+
+def convert_legacy_trial_log() -> int:
+    """
+    Move records from the old trial_users.json list format into the JSONL log.
+    Each conversion becomes its own segment sorting before every rotated one,
+    so ordering is preserved and earlier conversions are never overwritten.
+    Safe to call repeatedly / from several workers: the legacy file is claimed
+    with an atomic rename, then converted under an flock on the claimed file.
+    A claimed file nobody holds the lock on belongs to a converter that died
+    and is converted again. Returns the number of converted records.
+    """
+    global _abandoned_checked_pid
+    claims = []
+    if os.path.exists(LEGACY_TRIAL_LOG_FILE):
+        claimed = f"{LEGACY_TRIAL_LOG_FILE}.converting.{os.getpid()}.{threading.get_ident()}"
+        try:
+            os.rename(LEGACY_TRIAL_LOG_FILE, claimed)
+            claims.append(claimed)
+        except FileNotFoundError:
+            pass  # claimed by another worker
+    if fcntl is not None and _abandoned_checked_pid != os.getpid():
+        # Once per process: pick up files whose converter died mid-way
+        _abandoned_checked_pid = os.getpid()
+        claims += sorted(glob.glob(glob.escape(LEGACY_TRIAL_LOG_FILE) + ".converting.*"))
+    converted = 0
+    for claimed in dict.fromkeys(claims):
+        fd = _lock_claim(claimed)
+        if fd is None:
+            continue
+        try:
+            converted += _convert_claimed(claimed)
+        finally:
+            os.close(fd)  # also releases the lock
+    return converted
+
+
+def _lock_claim(path: str) -> Optional[int]:
+    """
+    fd holding an exclusive flock on a claimed legacy log, or None if a live
+    converter holds it or it was finished and moved away meanwhile. The lock
+    dies with its process, which is what marks a claim as abandoned.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if os.stat(path).st_ino == os.fstat(fd).st_ino:
+            return fd
+    except OSError:
+        pass
+    os.close(fd)
+    return None
+
+
+def _convert_claimed(claimed: str) -> int:
+    records = _load_json(claimed, [])
+    payload = "".join(
+        json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n" for record in records
+    ).encode("utf-8")
+    prefix = f"{TRIAL_LOG_FILE}.00000000T"
+    existing = sorted(glob.glob(glob.escape(prefix) + "*"))
+    existing = [path for path in existing if _TRIAL_SEGMENT_SUFFIX.search(path)]
+    # A retry after a crash that came after the segment was written must not
+    # add the records a second time
+    if payload and not any(_file_equals(path, payload) for path in existing):
+        tmp_path = f"{TRIAL_LOG_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        index = int(existing[-1][-12:]) + 1 if existing else 0
+        # link() never replaces an existing name, unlike rename()
+        while True:
+            try:
+                os.link(tmp_path, f"{prefix}{index:012d}")
+                break
+            except FileExistsError:
+                index += 1
+        os.unlink(tmp_path)
+        _fsync_dir(os.path.dirname(TRIAL_LOG_FILE) or ".")
+    backup, index = f"{LEGACY_TRIAL_LOG_FILE}.converted", 0
+    while True:
+        try:
+            os.link(claimed, backup)
+            break
+        except FileExistsError:
+            index += 1
+            backup = f"{LEGACY_TRIAL_LOG_FILE}.converted.{index}"
+    os.unlink(claimed)
+    return len(records)
+
+
+def _file_equals(path: str, payload: bytes) -> bool:
+    try:
+        if os.path.getsize(path) != len(payload):
+            return False
+        with open(path, "rb") as f:
+            return f.read() == payload
+    except FileNotFoundError:
+        return False
+
+
+def _iter_trial_log_files() -> Iterator[Dict[str, Any]]:
+    """Stream records from the rotated JSONL segments (oldest first), then the live file."""
+    candidates = glob.glob(glob.escape(TRIAL_LOG_FILE) + ".*")
+    segments = sorted(path for path in candidates if _TRIAL_SEGMENT_SUFFIX.search(path))
+    for path in segments + [TRIAL_LOG_FILE]:
+        try:
+            f = open(path, "r", encoding="utf-8")
+        except FileNotFoundError:
+            continue
+        with f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue  # torn / partial line
+
+
+def _parse_time(value: Any) -> Optional[datetime]:
+    if isinstance(value, datetime):
+        parsed = value
+    elif isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    else:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def iter_trial_log(
+    since: Optional[Union[datetime, str]] = None,
+    until: Optional[Union[datetime, str]] = None,
+    time_field: str = "created_at",
+) -> Iterator[Dict[str, Any]]:
+    """
+    Stream trial log records, oldest first, without loading the whole history.
+    `since` (inclusive) / `until` (exclusive) filter on the record's
+    `time_field`; records without a parseable timestamp are skipped when a
+    filter is given.
+    """
+    if STORAGE_BACKEND == "sqlite":
+        records: Iterator[Dict[str, Any]] = (
+            json.loads(row[0]) for row in _db().execute("SELECT data FROM trial_log ORDER BY id")
+        )
+    else:
+        convert_legacy_trial_log()
+        records = _iter_trial_log_files()
+
+    start = _parse_time(since)
+    end = _parse_time(until)
+    for record in records:
+        if start is not None or end is not None:
+            ts = _parse_time(record.get(time_field))
+            if ts is None or (start is not None and ts < start) or (end is not None and ts >= end):
+                continue
+        yield record
+
+
+def export_trial_log(
+    out: IO[str],
+    since: Optional[Union[datetime, str]] = None,
+    until: Optional[Union[datetime, str]] = None,
+    fmt: str = "jsonl",
+) -> int:
+    """Write (optionally date-filtered) trial log records to `out` as jsonl or csv. Returns the record count."""
+    count = 0
+    if fmt == "csv":
+        # Records gain fields over time, so the header is the union of every
+        # record's keys (first-seen order); costs a second streaming pass
+        fieldnames: Dict[str, None] = {}
+        for record in iter_trial_log(since, until):
+            fieldnames.update(dict.fromkeys(record))
+        if not fieldnames:
+            return 0
+        writer = csv.DictWriter(out, fieldnames=list(fieldnames), extrasaction="ignore")
+        writer.writeheader()
+        for record in iter_trial_log(since, until):
+            writer.writerow(record)
+            count += 1
+        return count
+    for record in iter_trial_log(since, until):
+        out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
 
+if __name__ == "__main__":
+    # One-shot migration of the JSON files into SQLite:
+    #   STORAGE_DB_FILE=/data/storage.sqlite3 python storage.py migrate
+    import sys
 
+    setup_logging()
+    if sys.argv[1:2] == ["reshard"] and len(sys.argv) == 3:
+        # python storage.py reshard 8   (safe while the app is running)
+        reshard(int(sys.argv[2]))
+    elif sys.argv[1:2] == ["convert-codec"] and len(sys.argv) == 3:
+        # python storage.py convert-codec msgpack   (also set STORAGE_CODEC for the app)
+        print(f"Rewrote {convert_codec(sys.argv[2])} file(s) as {sys.argv[2]}")
+    elif sys.argv[1:] == ["migrate"]:
+        migrated = migrate_json_to_sqlite()
+        print("Migration done." if migrated else "Database was already migrated.")
+    elif sys.argv[1:2] == ["export-trials"]:
+        # python storage.py export-trials [jsonl|csv] [since] [until] > out
+        args = sys.argv[2:] + [None] * 3
+        export_trial_log(sys.stdout, since=args[1], until=args[2], fmt=args[0] or "jsonl")
+    else:
+        print(
+            "Usage: python storage.py migrate | reshard N | convert-codec CODEC"
+            " | export-trials [jsonl|csv] [since] [until]"
+        )
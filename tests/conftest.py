@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    """The storage module, with every file it touches moved into tmp_path (JSON backend)."""
+    import storage
+
+    base = str(tmp_path)
+    pending_file = os.path.join(base, "pending_verifications.json")
+    monkeypatch.setattr(storage, "BASE_DIR", base)
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", "json")
+    monkeypatch.setattr(storage, "PENDING_FILE", pending_file)
+    monkeypatch.setattr(storage, "PENDING_LAYOUT_FILE", f"{pending_file}.layout")
+    monkeypatch.setattr(storage, "TRIAL_LOG_FILE", os.path.join(base, "trial_users.jsonl"))
+    monkeypatch.setattr(storage, "LEGACY_TRIAL_LOG_FILE", os.path.join(base, "trial_users.json"))
+    monkeypatch.setattr(storage, "STORAGE_DB_FILE", os.path.join(base, "storage.sqlite3"))
+    monkeypatch.setattr(storage, "_abandoned_checked_pid", None)
+    monkeypatch.setattr(storage, "_layout_state", None)
+    storage._committers.clear()
+    storage._file_cache.clear()
+    yield storage
+    storage._committers.clear()
+    storage._file_cache.clear()
@@ -0,0 +1,108 @@
+import multiprocessing
+import threading
+
+import pytest
+
+RECORD = {"status": "pending", "created_at": "2099-01-01T00:00:00+00:00"}
+
+
+def _stored_ids(storage):
+    # Straight from disk, not from this process' cache
+    storage._file_cache.clear()
+    storage._layout_state = None
+    return {tg_id for tg_id, _ in storage.iter_pending_verifications(include_expired=True)}
+
+
+def _write_range(storage, start, count):
+    for tg_id in range(start, start + count):
+        assert storage.set_pending_verification(tg_id, RECORD)
+
+
+def _fork_writers(storage, processes, per_process):
+    try:
+        context = multiprocessing.get_context("fork")
+    except ValueError:
+        pytest.skip("needs fork()")
+    workers = [
+        context.Process(target=_write_range, args=(storage, 1000 * (i + 1), per_process)) for i in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def _join(workers):
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+
+
+def test_concurrent_threads_lose_no_writes(storage, monkeypatch):
+    monkeypatch.setattr(storage, "STORAGE_COMMIT_WINDOW_MS", 1.0)
+    threads = [threading.Thread(target=_write_range, args=(storage, 1000 * (i + 1), 50)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert _stored_ids(storage) == {1000 * (i + 1) + n for i in range(8) for n in range(50)}
+    committer = storage._committer(storage.PENDING_FILE)
+    assert committer.writes == 400
+    assert committer.flushes < committer.writes  # writes were actually grouped
+    assert not committer._flushing
+
+
+def test_interrupted_leader_steps_down_and_fails_queued_writes(storage):
+    committer = storage._committer(storage.PENDING_FILE)
+    flushing, release = threading.Event(), threading.Event()
+    real_flush = committer._flush
+
+    def interrupted_flush(batch):
+        flushing.set()
+        release.wait(10)
+        raise KeyboardInterrupt
+
+    committer._flush = interrupted_flush
+    leader_error = []
+
+    def lead():
+        try:
+            committer.submit("set", "1", RECORD)
+        except BaseException as e:
+            leader_error.append(e)
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    assert flushing.wait(10)
+    queued = committer.submit("set", "2", RECORD)  # arrives mid-flush: queued behind the leader
+    release.set()
+    leader.join(10)
+
+    assert isinstance(leader_error[0], KeyboardInterrupt)
+    assert not committer._flushing
+    with pytest.raises(RuntimeError):
+        queued.result(timeout=10)
+
+    committer._flush = real_flush
+    assert committer.submit("set", "3", RECORD).result(timeout=10)
+    assert _stored_ids(storage) == {3}
+
+
+@pytest.mark.parametrize("shards", [1, 4])
+def test_concurrent_processes_lose_no_writes(storage, shards):
+    if shards > 1:
+        storage.reshard(shards)
+    _join(_fork_writers(storage, processes=4, per_process=100))
+
+    assert _stored_ids(storage) == {1000 * (i + 1) + n for i in range(4) for n in range(100)}
+
+
+def test_online_reshard_under_concurrent_writers_loses_no_writes(storage):
+    storage.set_pending_verification(1, RECORD)
+    workers = _fork_writers(storage, processes=4, per_process=200)
+    for count in (4, 2, 3):
+        storage.reshard(count)
+    _join(workers)
+
+    assert storage._shard_count() == 3
+    assert _stored_ids(storage) == {1} | {1000 * (i + 1) + n for i in range(4) for n in range(200)}
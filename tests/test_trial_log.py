@@ -0,0 +1,82 @@
+import io
+import json
+import os
+
+import pytest
+
+
+def _write_legacy(path, records):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(records, f)
+
+
+def _all(storage):
+    return list(storage.iter_trial_log())
+
+
+def test_successive_conversions_keep_earlier_history(storage):
+    _write_legacy(storage.LEGACY_TRIAL_LOG_FILE, [{"n": 1}, {"n": 2}])
+    storage.append_trial_log({"n": 3})
+    _write_legacy(storage.LEGACY_TRIAL_LOG_FILE, [{"n": 4}])
+    storage.append_trial_log({"n": 5})
+
+    assert _all(storage) == [{"n": 1}, {"n": 2}, {"n": 4}, {"n": 3}, {"n": 5}]
+    with open(f"{storage.LEGACY_TRIAL_LOG_FILE}.converted", encoding="utf-8") as f:
+        assert json.load(f) == [{"n": 1}, {"n": 2}]
+    with open(f"{storage.LEGACY_TRIAL_LOG_FILE}.converted.1", encoding="utf-8") as f:
+        assert json.load(f) == [{"n": 4}]
+
+
+def test_abandoned_claim_is_converted_alongside_a_new_legacy_file(storage):
+    # pid 1: a live pid in every container, so liveness can't be the test
+    _write_legacy(f"{storage.LEGACY_TRIAL_LOG_FILE}.converting.1", [{"n": 1}])
+    _write_legacy(storage.LEGACY_TRIAL_LOG_FILE, [{"n": 2}])
+
+    assert storage.convert_legacy_trial_log() == 2
+    assert sorted(record["n"] for record in _all(storage)) == [1, 2]
+    assert not [name for name in os.listdir(storage.BASE_DIR) if ".converting." in name]
+
+
+def test_claim_held_by_a_live_converter_is_left_alone(storage):
+    fcntl = pytest.importorskip("fcntl")
+    claimed = f"{storage.LEGACY_TRIAL_LOG_FILE}.converting.1"
+    _write_legacy(claimed, [{"n": 1}])
+    fd = os.open(claimed, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        assert storage.convert_legacy_trial_log() == 0
+    finally:
+        os.close(fd)
+    assert os.path.exists(claimed)
+    assert _all(storage) == []
+
+
+def test_retry_after_a_crash_does_not_duplicate_records(storage):
+    claimed = f"{storage.LEGACY_TRIAL_LOG_FILE}.converting.1"
+    _write_legacy(claimed, [{"n": 1}])
+    # The crashed converter had already written its segment
+    with open(f"{storage.TRIAL_LOG_FILE}.00000000T000000000000", "w", encoding="utf-8") as f:
+        f.write('{"n":1}\n')
+
+    storage.convert_legacy_trial_log()
+    assert _all(storage) == [{"n": 1}]
+    assert not os.path.exists(claimed)
+
+
+def test_only_rotated_segments_are_read(storage):
+    storage.append_trial_log({"n": 2})
+    with open(f"{storage.TRIAL_LOG_FILE}.20240101T000000000000", "w", encoding="utf-8") as f:
+        f.write('{"n":1}\n')
+    with open(f"{storage.TRIAL_LOG_FILE}.stray", "w", encoding="utf-8") as f:
+        f.write('{"n":9}\n')
+
+    assert _all(storage) == [{"n": 1}, {"n": 2}]
+
+
+def test_csv_header_is_the_union_of_record_keys(storage):
+    storage.append_trial_log({"a": 1})
+    storage.append_trial_log({"a": 2, "b": 3})
+
+    out = io.StringIO()
+    assert storage.export_trial_log(out, fmt="csv") == 2
+    assert out.getvalue().splitlines() == ["a,b", "1,", "2,3"]
@@ -0,0 +1,291 @@
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextvars import ContextVar, Token
+from functools import wraps
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+import requests
+
+from metrics import TRACE_SPANS_DROPPED
+
+log = logging.getLogger(__name__)
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+# Where finished spans go: "" (tracing off), "file" (JSON lines in TRACE_FILE)
+# or "otlp" (OTLP/HTTP JSON, e.g. an OpenTelemetry Collector or Jaeger)
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "").lower()
+TRACE_FILE = os.environ.get("TRACE_FILE", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.environ.get("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+# Share of requests traced. The decision is made once per request, so a trace
+# is always complete; untraced requests skip every span.
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "1"))
+# Finished spans waiting for the exporter thread; further spans are dropped
+TRACE_QUEUE_SIZE = int(os.environ.get("TRACE_QUEUE_SIZE", "10000"))
+# Spans per export batch, and the longest a span waits for its batch (seconds)
+TRACE_BATCH_SIZE = int(os.environ.get("TRACE_BATCH_SIZE", "512"))
+TRACE_FLUSH_INTERVAL = float(os.environ.get("TRACE_FLUSH_INTERVAL", "2"))
+# service.name resource attribute on exported spans
+TRACE_SERVICE_NAME = os.environ.get("TRACE_SERVICE_NAME", "add-remove")
+
+# Innermost open span of the request being handled in this thread / task
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+_queue: "queue.Queue[Span]" = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+_exporter: Optional[threading.Thread] = None
+_exporter_lock = threading.Lock()
+
+
+class Span:
+    """One timed phase of a request. Times are Unix nanoseconds."""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start_ns", "end_ns", "attributes", "error", "kind", "_token")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]) -> None:
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = attributes
+        self.error: Optional[str] = None
+        # OTLP span kind: 1 INTERNAL (a phase), 2 SERVER (a request)
+        self.kind = 1
+        self._token: Optional[Token] = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "duration_us": (self.end_ns - self.start_ns) // 1000,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+def _parse_traceparent(header: Optional[str]) -> Optional[tuple]:
+    """(trace_id, parent span_id) from a W3C traceparent header, if valid."""
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2]
+
+
+def start_trace(name: str, traceparent: Optional[str] = None, **attributes: Any) -> Optional[Span]:
+    """
+    Open the root span of a request and make it current, or return None when
+    tracing is off or the request isn't sampled. Close it with finish_trace().
+    An incoming traceparent header joins the caller's trace.
+    """
+    if not TRACE_EXPORTER or (TRACE_SAMPLE_RATE < 1 and random.random() >= TRACE_SAMPLE_RATE):
+        return None
+    parent = _parse_traceparent(traceparent)
+    trace_id, parent_id = parent if parent else (f"{random.getrandbits(128):032x}", None)
+    root = Span(name, trace_id, parent_id, attributes)
+    root.kind = 2
+    root._token = _current_span.set(root)
+    return root
+
+
+def finish_trace(root: Optional[Span], error: Optional[str] = None, **attributes: Any) -> None:
+    if root is None:
+        return
+    root.attributes.update(attributes)
+    if error:
+        root.error = error
+    if root._token is not None:
+        try:
+            _current_span.reset(root._token)
+        except ValueError:  # finished in another context (e.g. a streamed response)
+            pass
+    _finish(root)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+class span:
+    """
+    `with span("storage.set", path=p):` - time a phase as a child of the
+    current span. Outside a traced request it does nothing.
+    """
+
+    __slots__ = ("name", "attributes", "_span")
+
+    def __init__(self, name: str, **attributes: Any) -> None:
+        self.name = name
+        self.attributes = attributes
+        self._span: Optional[Span] = None
+
+    def __enter__(self) -> Optional[Span]:
+        parent = _current_span.get()
+        if parent is not None:
+            self._span = Span(self.name, parent.trace_id, parent.span_id, self.attributes)
+            self._span._token = _current_span.set(self._span)
+        return self._span
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        child = self._span
+        if child is None:
+            return
+        if exc_type is not None:
+            child.error = f"{exc_type.__name__}: {exc}"
+        _current_span.reset(child._token)
+        _finish(child)
+
+
+def traced(name: str) -> Callable[[F], F]:
+    """Decorator form of span(), for functions called on traced request paths."""
+
+    def decorate(fn: F) -> F:
+        @wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if _current_span.get() is None:
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorate
+
+
+class _TimedAcquire:
+    __slots__ = ("lock", "name", "attributes")
+
+    def __init__(self, lock: Any, name: str, attributes: Dict[str, Any]) -> None:
+        self.lock = lock
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self) -> None:
+        with span(self.name, **self.attributes):
+            self.lock.acquire()
+
+    def __exit__(self, *exc: Any) -> None:
+        self.lock.release()
+
+
+def traced_lock(lock: Any, name: str, **attributes: Any) -> Any:
+    """
+    `with traced_lock(lock, "storage.lock_wait"):` - like `with lock:`, plus a
+    span covering the time spent waiting for it. Untraced, it *is* `lock`.
+    """
+    if _current_span.get() is None:
+        return lock
+    return _TimedAcquire(lock, name, attributes)
+
+
+def _finish(finished: Span) -> None:
+    finished.end_ns = time.time_ns()
+    _ensure_exporter()
+    try:
+        _queue.put_nowait(finished)
+    except queue.Full:
+        TRACE_SPANS_DROPPED.inc()
+
+
+def _ensure_exporter() -> None:
+    global _exporter
+    if _exporter is not None:
+        return
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = threading.Thread(target=_export_loop, name="trace-exporter", daemon=True)
+            _exporter.start()
+
+
+def _export_loop() -> None:
+    session = requests.Session() if TRACE_EXPORTER == "otlp" else None
+    while True:
+        batch = [_queue.get()]
+        deadline = time.monotonic() + TRACE_FLUSH_INTERVAL
+        while len(batch) < TRACE_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            if session is not None:
+                _export_otlp(session, batch)
+            else:
+                _export_file(batch)
+        except Exception:
+            log.exception("Trace export failed", extra={"exporter": TRACE_EXPORTER, "spans": len(batch)})
+
+
+def _export_file(batch: List[Span]) -> None:
+    payload = "".join(json.dumps(s.to_dict(), ensure_ascii=False, default=str) + "\n" for s in batch)
+    # One O_APPEND write per batch, so workers sharing the file don't interleave lines
+    fd = os.open(TRACE_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, payload.encode("utf-8"))
+    finally:
+        os.close(fd)
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(s: Span) -> Dict[str, Any]:
+    entry: Dict[str, Any] = {
+        "traceId": s.trace_id,
+        "spanId": s.span_id,
+        "name": s.name,
+        "kind": s.kind,
+        "startTimeUnixNano": str(s.start_ns),
+        "endTimeUnixNano": str(s.end_ns),
+        "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in s.attributes.items()],
+        "status": {"code": 2, "message": s.error} if s.error else {"code": 0},
+    }
+    if s.parent_id:
+        entry["parentSpanId"] = s.parent_id
+    return entry
+
+
+def _export_otlp(session: requests.Session, batch: List[Span]) -> None:
+    body = {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}},
+                        {"key": "process.pid", "value": {"intValue": str(os.getpid())}},
+                    ]
+                },
+                "scopeSpans": [{"scope": {"name": "tracing"}, "spans": [_otlp_span(s) for s in batch]}],
+            }
+        ]
+    }
+    response = session.post(TRACE_OTLP_ENDPOINT, json=body, timeout=5)
+    response.raise_for_status()
@@ -1,24 +1,89 @@
 from datetime import datetime, timezone
-from typing import Optional
+from typing import Any, Dict, Mapping, Optional, Tuple
 
+import hmac
+import json
+import logging
 import os
-import requests
+import threading
+import time
+import urllib.parse
 from dotenv import load_dotenv
-from flask import Flask, request, render_template_string, jsonify
+from flask import Flask, Response, g, request, jsonify
+from markupsafe import escape
 
-from storage import set_pending_verification, get_pending_verification
-
-
-# Load .env if present
+# Load .env if present. This must run before the local imports below, since
+# those modules read their settings from the environment at import time.
 load_dotenv()
 
+from logs import request_id_from, request_id_var, setup_logging
+
+setup_logging()
+
+from assets import asset_response, asset_url
+from events import feed_stats, publish, start_webhook_dispatcher, wait_for_events
+from ip_cache import MISS, SingleFlight, make_ip_cache
+from ip_client import IP2LocationClient
+from ip_database import load_local_ip_database
+from metrics import HTTP_LATENCY, HTTP_REQUESTS, IP_BLOCKS, IP_CACHE_REQUESTS, RENDER_LATENCY, render_metrics
+from profiler import PROFILE_MAX_SECONDS, ProfilerBusy, folded, sample_stacks
+from storage import (
+    get_pending_verification,
+    get_pending_verifications,
+    has_passed_step1,
+    list_pending_verifications,
+    pending_stats,
+    set_pending_verification,
+    start_background_compaction,
+)
+from tracing import finish_trace, span, start_trace
+
+log = logging.getLogger(__name__)
+
 IP2LOCATION_API_KEY = os.environ.get("IP2LOCATION_API_KEY", "")
 # Blocked country code (e.g., "IN" for India, "PK" for Pakistan)
 # Set via environment variable, defaults to "PK" for testing
 BLOCKED_COUNTRY_CODE = os.environ.get("BLOCKED_COUNTRY_CODE", "PK").upper()
+# Where IP verdicts come from, in order: "api" (IP2Location.io), "local"
+# (range files from IP_DATABASE_PATH) or e.g. "local,api" to use the API only
+# when the local files don't cover the IP or have no proxy data
+IP_LOOKUP_PROVIDERS = [p.strip() for p in os.environ.get("IP_LOOKUP_PROVIDER", "api").lower().split(",") if p.strip()]
+# How long a browser may reuse a positive /check-step1 answer (seconds)
+CHECK_STEP1_MAX_AGE = int(os.environ.get("CHECK_STEP1_MAX_AGE", "60"))
+# Most tg_ids accepted by one /api/get-verifications call, and the largest page size
+BATCH_MAX_IDS = int(os.environ.get("BATCH_MAX_IDS", "1000"))
+# Shared secret the bot sends as "Authorization: Bearer <secret>" to the bulk
+# bot endpoints; they answer 401 to everyone while it is unset
+BOT_API_SECRET = os.environ.get("BOT_API_SECRET", "")
+# Longest a /api/events long-poll waits, and how long one /api/events/stream
+# connection is kept open before the client reconnects with Last-Event-ID.
+# Each waiting client holds a worker thread, so run gunicorn with --threads.
+EVENTS_LONG_POLL_MAX_SECONDS = float(os.environ.get("EVENTS_LONG_POLL_MAX_SECONDS", "30"))
+EVENTS_STREAM_MAX_SECONDS = float(os.environ.get("EVENTS_STREAM_MAX_SECONDS", "300"))
+# Most /api/events long-polls and streams one worker holds at once; more get
+# 503. Keep it well below gunicorn's --threads so /trial always has threads.
+EVENTS_MAX_WAITERS = int(os.environ.get("EVENTS_MAX_WAITERS", "2"))
+# Bearer token for /admin/* and /api/storage-stats; they answer 404 while it is unset
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
 
 app = Flask(__name__)
 
+# Purge expired pending verifications off the request path (no-op without a TTL)
+start_background_compaction()
+# Push step-1 completions to the bot (no-op unless BOT_WEBHOOK_URL is set)
+start_webhook_dispatcher()
+
+# Threads currently held by /api/events waiters (see EVENTS_MAX_WAITERS)
+_event_waiters = threading.BoundedSemaphore(EVENTS_MAX_WAITERS)
+
+# Cache of IP2Location answers, per process or shared per host (see ip_cache.py for IP_CACHE_* settings)
+_ip_cache = make_ip_cache()
+# Concurrent lookups of the same IP share one upstream request
+_ip_flight = SingleFlight()
+_local_ip_db = load_local_ip_database() if "local" in IP_LOOKUP_PROVIDERS else None
+# Keep-alive connection pool to IP2Location.io (see ip_client.py for IP2LOCATION_* settings)
+_ip_client = IP2LocationClient(api_key=IP2LOCATION_API_KEY)
+
 
 def _now_utc() -> datetime:
     return datetime.now(timezone.utc)
@@ -29,36 +94,99 @@ def get_client_ip() -> str:
     Best-effort client IP extraction. If you're behind a reverse proxy
     (Cloudflare, Nginx, etc.) make sure to forward the correct header.
     """
-    forwarded_for = request.headers.get("X-Forwarded-For")
+    return client_ip_from(request.headers, request.remote_addr)
+
+
+def client_ip_from(headers: Mapping[str, str], remote_addr: Optional[str]) -> str:
+    """get_client_ip() for any framework's request headers / peer address."""
+    forwarded_for = headers.get("X-Forwarded-For")
     if forwarded_for:
         # Take the first IP in the list
         return forwarded_for.split(",")[0].strip()
-    return request.remote_addr or "0.0.0.0"
+    return remote_addr or "0.0.0.0"
 
 
 def _ip2location_lookup(ip: str) -> Optional[dict]:
     """
     Call IP2Location.io to get geolocation and proxy info.
     Docs: https://www.ip2location.io/ip2location-documentation
+    Fail open: returns None on any failure, so we won't block a user purely on API failure.
     """
-    base_url = "https://api.ip2location.io/"
-    params = {"ip": ip, "format": "json"}
-    # If you configured a key, send it; otherwise keyless (limited) mode.
-    if IP2LOCATION_API_KEY:
-        params["key"] = IP2LOCATION_API_KEY
+    return _ip_client.lookup(ip)
+
+
+def _cached_ip_lookup(ip: str) -> Optional[dict]:
+    """
+    _ip2location_lookup() behind the IP cache. Failed lookups are cached too
+    (for IP_CACHE_NEGATIVE_TTL) so an API outage doesn't stall every request.
+    """
+    data = _ip_cache.get(ip)
+    IP_CACHE_REQUESTS.labels("miss" if data is MISS else "hit").inc()
+    if data is MISS:
+        with span("ip.api_lookup"):
+            data = _ip_flight.do(ip, lambda: _fetch_and_cache(ip))
+    return data
+
+
+def _fetch_and_cache(ip: str) -> Optional[dict]:
+    data = _ip2location_lookup(ip)
+    _ip_cache.set(ip, data)
+    return data
+
+
+def _lookup_ip_data(ip: str) -> Optional[dict]:
+    """
+    Resolve IP data from the configured providers. A local answer is final when
+    it has both country and proxy information, or when the API isn't enabled
+    as a fallback.
+    """
+    data, ask_api = _local_lookup(ip)
+    if ask_api:
+        return _cached_ip_lookup(ip)
+    return data
+
+
+def _local_lookup(ip: str) -> Tuple[Optional[dict], bool]:
+    """The local database's answer, and whether the API still has to be asked."""
+    data = None
+    if _local_ip_db is not None:
+        data = _local_ip_db.lookup(ip)
+        complete = data is not None and data.get("country_code") and data.get("is_proxy") is not None
+        if complete or "api" not in IP_LOOKUP_PROVIDERS:
+            return data, False
+    return data, "api" in IP_LOOKUP_PROVIDERS
+
+
+class IPVerdict:
+    """
+    Result of a single IP2Location lookup, carrying every decision /trial needs.
+    `data` is the raw API response (None when the lookup failed).
+    """
+
+    __slots__ = ("ip", "data", "is_vpn", "country_code")
+
+    def __init__(self, ip: str, data: Optional[dict]) -> None:
+        self.ip = ip
+        self.data = data
+        self.is_vpn = _is_proxy_data(data) if data else False
+        self.country_code = (data.get("country_code") or "").upper() if data else ""
+
+    @property
+    def is_blocked_country(self) -> bool:
+        return self.data is not None and self.country_code == BLOCKED_COUNTRY_CODE
 
-    try:
-        resp = requests.get(base_url, params=params, timeout=3)
-        if not resp.ok:
-            return None
-        data = resp.json()
-        # If API returned an error object, treat as no data
-        if isinstance(data, dict) and "error" in data:
-            return None
-        return data
-    except Exception:
-        # Fail open: if the lookup fails, we won't block user purely on API failure.
-        return None
+
+def get_ip_verdict(ip: str) -> IPVerdict:
+    """
+    Look the IP up once and derive both the VPN / proxy and the country verdict.
+    On lookup failure both verdicts are False (fail open).
+    """
+    with span("trial.ip_verdict") as current:
+        verdict = IPVerdict(ip, _lookup_ip_data(ip))
+        if current is not None:
+            current.set_attribute("is_vpn", verdict.is_vpn)
+            current.set_attribute("blocked_country", verdict.is_blocked_country)
+    return verdict
 
 
 def is_blocked_country_ip(ip: str) -> bool:
@@ -66,11 +194,7 @@ def is_blocked_country_ip(ip: str) -> bool:
     Use IP2Location.io to check if IP country_code matches the blocked country.
     Blocked country is set via BLOCKED_COUNTRY_CODE environment variable.
     """
-    data = _ip2location_lookup(ip)
-    if not data:
-        return False
-    country_code = data.get("country_code", "").upper()
-    return country_code == BLOCKED_COUNTRY_CODE
+    return get_ip_verdict(ip).is_blocked_country
 
 
 def is_vpn_ip(ip: str) -> bool:
@@ -78,11 +202,11 @@ def is_vpn_ip(ip: str) -> bool:
     Use IP2Location.io proxy fields to detect VPN / proxy.
     Checks multiple indicators to catch all VPN/proxy types.
     """
-    data = _ip2location_lookup(ip)
-    if not data:
-        # If API lookup fails, be conservative and don't block
-        return False
+    return get_ip_verdict(ip).is_vpn
+
 
+def _is_proxy_data(data: dict) -> bool:
+    """Evaluate the proxy indicators of an IP2Location.io response."""
     # Check top-level is_proxy flag (available in all plans)
     # This is the most reliable indicator
     if data.get("is_proxy") is True:
@@ -142,94 +266,11 @@ TRIAL_PAGE = """
   <title>Free Trial Verification</title>
   <meta name="viewport" content="width=device-width, initial-scale=1">
   <script src="https://telegram.org/js/telegram-web-app.js"></script>
-  <style>
-  {% raw %}
-    body {
-      font-family: system-ui, -apple-system, BlinkMacSystemFont, "Segoe UI", sans-serif;
-      background: #050816;
-      color: #f3f4f6;
-      display: flex;
-      align-items: center;
-      justify-content: center;
-      min-height: 100vh;
-      margin: 0;
-      padding: 16px;
-    }
-    .card {
-      background: linear-gradient(145deg, #020617, #020617);
-      border-radius: 16px;
-      padding: 24px 20px;
-      box-shadow: 0 20px 40px rgba(15,23,42,0.8);
-      max-width: 420px;
-      width: 100%;
-      border: 1px solid rgba(148,163,184,0.4);
-    }
-    h2 {
-      margin-top: 0;
-      font-size: 1.4rem;
-    }
-    p {
-      font-size: 0.95rem;
-      line-height: 1.5;
-      color: #e5e7eb;
-    }
-    form {
-      margin-top: 16px;
-      display: flex;
-      flex-direction: column;
-      gap: 10px;
-    }
-    label {
-      font-size: 0.85rem;
-      color: #9ca3af;
-    }
-    input[type="text"],
-    input[type="email"],
-    select {
-      padding: 9px 10px;
-      border-radius: 8px;
-      border: 1px solid #4b5563;
-      background: rgba(15,23,42,0.8);
-      color: #f9fafb;
-      font-size: 0.9rem;
-      width: 100%;
-      box-sizing: border-box;
-    }
-    select {
-      cursor: pointer;
-    }
-    select option {
-      background: #020617;
-      color: #f9fafb;
-    }
-    input[type="checkbox"] {
-      margin-right: 6px;
-    }
-    button {
-      margin-top: 6px;
-      padding: 10px 12px;
-      border-radius: 999px;
-      border: none;
-      background: linear-gradient(135deg, #22c55e, #16a34a);
-      color: white;
-      font-weight: 600;
-      font-size: 0.95rem;
-      cursor: pointer;
-      box-shadow: 0 8px 20px rgba(34,197,94,0.45);
-    }
-    button:active {
-      transform: translateY(1px);
-      box-shadow: 0 4px 10px rgba(34,197,94,0.3);
-    }
-    .note {
-      font-size: 0.78rem;
-      color: #9ca3af;
-      margin-top: 10px;
-    }
-  {% endraw %}
-  </style>
+  <link rel="stylesheet" href="{{ asset_url('trial.css') }}">
+  <link rel="preload" href="{{ asset_url('countries.json') }}" as="fetch" crossorigin>
+  <script src="{{ asset_url('trial.js') }}" defer></script>
 </head>
-<body>
+<body{% if already_passed %} data-already-passed="1"{% endif %}>
   <div class="card">
     <h2>Free Trial Verification</h2>
     <p>{{ message }}</p>
@@ -246,202 +287,8 @@ TRIAL_PAGE = """
       </div>
       <div>
         <label for="country">Country</label><br>
-        <select id="country" name="country" required>
+        <select id="country" name="country" required data-options="{{ asset_url('countries.json') }}">
           <option value="">Select your country</option>
-          <option value="Afghanistan">Afghanistan</option>
-          <option value="Albania">Albania</option>
-          <option value="Algeria">Algeria</option>
-          <option value="Andorra">Andorra</option>
-          <option value="Angola">Angola</option>
-          <option value="Antigua and Barbuda">Antigua and Barbuda</option>
-          <option value="Argentina">Argentina</option>
-          <option value="Armenia">Armenia</option>
-          <option value="Australia">Australia</option>
-          <option value="Austria">Austria</option>
-          <option value="Azerbaijan">Azerbaijan</option>
-          <option value="Bahamas">Bahamas</option>
-          <option value="Bahrain">Bahrain</option>
-          <option value="Bangladesh">Bangladesh</option>
-          <option value="Barbados">Barbados</option>
-          <option value="Belarus">Belarus</option>
-          <option value="Belgium">Belgium</option>
-          <option value="Belize">Belize</option>
-          <option value="Benin">Benin</option>
-          <option value="Bhutan">Bhutan</option>
-          <option value="Bolivia">Bolivia</option>
-          <option value="Bosnia and Herzegovina">Bosnia and Herzegovina</option>
-          <option value="Botswana">Botswana</option>
-          <option value="Brazil">Brazil</option>
-          <option value="Brunei">Brunei</option>
-          <option value="Bulgaria">Bulgaria</option>
-          <option value="Burkina Faso">Burkina Faso</option>
-          <option value="Burundi">Burundi</option>
-          <option value="Cambodia">Cambodia</option>
-          <option value="Cameroon">Cameroon</option>
-          <option value="Canada">Canada</option>
-          <option value="Cape Verde">Cape Verde</option>
-          <option value="Central African Republic">Central African Republic</option>
-          <option value="Chad">Chad</option>
-          <option value="Chile">Chile</option>
-          <option value="China">China</option>
-          <option value="Colombia">Colombia</option>
-          <option value="Comoros">Comoros</option>
-          <option value="Congo">Congo</option>
-          <option value="Costa Rica">Costa Rica</option>
-          <option value="Croatia">Croatia</option>
-          <option value="Cuba">Cuba</option>
-          <option value="Cyprus">Cyprus</option>
-          <option value="Czech Republic">Czech Republic</option>
-          <option value="Denmark">Denmark</option>
-          <option value="Djibouti">Djibouti</option>
-          <option value="Dominica">Dominica</option>
-          <option value="Dominican Republic">Dominican Republic</option>
-          <option value="Ecuador">Ecuador</option>
-          <option value="Egypt">Egypt</option>
-          <option value="El Salvador">El Salvador</option>
-          <option value="Equatorial Guinea">Equatorial Guinea</option>
-          <option value="Eritrea">Eritrea</option>
-          <option value="Estonia">Estonia</option>
-          <option value="Eswatini">Eswatini</option>
-          <option value="Ethiopia">Ethiopia</option>
-          <option value="Fiji">Fiji</option>
-          <option value="Finland">Finland</option>
-          <option value="France">France</option>
-          <option value="Gabon">Gabon</option>
-          <option value="Gambia">Gambia</option>
-          <option value="Georgia">Georgia</option>
-          <option value="Germany">Germany</option>
-          <option value="Ghana">Ghana</option>
-          <option value="Greece">Greece</option>
-          <option value="Grenada">Grenada</option>
-          <option value="Guatemala">Guatemala</option>
-          <option value="Guinea">Guinea</option>
-          <option value="Guinea-Bissau">Guinea-Bissau</option>
-          <option value="Guyana">Guyana</option>
-          <option value="Haiti">Haiti</option>
-          <option value="Honduras">Honduras</option>
-          <option value="Hungary">Hungary</option>
-          <option value="Iceland">Iceland</option>
-          <option value="Indonesia">Indonesia</option>
-          <option value="Iran">Iran</option>
-          <option value="Iraq">Iraq</option>
-          <option value="Ireland">Ireland</option>
-          <option value="Israel">Israel</option>
-          <option value="Italy">Italy</option>
-          <option value="Jamaica">Jamaica</option>
-          <option value="Japan">Japan</option>
-          <option value="Jordan">Jordan</option>
-          <option value="Kazakhstan">Kazakhstan</option>
-          <option value="Kenya">Kenya</option>
-          <option value="Kiribati">Kiribati</option>
-          <option value="Kosovo">Kosovo</option>
-          <option value="Kuwait">Kuwait</option>
-          <option value="Kyrgyzstan">Kyrgyzstan</option>
-          <option value="Laos">Laos</option>
-          <option value="Latvia">Latvia</option>
-          <option value="Lebanon">Lebanon</option>
-          <option value="Lesotho">Lesotho</option>
-          <option value="Liberia">Liberia</option>
-          <option value="Libya">Libya</option>
-          <option value="Liechtenstein">Liechtenstein</option>
-          <option value="Lithuania">Lithuania</option>
-          <option value="Luxembourg">Luxembourg</option>
-          <option value="Madagascar">Madagascar</option>
-          <option value="Malawi">Malawi</option>
-          <option value="Malaysia">Malaysia</option>
-          <option value="Maldives">Maldives</option>
-          <option value="Mali">Mali</option>
-          <option value="Malta">Malta</option>
-          <option value="Marshall Islands">Marshall Islands</option>
-          <option value="Mauritania">Mauritania</option>
-          <option value="Mauritius">Mauritius</option>
-          <option value="Mexico">Mexico</option>
-          <option value="Micronesia">Micronesia</option>
-          <option value="Moldova">Moldova</option>
-          <option value="Monaco">Monaco</option>
-          <option value="Mongolia">Mongolia</option>
-          <option value="Montenegro">Montenegro</option>
-          <option value="Morocco">Morocco</option>
-          <option value="Mozambique">Mozambique</option>
-          <option value="Myanmar">Myanmar</option>
-          <option value="Namibia">Namibia</option>
-          <option value="Nauru">Nauru</option>
-          <option value="Nepal">Nepal</option>
-          <option value="Netherlands">Netherlands</option>
-          <option value="New Zealand">New Zealand</option>
-          <option value="Nicaragua">Nicaragua</option>
-          <option value="Niger">Niger</option>
-          <option value="Nigeria">Nigeria</option>
-          <option value="North Korea">North Korea</option>
-          <option value="North Macedonia">North Macedonia</option>
-          <option value="Norway">Norway</option>
-          <option value="Oman">Oman</option>
-          <option value="Pakistan">Pakistan</option>
-          <option value="Palau">Palau</option>
-          <option value="Palestine">Palestine</option>
-          <option value="Panama">Panama</option>
-          <option value="Papua New Guinea">Papua New Guinea</option>
-          <option value="Paraguay">Paraguay</option>
-          <option value="Peru">Peru</option>
-          <option value="Philippines">Philippines</option>
-          <option value="Poland">Poland</option>
-          <option value="Portugal">Portugal</option>
-          <option value="Qatar">Qatar</option>
-          <option value="Romania">Romania</option>
-          <option value="Russia">Russia</option>
-          <option value="Rwanda">Rwanda</option>
-          <option value="Saint Kitts and Nevis">Saint Kitts and Nevis</option>
-          <option value="Saint Lucia">Saint Lucia</option>
-          <option value="Saint Vincent and the Grenadines">Saint Vincent and the Grenadines</option>
-          <option value="Samoa">Samoa</option>
-          <option value="San Marino">San Marino</option>
-          <option value="Sao Tome and Principe">Sao Tome and Principe</option>
-          <option value="Saudi Arabia">Saudi Arabia</option>
-          <option value="Senegal">Senegal</option>
-          <option value="Serbia">Serbia</option>
-          <option value="Seychelles">Seychelles</option>
-          <option value="Sierra Leone">Sierra Leone</option>
-          <option value="Singapore">Singapore</option>
-          <option value="Slovakia">Slovakia</option>
-          <option value="Slovenia">Slovenia</option>
-          <option value="Solomon Islands">Solomon Islands</option>
-          <option value="Somalia">Somalia</option>
-          <option value="South Africa">South Africa</option>
-          <option value="South Korea">South Korea</option>
-          <option value="South Sudan">South Sudan</option>
-          <option value="Spain">Spain</option>
-          <option value="Sri Lanka">Sri Lanka</option>
-          <option value="Sudan">Sudan</option>
-          <option value="Suriname">Suriname</option>
-          <option value="Sweden">Sweden</option>
-          <option value="Switzerland">Switzerland</option>
-          <option value="Syria">Syria</option>
-          <option value="Taiwan">Taiwan</option>
-          <option value="Tajikistan">Tajikistan</option>
-          <option value="Tanzania">Tanzania</option>
-          <option value="Thailand">Thailand</option>
-          <option value="Timor-Leste">Timor-Leste</option>
-          <option value="Togo">Togo</option>
-          <option value="Tonga">Tonga</option>
-          <option value="Trinidad and Tobago">Trinidad and Tobago</option>
-          <option value="Tunisia">Tunisia</option>
-          <option value="Turkey">Turkey</option>
-          <option value="Turkmenistan">Turkmenistan</option>
-          <option value="Tuvalu">Tuvalu</option>
-          <option value="Uganda">Uganda</option>
-          <option value="Ukraine">Ukraine</option>
-          <option value="United Arab Emirates">United Arab Emirates</option>
-          <option value="United Kingdom">United Kingdom</option>
-          <option value="United States">United States</option>
-          <option value="Uruguay">Uruguay</option>
-          <option value="Uzbekistan">Uzbekistan</option>
-          <option value="Vanuatu">Vanuatu</option>
-          <option value="Vatican City">Vatican City</option>
-          <option value="Venezuela">Venezuela</option>
-          <option value="Vietnam">Vietnam</option>
-          <option value="Yemen">Yemen</option>
-          <option value="Zambia">Zambia</option>
-          <option value="Zimbabwe">Zimbabwe</option>
         </select>
       </div>
       <div>
@@ -463,230 +310,170 @@ TRIAL_PAGE = """
     </form>
     {% endif %}
   </div>
-  <script>
-    // Telegram Web App: Extract user ID from Telegram's API
-    // This works when opened via Web App button (web_app parameter)
-    // Falls back to query param (?tg_id=...) for testing in regular browser
-    function extractTelegramUserId() {
-      var tgIdInput = document.getElementById('tg_id');
-      if (!tgIdInput) return;
-      
-      var tgId = null;
-      
-      // Try to get from Telegram Web App API first
-      if (window.Telegram && window.Telegram.WebApp) {
-        try {
-          // Wait for initDataUnsafe to be available
-          if (window.Telegram.WebApp.initDataUnsafe) {
-            var user = window.Telegram.WebApp.initDataUnsafe.user;
-            if (user && user.id) {
-              tgId = user.id.toString();
-              tgIdInput.value = tgId;
-              // Also set backup field
-              var backupInput = document.getElementById('tg_id_backup');
-              if (backupInput) {
-                backupInput.value = tgId;
-              }
-              // Expand the Web App to full height for better UX
-              window.Telegram.WebApp.expand();
-              
-              // Check if user already passed step1 (after extracting tg_id)
-              checkIfAlreadyPassed(tgId);
-              return;
-            }
-          }
-        } catch (e) {
-          console.log('Telegram Web App API not fully initialized yet');
-        }
-      }
-      
-      // Fallback: try to get from URL query parameter (for testing in browser)
-      var urlParams = new URLSearchParams(window.location.search);
-      var tgIdFromUrl = urlParams.get('tg_id');
-      if (tgIdFromUrl) {
-        tgId = tgIdFromUrl;
-        tgIdInput.value = tgId;
-        // Also set backup field
-        var backupInput = document.getElementById('tg_id_backup');
-        if (backupInput) {
-          backupInput.value = tgId;
-        }
-        checkIfAlreadyPassed(tgId);
-      }
-    }
-    
-    // Check if user already passed step1 and show message/close Web App
-    function checkIfAlreadyPassed(tgId) {
-      if (!tgId) return;
-      
-      // Check with server if user already passed step1
-      fetch('/check-step1?tg_id=' + tgId)
-        .then(response => response.json())
-        .then(data => {
-          if (data.already_passed) {
-            // Show message and close Web App
-            var card = document.querySelector('.card');
-            if (card) {
-              card.innerHTML = '<h2>Free Trial Verification</h2><p>✅ You have already passed Step 1 verification!<br><br>Please close this window and tap \'Continue verification\' button in Telegram to proceed with Step 2.</p>';
-            }
-            
-            // Close Web App after 3 seconds
-            if (window.Telegram && window.Telegram.WebApp) {
-              setTimeout(function() {
-                window.Telegram.WebApp.close();
-              }, 3000);
-            }
-          }
-        })
-        .catch(err => {
-          // Silently fail - don't block user if check fails
-          console.log('Could not check step1 status:', err);
-        });
-    }
-    
-    // Run when page loads - try multiple times to ensure extraction
-    function initTelegramId() {
-      extractTelegramUserId();
-      
-      // Keep trying until we get tg_id or timeout
-      var attempts = 0;
-      var maxAttempts = 20; // Try for up to 10 seconds (20 * 500ms)
-      var checkInterval = setInterval(function() {
-        var tgIdInput = document.getElementById('tg_id');
-        if (tgIdInput && tgIdInput.value) {
-          clearInterval(checkInterval);
-          console.log('Telegram ID extracted:', tgIdInput.value);
-        } else {
-          extractTelegramUserId();
-          attempts++;
-          if (attempts >= maxAttempts) {
-            clearInterval(checkInterval);
-            console.log('Could not extract Telegram ID after multiple attempts');
-          }
-        }
-      }, 500);
-    }
-    
-    if (document.readyState === 'loading') {
-      document.addEventListener('DOMContentLoaded', initTelegramId);
-    } else {
-      initTelegramId();
-    }
-    
-    // Form validation - ensure tg_id is set before submission
-    function validateForm(event) {
-      if (event) {
-        event.preventDefault(); // Prevent immediate submission
-      }
-      
-      var tgIdInput = document.getElementById('tg_id');
-      var errorDiv = document.getElementById('error-message');
-      var loadingDiv = document.getElementById('loading-indicator');
-      
-      if (!tgIdInput) {
-        if (errorDiv) {
-          errorDiv.textContent = 'Form error. Please refresh the page.';
-          errorDiv.style.display = 'block';
-        }
-        return false;
-      }
-      
-      // Show loading indicator
-      if (loadingDiv) {
-        loadingDiv.style.display = 'block';
-      }
-      if (errorDiv) {
-        errorDiv.style.display = 'none';
-      }
-      
-      // Always try to extract tg_id one more time before submission
-      extractTelegramUserId();
-      
-      // Function to check and submit if ready
-      function checkAndSubmit() {
-        if (!tgIdInput.value) {
-          // Still no tg_id - try one more time
-          extractTelegramUserId();
-          
-          if (!tgIdInput.value) {
-            // Failed to get tg_id
-            if (loadingDiv) {
-              loadingDiv.style.display = 'none';
-            }
-            if (errorDiv) {
-              errorDiv.textContent = 'Unable to verify your Telegram account. Please make sure you opened this page from Telegram and try again.';
-              errorDiv.style.display = 'block';
-            }
-            return false;
-          }
-        }
-        
-        // Verify tg_id is a valid number
-        if (!/^\\d+$/.test(tgIdInput.value)) {
-          if (loadingDiv) {
-            loadingDiv.style.display = 'none';
-          }
-          if (errorDiv) {
-            errorDiv.textContent = 'Invalid Telegram account. Please open this page from Telegram.';
-            errorDiv.style.display = 'block';
-          }
-          return false;
-        }
-        
-        // tg_id is valid - submit the form
-        if (loadingDiv) {
-          loadingDiv.style.display = 'none';
-        }
-        document.getElementById('trial-form').submit();
-        return true;
-      }
-      
-      // Wait a moment for extraction, then check
-      setTimeout(checkAndSubmit, 300);
-      return false; // Prevent immediate submission
-    }
-    
-    // Also extract tg_id when form is shown (not just on submit)
-    // This ensures it's ready before user fills the form
-    if (document.readyState === 'loading') {
-      document.addEventListener('DOMContentLoaded', function() {
-        extractTelegramUserId();
-        // Keep trying until we get it
-        var attempts = 0;
-        var checkInterval = setInterval(function() {
-          var tgIdInput = document.getElementById('tg_id');
-          if (tgIdInput && tgIdInput.value) {
-            clearInterval(checkInterval);
-          } else {
-            extractTelegramUserId();
-            attempts++;
-            if (attempts > 10) {
-              clearInterval(checkInterval);
-            }
-          }
-        }, 500);
-      });
-    } else {
-      extractTelegramUserId();
-    }
-    
-    // Close Web App if user already passed step1
-    {% if already_passed %}
-    if (window.Telegram && window.Telegram.WebApp) {
-      // Close the Web App after showing message
-      setTimeout(function() {
-        window.Telegram.WebApp.close();
-      }, 3000); // Close after 3 seconds
-    }
-    {% endif %}
-  </script>
 </body>
 </html>
 """
 
 
+# TRIAL_PAGE is compiled once and rendered once per (show_form, already_passed)
+# combination around a placeholder; a request only escapes its message and
+# joins it between the two pre-rendered halves.
+_MESSAGE_PLACEHOLDER = "__TRIAL_PAGE_MESSAGE__"
+_TRIAL_TEMPLATE = app.jinja_env.from_string(TRIAL_PAGE)
+
+
+def _split_trial_page(show_form: bool, already_passed: bool) -> Tuple[str, str]:
+    page = _TRIAL_TEMPLATE.render(
+        message=_MESSAGE_PLACEHOLDER,
+        show_form=show_form,
+        already_passed=already_passed,
+        asset_url=asset_url,
+    )
+    before, placeholder, after = page.partition(_MESSAGE_PLACEHOLDER)
+    if not placeholder or _MESSAGE_PLACEHOLDER in after:
+        raise ValueError("TRIAL_PAGE must use {{ message }} exactly once")
+    return before, after
+
+
+_TRIAL_PAGE_PARTS: Dict[Tuple[bool, bool], Tuple[str, str]] = {
+    (show_form, already_passed): _split_trial_page(show_form, already_passed)
+    for show_form in (False, True)
+    for already_passed in (False, True)
+}
+
+
 def _render(message: str, show_form: bool, already_passed: bool = False) -> str:
-    return render_template_string(TRIAL_PAGE, message=message, show_form=show_form, already_passed=already_passed)
+    started = time.perf_counter()
+    with span("trial.render"):
+        before, after = _TRIAL_PAGE_PARTS[(bool(show_form), bool(already_passed))]
+        # Same autoescaping render_template_string() applied to {{ message }}
+        page = "".join((before, str(escape(message)), after))
+    RENDER_LATENCY.observe(time.perf_counter() - started)
+    return page
+
+
+def _ip_block_page(verdict: IPVerdict) -> Optional[str]:
+    """Return the rejection page for a VPN / blocked-country verdict, or None if the IP may proceed."""
+    if verdict.is_vpn:
+        IP_BLOCKS.labels("vpn").inc()
+        return _render(
+            "We detected VPN / proxy on your connection. "
+            "Please turn it off and apply again. "
+            "We store minimal information only for security and abuse prevention.",
+            show_form=False,
+        )
+
+    if verdict.is_blocked_country:
+        IP_BLOCKS.labels("country").inc()
+        country_name = "Pakistan" if BLOCKED_COUNTRY_CODE == "PK" else "India" if BLOCKED_COUNTRY_CODE == "IN" else BLOCKED_COUNTRY_CODE
+        return _render(
+            f"Sorry, you are not eligible for this trial from your region ({country_name}). "
+            "We store minimal information only for security and abuse-prevention. "
+            "You can request deletion at any time.",
+            show_form=False,
+        )
+
+    return None
+
+
+@app.before_request
+def _start_request() -> None:
+    g.request_started = time.perf_counter()
+    g.request_id = request_id_from(request.headers.get("X-Request-ID"))
+    g.request_id_token = request_id_var.set(g.request_id)
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    g.trace = start_trace(
+        f"{request.method} {route}", request.headers.get("traceparent"),
+        **{"http.method": request.method, "http.route": route, "request_id": g.request_id},
+    )
+
+
+@app.after_request
+def _record_request(response: Response) -> Response:
+    # Label by route pattern, not path, to keep the series count bounded
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    HTTP_REQUESTS.labels(route, request.method, str(response.status_code)).inc()
+    started = g.get("request_started")
+    if started is not None:
+        duration = time.perf_counter() - started
+        HTTP_LATENCY.labels(route, request.method).observe(duration)
+        log.info(
+            "request",
+            extra={"route": route, "method": request.method, "status": response.status_code, "duration_ms": round(duration * 1000, 2)},
+        )
+    if "request_id" in g:
+        response.headers["X-Request-ID"] = g.request_id
+    trace = g.get("trace")
+    if trace is not None:
+        trace.set_attribute("http.status_code", response.status_code)
+    return response
+
+
+@app.teardown_request
+def _end_request(exc: Optional[BaseException]) -> None:
+    finish_trace(g.pop("trace", None), error=f"{type(exc).__name__}: {exc}" if exc else None)
+    token = g.pop("request_id_token", None)
+    if token is not None:
+        request_id_var.reset(token)
+
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus metrics, summed over all workers (see metrics.py)."""
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
+
+def _bearer_token_matches(headers: Mapping[str, str], expected: str) -> bool:
+    """Whether the request carries "Authorization: Bearer <expected>" (constant-time compare)."""
+    scheme, _, token = (headers.get("Authorization") or "").partition(" ")
+    return bool(expected) and scheme.lower() == "bearer" and hmac.compare_digest(token.encode(), expected.encode())
+
+
+def _bot_authorized(headers: Mapping[str, str]) -> bool:
+    return _bearer_token_matches(headers, BOT_API_SECRET)
+
+
+def _admin_authorized(headers: Mapping[str, str]) -> Optional[bool]:
+    """None if the admin endpoints are disabled, else whether the bearer token matches."""
+    if not ADMIN_TOKEN:
+        return None
+    return _bearer_token_matches(headers, ADMIN_TOKEN)
+
+
+def _profile_response(headers: Mapping[str, str], seconds_param: Optional[str]) -> Tuple[str, int, Dict[str, str]]:
+    """
+    (body, status, headers) for /admin/profile: sample every thread of this
+    worker for `seconds` (default 10) and return folded stacks, ready for
+    flamegraph.pl or speedscope. Blocks the calling thread meanwhile.
+    """
+    text = {"Content-Type": "text/plain; charset=utf-8"}
+    authorized = _admin_authorized(headers)
+    if authorized is None:
+        return "Not found", 404, text
+    if not authorized:
+        return "Forbidden", 403, text
+    try:
+        seconds = float(seconds_param or "10")
+    except ValueError:
+        seconds = -1
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        return f"seconds must be in (0, {PROFILE_MAX_SECONDS:g}]", 400, text
+    try:
+        stacks = sample_stacks(seconds)
+    except ProfilerBusy:
+        return "A profile is already running in this worker", 409, text
+    return folded(stacks), 200, {**text, "X-Profile-PID": str(os.getpid())}
+
+
+@app.route("/admin/profile")
+def admin_profile():
+    """
+    On-demand sampling profile of the worker that answers, e.g.
+    curl -H "Authorization: Bearer $ADMIN_TOKEN" ".../admin/profile?seconds=10" > out.folded
+    To cover every worker at once, send SIGUSR2 instead (see profiler.py).
+    """
+    return _profile_response(request.headers, request.args.get("seconds"))
 
 
 @app.route("/")
@@ -695,6 +482,24 @@ def index() -> str:
     return "Telegram Trial Verification Service is running. Use /trial endpoint.", 200
 
 
+@app.route("/assets/<path:name>")
+def static_asset(name: str):
+    """CSS / JS / country list for /trial, by content-hashed name (see assets.py)."""
+    return asset_response(name, request.headers.get("If-None-Match"), request.headers.get("Accept-Encoding"))
+
+
+def _check_step1_headers(passed: bool) -> Dict[str, str]:
+    """
+    Caching headers for a /check-step1 answer. A pass rarely goes away (only on
+    expiry or once the bot clears the record), so the browser may reuse it for
+    a while; "not yet" can change any moment and must be revalidated.
+    """
+    return {
+        "ETag": '"step1-passed"' if passed else '"step1-pending"',
+        "Cache-Control": f"private, max-age={CHECK_STEP1_MAX_AGE}" if passed else "private, no-cache",
+    }
+
+
 @app.route("/check-step1", methods=["GET"])
 def check_step1():
     """Check if user already passed step1 - used by JavaScript."""
@@ -702,10 +507,11 @@ def check_step1():
     if not tg_id_param or not tg_id_param.isdigit():
         return jsonify({"already_passed": False})
     
-    existing_data = get_pending_verification(int(tg_id_param))
-    if existing_data and existing_data.get("step1_ok"):
-        return jsonify({"already_passed": True})
-    return jsonify({"already_passed": False})
+    passed = has_passed_step1(int(tg_id_param))
+    headers = _check_step1_headers(passed)
+    if request.headers.get("If-None-Match") == headers["ETag"]:
+        return "", 304, headers
+    return jsonify({"already_passed": passed}), 200, headers
 
 
 @app.route("/api/get-verification", methods=["GET"])
@@ -724,6 +530,149 @@ def api_get_verification():
     return jsonify({"success": False, "data": None})
 
 
+@app.route("/api/get-verifications", methods=["GET", "POST"])
+def api_get_verifications():
+    """
+    Batch version of /api/get-verification for the bot.
+
+    Lookup: tg_ids as a repeated `tg_id` parameter (?tg_id=1&tg_id=2) or a JSON
+    body {"tg_ids": [1, 2]}; returns the records found plus the ids that weren't.
+    Bulk sync: no tg_ids at all; returns up to `limit` records ordered by tg_id and a
+    `next_cursor` to pass back as `cursor` (null on the last page).
+    Both modes take an optional `status` filter. Records include name, email
+    and IP, so the bot must authenticate with BOT_API_SECRET.
+    """
+    if not _bot_authorized(request.headers):
+        return jsonify({"error": "Unauthorized"}), 401
+    body = request.get_json(silent=True) if request.method == "POST" else None
+    if not isinstance(body, dict):
+        body = {}
+    raw_ids = body.get("tg_ids", request.args.getlist("tg_id"))
+    # An explicit empty list is a caller bug, not a request for everything
+    bulk = "tg_ids" not in body and "tg_id" not in request.args
+    status = body.get("status", request.args.get("status")) or None
+    if not isinstance(raw_ids, list) or not all(str(i).isdigit() for i in raw_ids):
+        return jsonify({"error": "Invalid tg_ids"}), 400
+    if len(raw_ids) > BATCH_MAX_IDS:
+        return jsonify({"error": f"At most {BATCH_MAX_IDS} tg_ids per request"}), 400
+
+    if not bulk and not raw_ids:
+        return jsonify({"error": "tg_ids must not be empty"}), 400
+
+    if raw_ids:
+        tg_ids = [int(i) for i in raw_ids]
+        found = get_pending_verifications(tg_ids, status=status)
+        return jsonify({
+            "success": True,
+            "data": {str(tg_id): info for tg_id, info in found.items()},
+            "missing": [tg_id for tg_id in dict.fromkeys(tg_ids) if tg_id not in found],
+        })
+
+    cursor = str(body.get("cursor", request.args.get("cursor", "0")) or "0")
+    limit = str(body.get("limit", request.args.get("limit", BATCH_MAX_IDS)))
+    if not cursor.isdigit() or not limit.isdigit() or not 0 < int(limit) <= BATCH_MAX_IDS:
+        return jsonify({"error": "Invalid cursor or limit"}), 400
+    page, next_cursor = list_pending_verifications(status=status, after=int(cursor), limit=int(limit))
+    return jsonify({
+        "success": True,
+        "data": {str(tg_id): info for tg_id, info in page},
+        "next_cursor": next_cursor,
+    })
+
+
+@app.route("/api/storage-stats", methods=["GET"])
+def api_storage_stats():
+    """
+    Live vs. expired pending verification counts and compaction counters.
+    Scans every record, so it sits behind the admin token like /admin/profile.
+    """
+    authorized = _admin_authorized(request.headers)
+    if authorized is None:
+        return jsonify({"error": "Not found"}), 404
+    if not authorized:
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify({**pending_stats(), "events": feed_stats()})
+
+
+def _parse_cursor(value: Optional[str]) -> Optional[int]:
+    """Cursor from a query parameter / header: None for "from now on", -1 if invalid."""
+    if value is None or value == "":
+        return None
+    return int(value) if value.isdigit() else -1
+
+
+def _too_many_waiters():
+    response = jsonify({"error": "Too many event listeners on this worker; retry shortly"})
+    response.headers["Retry-After"] = "5"
+    return response, 503
+
+
+@app.route("/api/events", methods=["GET"])
+def api_events():
+    """
+    Long-poll change feed of step-1 completions for the bot.
+    Waits up to `timeout` seconds for events after `cursor` and returns
+    {"events": [...], "cursor": N, "reset": bool}; call again with the returned
+    cursor. Without a cursor, only events from now on are returned. Use
+    cursor=0 to read everything still retained. Requires BOT_API_SECRET.
+    """
+    if not _bot_authorized(request.headers):
+        return jsonify({"error": "Unauthorized"}), 401
+    cursor = _parse_cursor(request.args.get("cursor"))
+    timeout = request.args.get("timeout", str(EVENTS_LONG_POLL_MAX_SECONDS))
+    limit = request.args.get("limit", "100")
+    try:
+        timeout_seconds = min(max(float(timeout), 0.0), EVENTS_LONG_POLL_MAX_SECONDS)
+    except ValueError:
+        timeout_seconds = -1
+    if cursor == -1 or timeout_seconds < 0 or not limit.isdigit() or not 0 < int(limit) <= BATCH_MAX_IDS:
+        return jsonify({"error": "Invalid cursor, timeout or limit"}), 400
+    if not _event_waiters.acquire(blocking=False):
+        return _too_many_waiters()
+    try:
+        events, next_cursor, reset = wait_for_events(cursor, timeout_seconds, int(limit))
+    finally:
+        _event_waiters.release()
+    return jsonify({"events": events, "cursor": next_cursor, "reset": reset})
+
+
+@app.route("/api/events/stream", methods=["GET"])
+def api_events_stream():
+    """
+    Server-Sent Events version of /api/events. Resumes from the Last-Event-ID
+    header (sent automatically by EventSource clients on reconnect) or the
+    `cursor` parameter. Closes after EVENTS_STREAM_MAX_SECONDS so workers are
+    recycled; clients simply reconnect. Requires BOT_API_SECRET.
+    """
+    if not _bot_authorized(request.headers):
+        return jsonify({"error": "Unauthorized"}), 401
+    cursor = _parse_cursor(request.headers.get("Last-Event-ID") or request.args.get("cursor"))
+    if cursor == -1:
+        return jsonify({"error": "Invalid cursor"}), 400
+    if not _event_waiters.acquire(blocking=False):
+        return _too_many_waiters()
+
+    def stream():
+        position = cursor
+        deadline = time.monotonic() + EVENTS_STREAM_MAX_SECONDS
+        yield "retry: 1000\n\n"
+        while time.monotonic() < deadline:
+            events, position, reset = wait_for_events(position, min(15.0, max(deadline - time.monotonic(), 0)))
+            if reset:
+                yield "event: reset\ndata: {}\n\n"
+            for event in events:
+                payload = json.dumps(event, ensure_ascii=False)
+                yield f"id: {event['cursor']}\nevent: {event['type']}\ndata: {payload}\n\n"
+            if not events:
+                yield ": keepalive\n\n"
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    response = Response(stream(), mimetype="text/event-stream", headers=headers)
+    # Runs when the stream ends or the client goes away
+    response.call_on_close(_event_waiters.release)
+    return response
+
+
 @app.route("/debug-ip")
 def debug_ip() -> str:
     """
@@ -731,7 +680,8 @@ def debug_ip() -> str:
     Remove this in production!
     """
     ip = get_client_ip()
-    data = _ip2location_lookup(ip)
+    verdict = get_ip_verdict(ip)
+    data = verdict.data
     
     if not data:
         return f"API lookup failed for IP: {ip}", 500
@@ -746,117 +696,101 @@ def debug_ip() -> str:
         "proxy": data.get("proxy"),
         "proxy_type": data.get("proxy_type"),
         "usage_type": data.get("usage_type"),
+        "is_vpn": verdict.is_vpn,
+        "is_blocked_country": verdict.is_blocked_country,
         "full_response": data,
+        "ip_cache": _ip_cache.stats(),
+        "ip_client": _ip_client.stats(),
+        "ip_single_flight": _ip_flight.stats(),
+        "ip_database": _local_ip_db.stats() if _local_ip_db is not None else None,
     }
     
     return f"<pre>{json.dumps(debug_info, indent=2)}</pre>", 200
 
 
-@app.route("/trial", methods=["GET", "POST"])
-def trial() -> str:
-    ip = get_client_ip()
+def _already_passed_page() -> str:
+    return _render(
+        "✅ You have already passed Step 1 verification!\n\n"
+        "Please close this window and tap 'Continue verification' button in Telegram to proceed with Step 2.",
+        show_form=False,
+        already_passed=True,  # Flag to trigger close script
+    )
 
-    # For GET requests: Allow page to load without tg_id (JavaScript will extract it from Telegram Web App)
-    if request.method == "GET":
-        # Check if user already passed step1 (from query param or will be extracted by JavaScript)
-        tg_id_param: Optional[str] = request.args.get("tg_id")
-        if tg_id_param and tg_id_param.isdigit():
-            existing_data = get_pending_verification(int(tg_id_param))
-            if existing_data and existing_data.get("step1_ok"):
-                # User already passed step1 - show message and close Web App
-                return _render(
-                    "✅ You have already passed Step 1 verification!\n\n"
-                    "Please close this window and tap 'Continue verification' button in Telegram to proceed with Step 2.",
-                    show_form=False,
-                    already_passed=True,  # Flag to trigger close script
-                )
-        
-        # IP / VPN checks happen before showing the form
-        if is_vpn_ip(ip):
-            return _render(
-                "We detected VPN / proxy on your connection. "
-                "Please turn it off and apply again. "
-                "We store minimal information only for security and abuse prevention.",
-                show_form=False,
-            )
-
-        if is_blocked_country_ip(ip):
-            country_name = "Pakistan" if BLOCKED_COUNTRY_CODE == "PK" else "India" if BLOCKED_COUNTRY_CODE == "IN" else BLOCKED_COUNTRY_CODE
-            return _render(
-                f"Sorry, you are not eligible for this trial from your region ({country_name}). "
-                "We store minimal information only for security and abuse-prevention. "
-                "You can request deletion at any time.",
-                show_form=False,
-            )
 
-        # Allow page to load - JavaScript will extract tg_id from Telegram Web App API
-        return _render(
-            "IP check passed. Please fill in your name and country to continue.",
-            show_form=True,
-        )
+def _form_page() -> str:
+    return _render(
+        "IP check passed. Please fill in your name and country to continue.",
+        show_form=True,
+    )
 
-    # For POST requests: Require tg_id (from form data, query param, or Telegram Web App initData)
-    tg_id_param: Optional[str] = request.form.get("tg_id") or request.form.get("tg_id_backup") or request.args.get("tg_id")
+
+def _missing_tg_id_page() -> str:
+    return _render(
+        "Error: Could not verify your Telegram account. Please make sure you opened this page from Telegram and try again. "
+        "If the problem persists, close this window and tap 'Get Free Trial' again.",
+        show_form=True,
+    )
+
+
+def _missing_fields_page() -> str:
+    return _render(
+        "Name and country are required. Please fill the form again.",
+        show_form=True,
+    )
+
+
+def _save_failed_page() -> str:
+    return _render(
+        "Error saving your information. Please try again.",
+        show_form=True,
+    )
+
+
+def _step1_passed_page() -> str:
+    return _render(
+        "Step 1 verification passed ✅. "
+        "Please go back to Telegram and tap 'Continue verification'. "
+        "We only use your data for verification, security and (if you agreed) updates.",
+        show_form=False,
+    )
+
+
+def _submitted_tg_id(form: Mapping[str, str], args: Mapping[str, str], headers: Mapping[str, str]) -> Optional[int]:
+    """tg_id of a POST to /trial (form data, query param, or Telegram Web App initData), or None."""
+    tg_id_param: Optional[str] = form.get("tg_id") or form.get("tg_id_backup") or args.get("tg_id")
     
     # Fallback: Try to extract from Telegram Web App initData if available
     if not tg_id_param or not tg_id_param.isdigit():
         # Check if this is a Telegram Web App request
-        init_data = request.headers.get("X-Telegram-Init-Data") or request.form.get("_auth")
+        init_data = headers.get("X-Telegram-Init-Data") or form.get("_auth")
         if init_data:
             # Try to parse initData (basic extraction - in production you should validate the hash)
             try:
-                import urllib.parse
                 parsed = urllib.parse.parse_qs(init_data)
                 if "user" in parsed:
                     user_str = parsed["user"][0]
-                    import json
                     user_data = json.loads(user_str)
                     if "id" in user_data:
                         tg_id_param = str(user_data["id"])
             except Exception:
                 pass
     
-    # Final check - if still no tg_id, return helpful error
     if not tg_id_param or not tg_id_param.isdigit():
-        return _render(
-            "Error: Could not verify your Telegram account. Please make sure you opened this page from Telegram and try again. "
-            "If the problem persists, close this window and tap 'Get Free Trial' again.",
-            show_form=True,
-        )
-    
-    tg_id = int(tg_id_param)
-
-    # Re-check VPN and India IP on POST (security: prevent bypass)
-    if is_vpn_ip(ip):
-        return _render(
-            "We detected VPN / proxy on your connection. "
-            "Please turn it off and apply again. "
-            "We store minimal information only for security and abuse prevention.",
-            show_form=False,
-        )
+        return None
+    return int(tg_id_param)
 
-    if is_blocked_country_ip(ip):
-        country_name = "Pakistan" if BLOCKED_COUNTRY_CODE == "PK" else "India" if BLOCKED_COUNTRY_CODE == "IN" else BLOCKED_COUNTRY_CODE
-        return _render(
-            f"Sorry, you are not eligible for this trial from your region ({country_name}). "
-            "We store minimal information only for security and abuse-prevention. "
-            "You can request deletion at any time.",
-            show_form=False,
-        )
 
-    # POST: user submitted form
-    name = (request.form.get("name") or "").strip()
-    country = (request.form.get("country") or "").strip()
-    email = (request.form.get("email") or "").strip()
-    marketing_opt_in = request.form.get("marketing_opt_in") == "1"
+def _step1_info(form: Mapping[str, str], ip: str) -> Optional[Dict[str, Any]]:
+    """The pending verification record for a submitted form, or None if name / country are missing."""
+    name = (form.get("name") or "").strip()
+    country = (form.get("country") or "").strip()
+    email = (form.get("email") or "").strip()
+    marketing_opt_in = form.get("marketing_opt_in") == "1"
 
     if not name or not country:
-        return _render(
-            "Name and country are required. Please fill the form again.",
-            show_form=True,
-        )
+        return None
 
-    info = {
+    return {
         "name": name,
         "country": country,
         "email": email,
@@ -866,33 +800,56 @@ def trial() -> str:
         "status": "step1_passed",
         "created_at": _now_utc().isoformat(),
     }
-    
-    try:
-        set_pending_verification(tg_id, info)
-        # Verify it was saved
-        from storage import get_pending_verification as verify_get
-        verified = verify_get(tg_id)
-        if not verified or not verified.get("step1_ok"):
-            print(f"WARNING: Data saved but verification failed for tg_id={tg_id}")
-            print(f"Saved data: {info}")
-        else:
-            print(f"✅ Successfully saved verification for tg_id={tg_id}, name={name}")
-    except Exception as e:
-        # Log error but don't crash - return error message to user
-        import traceback
-        print(f"❌ Error saving verification data for tg_id={tg_id}: {e}")
-        print(traceback.format_exc())
-        return _render(
-            f"Error saving your information. Please try again. Error: {str(e)}",
-            show_form=True,
-        )
 
-    return _render(
-        "Step 1 verification passed ✅. "
-        "Please go back to Telegram and tap 'Continue verification'. "
-        "We only use your data for verification, security and (if you agreed) updates.",
-        show_form=False,
-    )
+
+@app.route("/trial", methods=["GET", "POST"])
+def trial() -> str:
+    # The async app (async_app.py) runs the same steps with non-blocking I/O;
+    # keep the two in sync.
+    with span("trial.client_ip"):
+        ip = get_client_ip()
+
+    # For GET requests: Allow page to load without tg_id (JavaScript will extract it from Telegram Web App)
+    if request.method == "GET":
+        # Check if user already passed step1 (from query param or will be extracted by JavaScript)
+        tg_id_param: Optional[str] = request.args.get("tg_id")
+        if tg_id_param and tg_id_param.isdigit() and has_passed_step1(int(tg_id_param)):
+            # User already passed step1 - show message and close Web App
+            return _already_passed_page()
+        
+        # IP / VPN checks happen before showing the form (one lookup for both)
+        blocked_page = _ip_block_page(get_ip_verdict(ip))
+        if blocked_page is not None:
+            return blocked_page
+
+        # Allow page to load - JavaScript will extract tg_id from Telegram Web App API
+        return _form_page()
+
+    # For POST requests: Require tg_id (from form data, query param, or Telegram Web App initData)
+    tg_id = _submitted_tg_id(request.form, request.args, request.headers)
+    # Final check - if still no tg_id, return helpful error
+    if tg_id is None:
+        return _missing_tg_id_page()
+
+    # Re-check VPN and blocked country on POST (security: prevent bypass)
+    blocked_page = _ip_block_page(get_ip_verdict(ip))
+    if blocked_page is not None:
+        return blocked_page
+
+    # POST: user submitted form
+    info = _step1_info(request.form, ip)
+    if info is None:
+        return _missing_fields_page()
+    
+    # set_pending_verification() only returns True once the write is durable,
+    # so there is no need to read it back; failures are logged by storage.
+    if not set_pending_verification(tg_id, info):
+        return _save_failed_page()
+    log.info("Step 1 passed", extra={"tg_id": tg_id})
+    # Tell the bot right away instead of waiting for its next poll
+    publish("step1_passed", tg_id)
+
+    return _step1_passed_page()
 
 
 if __name__ == "__main__":